@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+
+"""agenda.py
+
+A user's agenda: the sessions of their wishlist by date, with the ones
+overlapping in time grouped as conflicts. The sessions of a day are
+sorted by start time and swept once, keeping the latest end seen so far:
+a session starting before it overlaps the running group. That is
+O(n log n) for n sessions, whatever the number of conferences followed.
+Sessions without a start time are listed but never conflict; a missing
+duration counts as zero minutes.
+
+The encoded agenda is cached per user under a signature of the wishlist
+and of the version counters of its conferences, which every session
+write bumps: changing the wishlist or one of its sessions makes the next
+read rebuild it.
+
+"""
+
+import hashlib
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+from caching import MEMCACHE_AGENDA_PRE_KEY
+from caching import conferenceVersionKey
+from caching import getVersions
+
+AGENDA_CACHE_SECONDS = 3600
+
+
+def _minutes(t):
+    return t.hour * 60 + t.minute
+
+
+def formatMinutes(minutes):
+    """Return minutes from midnight as HH:MM (past 24:00 for sessions
+    ending after midnight)."""
+    return '%02d:%02d' % divmod(minutes, 60)
+
+
+def conflictGroups(sessions):
+    """Return the groups of overlapping sessions of one day, sessions being
+    in start order, as [(start, end, sessions)] in minutes from midnight.
+    A group is a chain of overlaps: its first and last sessions may not
+    overlap each other."""
+    groups, group, groupStart, latestEnd = [], [], None, None
+    for sess in sessions:
+        if sess.start is None:
+            continue
+        start = _minutes(sess.start)
+        end = start + (_minutes(sess.duration) if sess.duration else 0)
+        if group and start < latestEnd:
+            group.append(sess)
+            latestEnd = max(latestEnd, end)
+            continue
+        if len(group) > 1:
+            groups.append((groupStart, latestEnd, group))
+        group, groupStart, latestEnd = [sess], start, end
+    if len(group) > 1:
+        groups.append((groupStart, latestEnd, group))
+    return groups
+
+
+def _startOrder(sess):
+    # sessions without a start time go last
+    return (sess.start is None, sess.start, sess.name)
+
+
+def agendaDays(sessions):
+    """Return the agenda of sessions: [(date, sessions in start order,
+    conflictGroups)] by date, sessions without a date last."""
+    days = {}
+    for sess in sessions:
+        days.setdefault(sess.date, []).append(sess)
+    agenda = []
+    for day in sorted(days, key=lambda d: (d is None, d)):
+        ordered = sorted(days[day], key=_startOrder)
+        agenda.append((day, ordered, conflictGroups(ordered)))
+    return agenda
+
+
+def _signature(wishlist):
+    wishlist = sorted(set(wishlist))
+    conferences = set()
+    for wssk in wishlist:
+        try:
+            conferences.add(ndb.Key(urlsafe=wssk).parent().urlsafe())
+        except Exception:
+            # invalid keys are skipped by the agenda as well
+            continue
+    conferences = sorted(conferences)
+    versions = getVersions([conferenceVersionKey(wsck) for wsck in conferences])
+    return hashlib.md5(repr((wishlist, conferences, versions))).hexdigest()
+
+
+def cachedAgenda(user_id, wishlist, build):
+    """Return build(), the encoded agenda of wishlist, cached for the user
+    until the wishlist or one of its sessions changes."""
+    # versions are read before building: a concurrent write can only leave
+    # an agenda under an older signature
+    signature = _signature(wishlist)
+    key = MEMCACHE_AGENDA_PRE_KEY + user_id
+    cached = memcache.get(key)
+    if cached and cached[0] == signature:
+        return cached[1]
+    agenda = build()
+    memcache.set(key, (signature, agenda), time=AGENDA_CACHE_SECONDS)
+    return agenda
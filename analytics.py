@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+
+"""analytics.py
+
+Offline analytics for the organisers: seat fill rates by city, start
+month and topic, and the mix of session types and durations. An
+AnalyticsJob, started daily by /crons/analytics or from /admin/analytics,
+runs in chained /tasks/analytics tasks. Every step reads one page of a
+projection query into columnar NumPy arrays, sums it by group
+(np.unique and np.bincount) and adds the sums to the job's running
+totals with the checkpoint, so memory stays bounded by the page whatever
+the number of entities:
+
+    conferences  city, startDate, maxAttendees, seatsAvailable
+    topics       topics, maxAttendees, seatsAvailable (one row per topic)
+    sessions     typeOfSession, duration
+
+The last step turns the totals into an AnalyticsSnapshot, which
+/admin/analytics serves. The projections need the composite indexes of
+index.yaml; entities missing a projected property are left out. A job
+with no progress for JOB_TIMEOUT_SECONDS is abandoned by the next start.
+
+"""
+
+import logging
+from datetime import datetime
+from datetime import timedelta
+
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+
+from models import AnalyticsJob
+from models import AnalyticsSnapshot
+from models import Conference
+from models import Session
+
+PAGE_SIZE = 1000
+DURATION_BUCKET_MINUTES = 15
+KEEP_SNAPSHOTS = 30
+JOB_TIMEOUT_SECONDS = 6 * 3600
+
+# phase -> (kind, projected properties), in order
+PHASES = [
+    ('conferences', Conference, ['city', 'startDate', 'maxAttendees', 'seatsAvailable']),
+    ('topics', Conference, ['topics', 'maxAttendees', 'seatsAvailable']),
+    ('sessions', Session, ['typeOfSession', 'duration']),
+]
+
+
+def startAnalyticsJob():
+    """Start a job unless one is running; return the running job. A job
+    with no progress for JOB_TIMEOUT_SECONDS is abandoned."""
+    timeout = datetime.utcnow() - timedelta(seconds=JOB_TIMEOUT_SECONDS)
+    for running in AnalyticsJob.query(AnalyticsJob.done == False):
+        if running.updatedAt > timeout:
+            return running
+        _abandon(running.key)
+    job = AnalyticsJob(phase=PHASES[0][0], totals={})
+    job.put()
+    _enqueueStep(job.key, 0)
+    return job
+
+
+@ndb.transactional()
+def _abandon(job_key):
+    """Mark a stuck job done, so that its pending steps do nothing."""
+    job = job_key.get()
+    if job and not job.done:
+        logging.warning('Abandoning analytics job %s stuck at step %d (%s)'
+                        % (job_key.id(), job.step, job.phase))
+        job.phase = 'abandoned'
+        job.totals = {}
+        job.done = True
+        job.put()
+
+
+def _enqueueStep(job_key, step):
+    """Queue the task running one step of a job."""
+    taskqueue.add(params={'job': job_key.urlsafe(), 'step': step},
+        url='/tasks/analytics',
+        transactional=ndb.in_transaction()
+    )
+
+
+def _groupSums(labels, columns):
+    """Return {label: [sum of every column]} over rows; labels and columns
+    are arrays of the same length."""
+    import numpy as np
+    if not len(labels):
+        return {}
+    keys, inverse = np.unique(labels, return_inverse=True)
+    sums = [np.bincount(inverse, weights=column, minlength=len(keys))
+            for column in columns]
+    return dict((key, [float(s[i]) for s in sums]) for i, key in enumerate(keys))
+
+
+def _addTo(totals, group, sums):
+    values = totals.setdefault(group, {})
+    for label, row in sums.items():
+        old = values.get(label)
+        values[label] = [a + b for a, b in zip(old, row)] if old else row
+
+
+def _fillSums(rows, labels):
+    """Sum [conferences, capacity, registered] by label over the rows with
+    a capacity."""
+    import numpy as np
+    capacity = np.array([r.maxAttendees or 0 for r in rows], float)
+    seats = np.array([r.seatsAvailable or 0 for r in rows], float)
+    registered = np.maximum(capacity - seats, 0)
+    valid = capacity > 0
+    labels = np.array(labels, object)[valid]
+    return _groupSums(labels, [np.ones(len(labels)), capacity[valid], registered[valid]])
+
+
+def _single(value):
+    # a projected repeated property holds the one value of its row
+    if isinstance(value, list):
+        value = value[0] if value else None
+    return value or ''
+
+
+def pageSums(phase, rows):
+    """Return the sums {group: {label: [sums]}} of one page of projected
+    entities of a phase."""
+    import numpy as np
+    if phase == 'conferences':
+        months = [r.startDate.strftime('%Y-%m') if r.startDate else '' for r in rows]
+        return {
+            'city': _fillSums(rows, [r.city or '' for r in rows]),
+            'month': _fillSums(rows, months),
+        }
+    if phase == 'topics':
+        return {'topic': _fillSums(rows, [_single(r.topics) for r in rows])}
+    minutes = np.array([r.duration.hour * 60 + r.duration.minute if r.duration else -1
+                        for r in rows], float)
+    timed = minutes >= 0
+    types = np.array([r.typeOfSession or '' for r in rows], object)
+    buckets = (minutes[timed] // DURATION_BUCKET_MINUTES) * DURATION_BUCKET_MINUTES
+    return {
+        # sessions, sessions with a duration, their minutes
+        'type': _groupSums(types, [np.ones(len(rows)), timed.astype(float),
+                                   np.where(timed, minutes, 0)]),
+        'duration': _groupSums(buckets.astype(int).astype(str),
+                               [np.ones(len(buckets))]),
+    }
+
+
+def runAnalyticsStep(job_key, step):
+    """Run one step of a job and checkpoint it."""
+    job = job_key.get()
+    if not job or job.done or job.step != step:
+        # duplicate of a step that was already checkpointed
+        return
+    names = [name for name, kind, properties in PHASES]
+    index = names.index(job.phase)
+    name, kind, properties = PHASES[index]
+    start = Cursor(urlsafe=job.cursor) if job.cursor else None
+    rows, cursor, more = kind.query().fetch_page(
+        PAGE_SIZE, start_cursor=start, projection=properties)
+    sums = pageSums(name, rows)
+    job.entitiesRead += len(rows)
+    if more and cursor:
+        job.cursor = cursor.urlsafe()
+    else:
+        job.cursor = None
+        job.phase = names[index + 1] if index + 1 < len(names) else 'done'
+    _checkpoint(job_key, step, job, sums)
+    if job.phase == 'done':
+        _deleteOldSnapshots()
+
+
+@ndb.transactional()
+def _checkpoint(job_key, step, job, sums):
+    stored = job_key.get()
+    if stored.done or stored.step != step:
+        return
+    totals = job.totals or {}
+    for group, values in sums.items():
+        _addTo(totals, group, values)
+    job.totals = totals
+    job.step += 1
+    job.done = job.phase == 'done'
+    if job.done:
+        snapshot = AnalyticsSnapshot(parent=job_key, results=summarise(totals),
+                                     entitiesRead=job.entitiesRead,
+                                     computedAt=datetime.utcnow())
+        snapshot.put()
+        logging.info('Analytics: %d entities read' % job.entitiesRead)
+    job.put()
+    if not job.done:
+        _enqueueStep(job_key, job.step)
+
+
+def _rates(values):
+    return dict((label or 'none', {
+        'conferences': int(count),
+        'capacity': int(capacity),
+        'registered': int(registered),
+        'fillRate': round(registered / capacity, 4),
+    }) for label, (count, capacity, registered) in values.items())
+
+
+def summarise(totals):
+    """Return the snapshot results of a job's totals."""
+    types = dict((label or 'none', {
+        'sessions': int(count),
+        'averageMinutes': round(minutes / timed, 1) if timed else None,
+    }) for label, (count, timed, minutes) in totals.get('type', {}).items())
+    return {
+        'fillRateByCity': _rates(totals.get('city', {})),
+        'fillRateByMonth': _rates(totals.get('month', {})),
+        'fillRateByTopic': _rates(totals.get('topic', {})),
+        'sessionTypes': types,
+        # sessions per duration bucket, keyed by its first minute
+        'sessionDurations': dict((label, int(count)) for label, (count,)
+                                 in totals.get('duration', {}).items()),
+    }
+
+
+def _deleteOldSnapshots():
+    keys = AnalyticsSnapshot.query().order(-AnalyticsSnapshot.computedAt).fetch(
+        offset=KEEP_SNAPSHOTS, keys_only=True)
+    # with the jobs that computed them
+    ndb.delete_multi(keys + [key.parent() for key in keys])
+
+
+def latestSnapshot():
+    """Return the last AnalyticsSnapshot as a dict, or None."""
+    snapshot = AnalyticsSnapshot.query().order(-AnalyticsSnapshot.computedAt).get()
+    if not snapshot:
+        return None
+    return {
+        'computedAt': str(snapshot.computedAt),
+        'entitiesRead': snapshot.entitiesRead,
+        'results': snapshot.results,
+    }
@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+
+"""apistats.py
+
+Per endpoint instrumentation of the API. Methods decorated with
+@instrumented record their latency (histogram), errors and API call
+counters (rpcstats) in per instance aggregates, which are added to the
+totals in memcache at most every FLUSH_SECONDS with a single
+offset_multi call. /admin/stats serves the totals.
+
+On the dev server (or with RPC_TRACE set) every call is also traced and
+logs a report of its API calls, with warnings for repeated queries and
+single gets that could be batched. With CAPTURE_CALLS set, calls are
+captured for replay (capture.py).
+
+The first call served by each instance is also counted on its own
+(firstCalls, firstLatencyMs, and msAfterStart since the instance loaded),
+with coldFirstCalls for the instances that got no warmup request; the
+warmup itself is recorded under WARMUP_METHOD.
+
+"""
+
+import bisect
+from functools import wraps
+import logging
+import threading
+import time
+
+from google.appengine.api import memcache
+
+import capture
+import rpcstats
+import warmup
+
+MEMCACHE_STATS_PREFIX = "ApiStats|"
+FLUSH_SECONDS = 60
+# upper bounds (ms) of the latency histogram buckets; the last one is open
+LATENCY_BUCKETS_MS = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+COUNTERS = ('calls', 'errors', 'latencyMs', 'firstCalls', 'firstLatencyMs',
+            'coldFirstCalls', 'msAfterStart') + rpcstats.RpcStats.FIELDS
+WARMUP_METHOD = 'warmup'
+
+_lock = threading.Lock()
+_pending = {}       # "method|counter" -> value not flushed yet
+_lastFlush = [time.time()]
+_firstCall = [True]
+
+
+def _bucketName(index):
+    if index < len(LATENCY_BUCKETS_MS):
+        return 'le%dms' % LATENCY_BUCKETS_MS[index]
+    return 'gt%dms' % LATENCY_BUCKETS_MS[-1]
+
+BUCKETS = [_bucketName(i) for i in range(len(LATENCY_BUCKETS_MS) + 1)]
+
+
+def instrumented(func):
+    """Record the latency, errors and API calls of an API method.
+    Put it under @endpoints.method, right above the method."""
+    name = func.__name__
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if capture.CAPTURE_CALLS:
+            capture.captureCall(name, args[-1])
+        error = False
+        started = time.time()
+        trace = rpcstats.RpcTrace() if rpcstats.TRACE_REQUESTS else None
+        with rpcstats.recording(trace) as stats:
+            try:
+                return func(*args, **kwargs)
+            except Exception:
+                error = True
+                raise
+            finally:
+                ms = (time.time() - started) * 1000
+                _record(name, ms, error, stats, _firstCallValues(name, ms))
+                if trace is not None:
+                    _report(name, trace)
+    return wrapper
+
+
+def _report(name, trace):
+    """Log the per request RPC report of a traced call."""
+    if trace.findings():
+        logging.warning('RPC report for %s: %s' % (name, trace.report()))
+    else:
+        logging.info('RPC report for %s: %s' % (name, trace.report()))
+
+
+def _firstCallValues(name, ms):
+    """Return the counters of the instance's first call, if this is it."""
+    with _lock:
+        first = _firstCall[0]
+        _firstCall[0] = False
+    if not first:
+        return {}
+    afterStart = (time.time() - warmup.STARTED) * 1000
+    logging.info('First call of the instance: %s in %.0f ms, %.0f ms after '
+                 'start (%s)' % (name, ms, afterStart,
+                                 'warm' if warmup.WARMED[0] else 'cold'))
+    return {'firstCalls': 1, 'firstLatencyMs': int(ms),
+            'coldFirstCalls': int(not warmup.WARMED[0]),
+            'msAfterStart': int(afterStart)}
+
+
+def recordWarmup(ms, stats):
+    """Record a warmup request that took ms, with its API call stats."""
+    _record(WARMUP_METHOD, ms, False, stats, {
+        'msAfterStart': int((time.time() - warmup.STARTED) * 1000)})
+
+
+def _record(name, ms, error, stats, extra=None):
+    """Add one call to the instance aggregates; flush them when due."""
+    bucket = BUCKETS[bisect.bisect_left(LATENCY_BUCKETS_MS, ms)]
+    values = stats.toDict()
+    values.update({'calls': 1, 'errors': int(error),
+                   'latencyMs': int(ms), bucket: 1})
+    values.update(extra or {})
+    with _lock:
+        for counter, value in values.items():
+            if value:
+                key = '%s|%s' % (name, counter)
+                _pending[key] = _pending.get(key, 0) + value
+        due = time.time() - _lastFlush[0] >= FLUSH_SECONDS
+        if due:
+            deltas = dict(_pending)
+            _pending.clear()
+            _lastFlush[0] = time.time()
+    if due:
+        flush(deltas)
+
+
+def flush(deltas):
+    """Add deltas to the totals in memcache."""
+    try:
+        memcache.offset_multi(deltas, key_prefix=MEMCACHE_STATS_PREFIX,
+                              initial_value=0)
+    except Exception, e:
+        # stats are best effort, never fail the request
+        logging.warning('Could not flush API stats: %s' % e)
+
+
+def readTotals(methods):
+    """Return the totals of the given methods: {method: {counter: value}}."""
+    counters = list(COUNTERS) + BUCKETS
+    keys = ['%s|%s' % (m, c) for m in methods for c in counters]
+    values = memcache.get_multi(keys, key_prefix=MEMCACHE_STATS_PREFIX)
+    totals = {}
+    for method in methods:
+        row = dict((c, values.get('%s|%s' % (method, c), 0)) for c in counters)
+        if row['calls']:
+            row['meanLatencyMs'] = float(row['latencyMs']) / row['calls']
+        totals[method] = row
+    return totals
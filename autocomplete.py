@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+
+"""autocomplete.py
+
+Prefix (typeahead) search on the names of conferences, sessions and
+speakers. The models store the edge n-grams of their normalised name, and
+of every word in it, in an indexed repeated namePrefixes property, so a
+prefix is one equality filter served by a (namePrefixes, name) index and
+a few projected rows. The results for prefixes of up to
+CACHED_PREFIX_LENGTH characters, the most requested and least
+selective, are cached in memcache for SUGGEST_CACHE_SECONDS.
+
+"""
+
+import re
+import unicodedata
+
+from google.appengine.api import memcache
+
+MEMCACHE_SUGGEST_PRE_KEY = "Suggest|"
+# longest prefix stored; longer ones are matched by filtering in memory
+MAX_PREFIX_LENGTH = 15
+CACHED_PREFIX_LENGTH = 3
+SUGGEST_CACHE_SECONDS = 300
+DEFAULT_SUGGESTIONS = 10
+MAX_SUGGESTIONS = 20
+# candidates read at most for a prefix longer than MAX_PREFIX_LENGTH
+MAX_SCANNED = 200
+
+_separators = re.compile(r'[^a-z0-9]+')
+
+
+def normalise(name):
+    """Return name lowercased, without accents or punctuation."""
+    if not name:
+        return ''
+    if isinstance(name, str):
+        name = name.decode('utf-8', 'ignore')
+    name = unicodedata.normalize('NFKD', name).encode('ascii', 'ignore')
+    return ' '.join(_separators.split(name.lower())).strip()
+
+
+def edgeNgrams(name):
+    """Return the prefixes of a name and of each of its words."""
+    name = normalise(name)
+    prefixes = set()
+    starts = [0] + [i + 1 for i, c in enumerate(name) if c == ' ']
+    for start in starts:
+        for end in range(start + 1, min(len(name), start + MAX_PREFIX_LENGTH) + 1):
+            prefixes.add(name[start:end].rstrip())
+    return sorted(prefixes)
+
+
+def _matches(name, prefix):
+    name = normalise(name)
+    return name.startswith(prefix) or (' ' + prefix) in name
+
+
+def suggestNames(cls, prefix, limit=DEFAULT_SUGGESTIONS):
+    """Return the (name, websafeKey) of the first entities of cls, by name,
+    whose name or one of its words starts with prefix."""
+    prefix = normalise(prefix)
+    if not prefix:
+        return []
+    limit = min(limit or DEFAULT_SUGGESTIONS, MAX_SUGGESTIONS)
+    stored = prefix[:MAX_PREFIX_LENGTH].rstrip()
+    short = len(prefix) <= CACHED_PREFIX_LENGTH
+    key = MEMCACHE_SUGGEST_PRE_KEY + '%s|%s' % (cls._get_kind(), prefix)
+    if short:
+        matches = memcache.get(key)
+        if matches is not None:
+            return matches[:limit]
+
+    q = cls.query(cls.namePrefixes == stored).order(cls.name)
+    if stored == prefix:
+        entities = q.fetch(MAX_SUGGESTIONS if short else limit,
+                           projection=[cls.name])
+    else:
+        # a prefix longer than the stored ones: filter the candidates
+        entities = []
+        for entity in q.iter(limit=MAX_SCANNED, projection=[cls.name],
+                             batch_size=MAX_SUGGESTIONS):
+            if _matches(entity.name, prefix):
+                entities.append(entity)
+                if len(entities) == limit:
+                    break
+    matches = [(e.name, e.key.urlsafe()) for e in entities]
+    if short:
+        memcache.set(key, matches, time=SUGGEST_CACHE_SECONDS)
+    return matches[:limit]
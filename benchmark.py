@@ -0,0 +1,428 @@
+#!/usr/bin/env python
+
+"""benchmark.py
+
+Endpoint benchmark on the App Engine testbed stubs. Generates a
+deterministic data set at the requested scale, then calls every
+ConferenceApi method and records, per method, the wall time, datastore
+RPCs, entities read and written, queries, memcache hit rate, tasks
+queued and the wasteful RPC patterns spotted (repeated queries, single
+gets that could be batched), and the cold start: the import time of
+the script modules in fresh interpreters and the first call of every
+method. Results are written as JSON so runs can be compared across
+commits. Runs offline; it only needs the App Engine SDK:
+
+    python benchmark.py --sdk ~/google_appengine --scale 1000 \
+        --output bench_output.txt
+
+--scale is the number of profiles; the data set has scale/10
+conferences of SESSIONS_PER_CONFERENCE sessions and scale/20 speakers.
+
+"""
+
+import argparse
+from datetime import date
+from datetime import time as dtime
+from datetime import timedelta
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+SESSIONS_PER_CONFERENCE = 5
+CONFERENCES_PER_ATTENDEE = 3
+SESSIONS_PER_WISHLIST = 5
+PUT_BATCH_SIZE = 500
+
+CITIES = ['London', 'Paris', 'Chicago', 'Tokyo', 'San Francisco', 'Sao Paulo']
+TOPICS = ['Medical Innovations', 'Programming Languages', 'Web Technologies',
+          'Movie Making', 'Health and Nutrition']
+SESSION_TYPES = ['workshop', 'lecture', 'keynote']
+COMPANIES = ['Google', 'Udacity', 'Acme', 'Initech']
+# script modules of app.yaml whose import a cold instance pays for
+STARTUP_MODULES = ('main', 'conference')
+STARTUP_CODE = """
+import sys, time
+sys.path[:0] = %(path)r
+import dev_appserver
+dev_appserver.fix_sys_path()
+started = time.time()
+import %(module)s
+sys.stdout.write('%%f' %% ((time.time() - started) * 1000))
+"""
+SPECIALTIES = ['app engine', 'python', 'javascript', 'datastore']
+
+
+def setupSdk(sdk):
+    """Put the App Engine SDK and its libraries on sys.path."""
+    if sdk:
+        sys.path.insert(0, sdk)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+    sys.path.insert(0, ROOT)
+
+
+def setupTestbed():
+    """Activate the stubs the API uses; return the testbed."""
+    from google.appengine.datastore import datastore_stub_util
+    from google.appengine.ext import testbed
+    tb = testbed.Testbed()
+    tb.activate()
+    # fully consistent, so every run reads the same data
+    policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=1)
+    tb.init_datastore_v3_stub(consistency_policy=policy)
+    tb.init_memcache_stub()
+    tb.init_taskqueue_stub(root_path=ROOT)
+    tb.init_mail_stub()
+    tb.init_app_identity_stub()
+    tb.init_urlfetch_stub()
+    tb.init_user_stub()
+    return tb
+
+
+class DataSet(object):
+    """DataSet -- keys and names of the generated entities"""
+
+    def __init__(self):
+        self.emails = []
+        self.conferences = []       # websafe keys
+        self.organizers = {}        # websafe conference key -> email
+        self.sessions = []          # websafe keys
+        self.speakers = []          # names
+
+
+def generate(scale, seed):
+    """Write a deterministic data set of the given scale; return its DataSet."""
+    from google.appengine.ext import ndb
+    from models import Conference
+    from models import Profile
+    from models import Session
+    from models import Speaker
+
+    rnd = random.Random(seed)
+    data = DataSet()
+    entities = []
+
+    def put(entity):
+        entities.append(entity)
+        if len(entities) >= PUT_BATCH_SIZE:
+            ndb.put_multi(entities)
+            del entities[:]
+
+    n_speakers = max(1, scale // 20)
+    for i in range(n_speakers):
+        name = 'Speaker %d' % i
+        data.speakers.append(name)
+        put(Speaker(id=i + 1, name=name, biography='Biography of %s' % name,
+                    company=rnd.choice(COMPANIES),
+                    specialty=rnd.sample(SPECIALTIES, 2)))
+
+    profiles = []
+    for i in range(scale):
+        email = 'user%d@example.com' % i
+        data.emails.append(email)
+        profiles.append(Profile(id=email, displayName='User %d' % i,
+                                mainEmail=email, teeShirtSize='NOT_SPECIFIED'))
+
+    n_conferences = max(1, scale // 10)
+    capacity = scale * CONFERENCES_PER_ATTENDEE // n_conferences + 10
+    confs = []
+    for i in range(n_conferences):
+        organizer = data.emails[rnd.randrange(scale)]
+        start = date(2016, 1, 1) + timedelta(days=rnd.randrange(365))
+        conf = Conference(
+            key=ndb.Key(Profile, organizer, Conference, i + 1),
+            name='Conference %d' % i,
+            description=('Description of conference %d. ' % i) * 5,
+            organizerUserId=organizer,
+            topics=rnd.sample(TOPICS, 2),
+            city=rnd.choice(CITIES),
+            startDate=start,
+            month=start.month,
+            endDate=start + timedelta(days=2),
+            maxAttendees=capacity,
+            seatsAvailable=capacity)
+        confs.append(conf)
+        wsck = conf.key.urlsafe()
+        data.conferences.append(wsck)
+        data.organizers[wsck] = organizer
+        for j in range(SESSIONS_PER_CONFERENCE):
+            sess = Session(
+                key=ndb.Key(Session, j + 1, parent=conf.key),
+                name='Session %d.%d' % (i, j),
+                highlights='Highlights of session %d.%d' % (i, j),
+                speaker=[rnd.choice(data.speakers)],
+                duration=dtime(1, 0),
+                typeOfSession=rnd.choice(SESSION_TYPES),
+                date=start,
+                start=dtime(9 + 2 * j, 0))
+            data.sessions.append(sess.key.urlsafe())
+            put(sess)
+
+    # registrations and wishlists
+    for prof in profiles:
+        for conf in rnd.sample(confs, min(CONFERENCES_PER_ATTENDEE, len(confs))):
+            prof.conferenceKeysToAttend.append(conf.key.urlsafe())
+            conf.seatsAvailable -= 1
+        prof.sessionWishlist = rnd.sample(
+            data.sessions, min(SESSIONS_PER_WISHLIST, len(data.sessions)))
+        put(prof)
+    for conf in confs:
+        put(conf)
+    ndb.put_multi(entities)
+    return data
+
+
+def buildCalls(data, rnd):
+    """Return (method name, builder) pairs; builders return the
+    (user email, request) of one call."""
+    from protorpc import message_types
+    import conference as c
+    from forms import ConferenceForm
+    from forms import ConferenceQueryForm
+    from forms import ConferenceQueryForms
+    from forms import ProfileMiniForm
+    from forms import QueryForm
+    from forms import QueryForms
+    from forms import SpeakerForm
+
+    void = message_types.VoidMessage
+
+    def conf():
+        return rnd.choice(data.conferences)
+
+    def owned():
+        wsck = conf()
+        return data.organizers[wsck], wsck
+
+    def user():
+        return rnd.choice(data.emails)
+
+    def confGet(container, **fields):
+        return lambda: (user(), container.combined_message_class(
+            websafeConferenceKey=conf(), **fields))
+
+    def updateConference():
+        email, wsck = owned()
+        return email, c.CONF_POST_REQUEST.combined_message_class(
+            websafeConferenceKey=wsck, city=rnd.choice(CITIES))
+
+    def createSession():
+        email, wsck = owned()
+        return email, c.SESSION_POST_REQUEST.combined_message_class(
+            websafeConferenceKey=wsck, name='Benchmark session',
+            speaker=[rnd.choice(data.speakers)], typeOfSession='lecture',
+            date='2016-06-01', start='10:00', duration='01:00')
+
+    def deleteConference():
+        email, wsck = owned()
+        return email, c.CONF_GET_REQUEST.combined_message_class(
+            websafeConferenceKey=wsck)
+
+    return [
+        ('getConference', confGet(c.CONF_CONDITIONAL_GET_REQUEST)),
+        ('getConferenceSessions', confGet(c.CONF_CONDITIONAL_GET_REQUEST)),
+        ('getConferencesCreated', lambda: (user(), void())),
+        ('queryConferences', lambda: (None, ConferenceQueryForms(filters=[
+            ConferenceQueryForm(field='CITY', operator='EQ', value=rnd.choice(CITIES))]))),
+        ('getSessionsBySpeaker', lambda: (None, c.SPEAKER_GET_BY_NAME_REQUEST
+            .combined_message_class(speaker=rnd.choice(data.speakers)))),
+        ('getConferenceSessionsByType', confGet(c.SESSION_GET_BY_TYPE_REQUEST,
+            typeOfSession=rnd.choice(SESSION_TYPES))),
+        ('getConferenceSessionsByCompany', confGet(c.SESSION_GET_BY_COMPANY_REQUEST,
+            company=rnd.choice(COMPANIES))),
+        ('getConferenceSessionsBySpeakerSpecialty', confGet(
+            c.SESSION_GET_BY_SPECIALTY_REQUEST, specialty=rnd.choice(SPECIALTIES))),
+        ('getSessionByKey', lambda: (None, c.SESSION_KEY.combined_message_class(
+            websafeSessionKey=rnd.choice(data.sessions)))),
+        ('getSessionsInWishlist', lambda: (user(), void())),
+        ('querySessions', lambda: (None, QueryForms(filters=[
+            QueryForm(field='typeOfSession', operator='NE', value='workshop'),
+            QueryForm(field='start', operator='LT', value='19:00')]))),
+        ('querySpeaker', lambda: (None, QueryForms(filters=[
+            QueryForm(field='company', operator='EQ', value=rnd.choice(COMPANIES))]))),
+        ('getFeaturedSpeaker', confGet(c.CONF_GET_REQUEST)),
+        ('suggest', lambda: (None, c.SUGGEST_GET_REQUEST.combined_message_class(
+            kind=rnd.choice(['conference', 'session', 'speaker']),
+            prefix=rnd.choice(['s', 'se', 'ses', 'speaker 1', 'conference 1'])))),
+        ('searchSessions', lambda: (None, c.SESSION_SEARCH_REQUEST.combined_message_class(
+            query=rnd.choice(['session', 'highlights', 'conference description'])))),
+        ('getConferencesInRange', lambda: (None, c.CONF_RANGE_GET_REQUEST.combined_message_class(
+            startDate='2016-%02d-01' % rnd.randint(1, 12), city=rnd.choice([None] + CITIES)))),
+        ('getConferenceFacets', lambda: (None, void())),
+        ('getChangesSince', lambda: (None, c.CHANGES_GET_REQUEST.combined_message_class())),
+        ('getProfile', lambda: (user(), void())),
+        ('getAnnouncement', lambda: (None, c.ANNOUNCEMENT_GET_REQUEST.combined_message_class())),
+        ('getConferencesToAttend', lambda: (user(), void())),
+        ('filterPlayground', lambda: (None, void())),
+        ('saveProfile', lambda: (user(), ProfileMiniForm(displayName='Renamed'))),
+        ('createConference', lambda: (user(), ConferenceForm(
+            name='Benchmark conference', city=rnd.choice(CITIES),
+            startDate='2016-05-01', endDate='2016-05-03', maxAttendees=100))),
+        ('updateConference', updateConference),
+        ('createSpeaker', lambda: (user(), SpeakerForm(
+            name='Benchmark speaker', company=rnd.choice(COMPANIES)))),
+        ('createSession', createSession),
+        ('addSessionToWishlist', lambda: (user(), c.SESSION_KEY.combined_message_class(
+            websafeSessionKey=rnd.choice(data.sessions)))),
+        ('getMyAgenda', lambda: (user(), void())),
+        ('getRecommendedSessions', lambda: (user(), c.RECOMMENDATIONS_GET_REQUEST.combined_message_class())),
+        ('registerForConference', confGet(c.CONF_GET_REQUEST)),
+        ('unregisterFromConference', confGet(c.CONF_GET_REQUEST)),
+        ('getTrendingConferences', lambda: (None, c.TRENDING_GET_REQUEST.combined_message_class(
+            window=rnd.choice(['hour', 'day'])))),
+        ('getWaitlistPosition', confGet(c.CONF_GET_REQUEST)),
+        ('getConferenceDeletion', confGet(c.CONF_GET_REQUEST)),
+        ('deleteConference', deleteConference),
+    ]
+
+
+def percentile(values, p):
+    """Return the p-th percentile (0-100) of values."""
+    values = sorted(values)
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+
+def runCall(api, name, email, request):
+    """Call one API method as the given user; return (seconds, stats, error)."""
+    from google.appengine.ext import ndb
+    import rpcstats
+
+    if email:
+        os.environ['ENDPOINTS_AUTH_EMAIL'] = email
+        os.environ['ENDPOINTS_AUTH_DOMAIN'] = 'example.com'
+    else:
+        os.environ.pop('ENDPOINTS_AUTH_EMAIL', None)
+        os.environ.pop('ENDPOINTS_AUTH_DOMAIN', None)
+    # every call is a new request: nothing left in the ndb in-context cache
+    ndb.get_context().clear_cache()
+    error = None
+    with rpcstats.recording(rpcstats.RpcTrace()) as stats:
+        started = time.time()
+        try:
+            getattr(api, name)(request)
+        except Exception, e:
+            error = '%s: %s' % (type(e).__name__, e)
+        seconds = time.time() - started
+    return seconds, stats, error
+
+
+def benchmark(data, repeat, seed):
+    """Call every API method repeat times; return the per method results."""
+    from conference import ConferenceApi
+    import rpcstats
+
+    rnd = random.Random(seed)
+    api = ConferenceApi()
+    calls = buildCalls(data, rnd)
+    missing = set(ConferenceApi.all_remote_methods()) - set(n for n, b in calls)
+    if missing:
+        sys.stderr.write('Not benchmarked: %s\n' % ', '.join(sorted(missing)))
+
+    results = []
+    for name, build in calls:
+        times = []
+        total = rpcstats.RpcStats()
+        errors = []
+        findings = set()
+        for i in range(repeat):
+            email, request = build()
+            seconds, stats, error = runCall(api, name, email, request)
+            times.append(seconds * 1000)
+            total.add(stats)
+            findings.update(stats.findings())
+            if error:
+                errors.append(error)
+        result = {
+            'method': name,
+            'calls': repeat,
+            'errors': len(errors),
+            'wallMs': {
+                'mean': sum(times) / len(times),
+                'p50': percentile(times, 50),
+                'p95': percentile(times, 95),
+                'max': max(times),
+                # first call of the method in this process
+                'first': times[0],
+            },
+            'memcacheHitRate': total.memcacheHitRate(),
+            'findings': sorted(findings),
+        }
+        # per call averages of the API call counters
+        for field, value in total.toDict().items():
+            result[field] = float(value) / repeat
+        if errors:
+            result['firstError'] = errors[0]
+        results.append(result)
+    return results
+
+
+def measureStartup(sdk, runs=3):
+    """Return the median time (ms) a fresh interpreter takes to import
+    each script module."""
+    path = [sdk, ROOT] if sdk else [ROOT]
+    startup = {}
+    for module in STARTUP_MODULES:
+        times = []
+        for i in range(runs):
+            try:
+                out = subprocess.check_output(
+                    [sys.executable, '-c', STARTUP_CODE % {'path': path, 'module': module}],
+                    cwd=ROOT)
+                times.append(float(out))
+            except (OSError, ValueError, subprocess.CalledProcessError), e:
+                sys.stderr.write('Could not time the import of %s: %s\n' % (module, e))
+        startup[module] = percentile(times, 50)
+    return startup
+
+
+def currentCommit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Benchmark the ConferenceApi methods.')
+    parser.add_argument('--sdk', default=os.environ.get('APPENGINE_SDK'),
+                        help='App Engine SDK directory (default: $APPENGINE_SDK)')
+    parser.add_argument('--scale', type=int, default=1000,
+                        help='number of profiles (default: 1000)')
+    parser.add_argument('--repeat', type=int, default=20,
+                        help='calls per method (default: 20)')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='write the JSON results here instead of stdout')
+    args = parser.parse_args(argv)
+
+    setupSdk(args.sdk)
+    tb = setupTestbed()
+    try:
+        started = time.time()
+        data = generate(args.scale, args.seed)
+        generated = time.time() - started
+        report = {
+            'commit': currentCommit(),
+            'scale': args.scale,
+            'seed': args.seed,
+            'repeat': args.repeat,
+            'generateSeconds': generated,
+            'results': benchmark(data, args.repeat, args.seed),
+            'importMs': measureStartup(args.sdk),
+        }
+    finally:
+        tb.deactivate()
+
+    out = open(args.output, 'w') if args.output else sys.stdout
+    json.dump(report, out, indent=2, sort_keys=True)
+    out.write('\n')
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+
+"""bulk.py
+
+Bulk export and import of conferences as JSONL, one entity per line:
+the Conference, its Sessions, then the Speakers they reference. Both
+directions walk the data in fixed size batches, so memory stays bounded
+whatever the size of the conference. Registrations are not carried over:
+imported conferences start with no attendees (all their seats free) and
+an empty waitlist.
+
+Run it against a deployed app (or dev_appserver) through remote_api:
+
+    python bulk.py export --server ud-calixto.appspot.com \
+        --conference <websafeConferenceKey> > conference.jsonl
+    python bulk.py import --server localhost:8080 < conference.jsonl
+
+"""
+
+import argparse
+from datetime import date
+from datetime import datetime
+from datetime import time
+import json
+import sys
+
+from google.appengine.ext import ndb
+
+from caching import bumpMonthVersions
+from facets import enqueueFacetChange
+from facets import facetValues
+from fulltext import enqueueIndexing
+from models import Conference
+from models import Profile
+from models import Session
+from models import Speaker
+from speakerdirectory import bumpSpeakerGeneration
+
+BATCH_SIZE = 500
+KINDS = {'Conference': Conference, 'Session': Session, 'Speaker': Speaker}
+# properties not carried over: maintained by the datastore on put, or
+# counting entities that are not exported (the waitlist)
+SKIPPED_PROPERTIES = ('updatedAt', 'namePrefixes', 'waitlisted')
+
+
+def _encode(value):
+    """Convert a property value to its JSON representation."""
+    if isinstance(value, list):
+        return [_encode(v) for v in value]
+    if isinstance(value, (date, time, datetime)):
+        return value.isoformat()
+    return value
+
+
+def _decode(prop, value):
+    """Convert the JSON representation of a property value back."""
+    if value is None:
+        return None
+    if prop._repeated:
+        return [_decodeOne(prop, v) for v in value]
+    return _decodeOne(prop, value)
+
+
+def _decodeOne(prop, value):
+    # Date and TimeProperty subclass DateTimeProperty: test them first
+    if isinstance(prop, ndb.DateProperty):
+        return datetime.strptime(value[:10], "%Y-%m-%d").date()
+    if isinstance(prop, ndb.TimeProperty):
+        return datetime.strptime(value[:8], "%H:%M:%S").time()
+    if isinstance(prop, ndb.DateTimeProperty):
+        return datetime.strptime(value[:19], "%Y-%m-%dT%H:%M:%S")
+    return value
+
+
+def entityToLine(entity):
+    """Serialise an entity as one JSONL line."""
+    data = {}
+    for name in entity._properties:
+        if name not in SKIPPED_PROPERTIES:
+            data[name] = _encode(getattr(entity, name))
+    return json.dumps({
+        'kind': entity._get_kind(),
+        'key': entity.key.pairs(),
+        'data': data,
+    }) + '\n'
+
+
+def recordToEntity(record, key):
+    """Build the entity of a parsed JSONL line, with the given key."""
+    cls = KINDS[record['kind']]
+    values = {}
+    for name, value in record['data'].items():
+        prop = cls._properties.get(name)
+        if prop is not None:
+            values[name] = _decode(prop, value)
+    return cls(key=key, **values)
+
+
+def exportConference(conf_key):
+    """Yield the JSONL lines of a conference, its sessions and speakers."""
+    conf = conf_key.get()
+    if not conf:
+        raise LookupError('No conference found with key: %s' % conf_key.urlsafe())
+    yield entityToLine(conf)
+
+    speakers = set()
+    cursor, more = None, True
+    while more:
+        sessions, cursor, more = Session.query(ancestor=conf_key).fetch_page(
+            BATCH_SIZE, start_cursor=cursor)
+        for sess in sessions:
+            speakers.update(sess.speaker)
+            yield entityToLine(sess)
+
+    # speakers are referenced by name; IN queries take 30 values at most
+    names = sorted(speakers)
+    for i in range(0, len(names), 30):
+        for speaker in Speaker.query(Speaker.name.IN(names[i:i + 30])):
+            yield entityToLine(speaker)
+
+
+def importConferences(lines, organizerUserId=None):
+    """Import exported conferences from an iterable of JSONL lines;
+    return the number of entities written.
+    Every entity gets a newly allocated id (sessions are moved under their
+    new conference), so importing never overwrites existing data. Speakers
+    whose name already exists are skipped. Conferences stay under their
+    exported organizer unless organizerUserId is given."""
+    conferences = {}    # exported Conference key pairs -> new key
+    batch = []
+    written = 0
+    for line in lines:
+        if not line.strip():
+            continue
+        record = json.loads(line)
+        batch.append(record)
+        if record['kind'] == 'Conference' or len(batch) >= BATCH_SIZE:
+            # sessions need the new key of their conference: flush
+            # the conference on its own before reading its sessions
+            written += _importBatch(batch, conferences, organizerUserId)
+            batch = []
+    written += _importBatch(batch, conferences, organizerUserId)
+    return written
+
+
+def _importBatch(records, conferences, organizerUserId):
+    """Allocate ids for and put_multi one batch of exported records."""
+    entities = []
+    sessions = {}
+    speakers = []
+    for record in records:
+        if record['kind'] == 'Conference':
+            old = tuple(map(tuple, record['key']))
+            p_key = ndb.Key(Profile, organizerUserId) if organizerUserId \
+                else ndb.Key(pairs=old[:-1])
+            c_id = Conference.allocate_ids(size=1, parent=p_key)[0]
+            conferences[old] = ndb.Key(Conference, c_id, parent=p_key)
+            record['data']['organizerUserId'] = p_key.id()
+            # no attendees are imported: every seat is free
+            record['data']['seatsAvailable'] = record['data'].get('maxAttendees')
+            entities.append(recordToEntity(record, conferences[old]))
+        elif record['kind'] == 'Session':
+            parent = conferences[tuple(map(tuple, record['key'][:-1]))]
+            sessions.setdefault(parent, []).append(record)
+        else:
+            speakers.append(record)
+
+    # one id range per conference for its sessions
+    for parent, records in sessions.items():
+        first, last = Session.allocate_ids(size=len(records), parent=parent)
+        for s_id, record in zip(range(first, last + 1), records):
+            entities.append(recordToEntity(record, ndb.Key(Session, s_id, parent=parent)))
+
+    if speakers:
+        names = [record['data']['name'] for record in speakers]
+        existing = set()
+        for i in range(0, len(names), 30):
+            existing.update(s.name for s in
+                Speaker.query(Speaker.name.IN(names[i:i + 30])))
+        speakers = [r for r in speakers if r['data']['name'] not in existing]
+    if speakers:
+        first, last = Speaker.allocate_ids(size=len(speakers))
+        for s_id, record in zip(range(first, last + 1), speakers):
+            entities.append(recordToEntity(record, ndb.Key(Speaker, s_id)))
+
+    ndb.put_multi(entities)
+    enqueueIndexing([e.key for e in entities if isinstance(e, Session)])
+    if speakers:
+        bumpSpeakerGeneration([e.key for e in entities if isinstance(e, Speaker)])
+    for entity in entities:
+        if isinstance(entity, Conference):
+            enqueueFacetChange(entity.key, {}, facetValues(entity))
+            bumpMonthVersions(entity.startDate)
+    return len(entities)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Bulk export/import of conferences.')
+    parser.add_argument('command', choices=['export', 'import'])
+    parser.add_argument('--server', required=True,
+                        help='app host, e.g. localhost:8080')
+    parser.add_argument('--conference', help='websafe key of the conference to export')
+    parser.add_argument('--organizer', help='user id owning the imported conferences')
+    args = parser.parse_args(argv)
+
+    from google.appengine.ext.remote_api import remote_api_stub
+    remote_api_stub.ConfigureRemoteApiForOAuth(args.server, '/_ah/remote_api',
+        secure=not args.server.startswith('localhost'))
+
+    if args.command == 'export':
+        if not args.conference:
+            parser.error('--conference is required to export')
+        for line in exportConference(ndb.Key(urlsafe=args.conference)):
+            sys.stdout.write(line)
+    else:
+        written = importConferences(sys.stdin, args.organizer)
+        sys.stderr.write('Imported %d entities\n' % written)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+
+"""caching.py
+
+Memcache keys shared by the API and the background jobs, the version
+counters behind the API's ETags and the announcement cache.
+
+"""
+
+import time
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+from models import Conference
+
+MEMCACHE_ANNOUNCEMENTS_KEY = "RECENT_ANNOUNCEMENTS"
+MEMCACHE_ANNOUNCEMENTS_VERSION_KEY = "RECENT_ANNOUNCEMENTS_VERSION"
+MEMCACHE_FEATURED_SPEAKER_PRE_KEY = "FeaturedSpeaker|"
+MEMCACHE_CONFERENCE_VERSION_PRE_KEY = "ConferenceVersion|"
+MEMCACHE_SPEAKER_GENERATION_KEY = "SpeakerGeneration"
+MEMCACHE_SPEAKER_WRITES_PRE_KEY = "SpeakerWrites|"
+MEMCACHE_FACETS_KEY = "ConferenceFacets"
+MEMCACHE_MONTH_VERSION_PRE_KEY = "MonthVersion|"
+MEMCACHE_MONTH_PAGE_PRE_KEY = "MonthPage|"
+MEMCACHE_MONTH_BUMPED_PRE_KEY = "MonthBumped|"
+MEMCACHE_WAITLIST_VERSION_PRE_KEY = "WaitlistVersion|"
+MEMCACHE_WAITLIST_POSITION_PRE_KEY = "WaitlistPosition|"
+MEMCACHE_TRENDING_KEY = "TrendingConferences"
+MEMCACHE_AGENDA_PRE_KEY = "Agenda|"
+ANNOUNCEMENT_TPL = ('Last chance to attend! The following conferences '
+                    'are nearly sold out: %s')
+
+
+def _versionSeed():
+    """Starting value for a version counter missing from memcache.
+    Based on the clock, so a counter recreated after an eviction is always
+    ahead of any version handed out before and stale ETags never match."""
+    return int(time.time() * 1000)
+
+
+def getVersion(key):
+    """Return the current version (ETag) stored in memcache under key."""
+    version = memcache.get(key)
+    if version is None:
+        seed = _versionSeed()
+        memcache.add(key, seed)
+        # fall back to the fresh seed if memcache is unavailable, which
+        # simply makes the next conditional request miss
+        version = memcache.get(key) or seed
+    return str(version)
+
+
+def getVersions(keys):
+    """Return the current versions of keys, as getVersion, in a single
+    memcache round trip."""
+    versions = memcache.get_multi(keys)
+    missing = [key for key in keys if key not in versions]
+    seed = _versionSeed()
+    if missing:
+        memcache.add_multi(dict((key, seed) for key in missing))
+        versions.update(memcache.get_multi(missing))
+    return [str(versions.get(key) or seed) for key in keys]
+
+
+def bumpVersion(key):
+    """Invalidate every ETag handed out for key.
+    Inside a transaction the bump waits for the commit, so no reader can
+    pair the new version with the data from before the write."""
+    ndb.get_context().call_on_commit(lambda: incrementVersion(key))
+
+
+def incrementVersion(key):
+    """Bump the version of key right away; return the new version, or None
+    if memcache is unavailable."""
+    return memcache.incr(key, initial_value=_versionSeed())
+
+
+def conferenceVersionKey(websafeConferenceKey):
+    """Memcache key of the version counter of a Conference entity group."""
+    # normalise the urlsafe key so every spelling maps to the same counter
+    return MEMCACHE_CONFERENCE_VERSION_PRE_KEY + \
+        ndb.Key(urlsafe=websafeConferenceKey).urlsafe()
+
+
+def monthVersionKey(month):
+    """Memcache key of the version counter of the conferences starting in
+    month ('YYYY-MM')."""
+    return MEMCACHE_MONTH_VERSION_PRE_KEY + month
+
+
+def bumpMonthVersions(*dates):
+    """Invalidate the cached month pages holding conferences starting on
+    any of dates (None for no start date), and record when (see
+    monthBumpedAt)."""
+    months = set(d.strftime('%Y-%m') for d in dates if d)
+    for month in months:
+        bumpVersion(monthVersionKey(month))
+    if months:
+        ndb.get_context().call_on_commit(lambda: memcache.set_multi(
+            dict((month, time.time()) for month in months),
+            key_prefix=MEMCACHE_MONTH_BUMPED_PRE_KEY))
+
+
+def monthBumpedAt(month):
+    """Return when the version of month was last bumped; now if that is
+    no longer known."""
+    bumpedAt = memcache.get(MEMCACHE_MONTH_BUMPED_PRE_KEY + month)
+    if bumpedAt is None:
+        bumpedAt = time.time()
+        memcache.add(MEMCACHE_MONTH_BUMPED_PRE_KEY + month, bumpedAt)
+    return bumpedAt
+
+
+def waitlistVersionKey(websafeConferenceKey):
+    """Memcache key of the version counter of a conference's waitlist
+    positions."""
+    return MEMCACHE_WAITLIST_VERSION_PRE_KEY + websafeConferenceKey
+
+
+def cacheAnnouncement():
+    """Create Announcement & assign to memcache; used by the memcache cron
+    job and the warmup."""
+    confs = Conference.query(ndb.AND(
+        Conference.seatsAvailable <= 5,
+        Conference.seatsAvailable > 0)
+    ).fetch(projection=[Conference.name])
+
+    previous = memcache.get(MEMCACHE_ANNOUNCEMENTS_KEY) or ""
+    if confs:
+        # If there are almost sold out conferences,
+        # format announcement and set it in memcache
+        announcement = ANNOUNCEMENT_TPL % (
+            ', '.join(conf.name for conf in confs))
+        memcache.set(MEMCACHE_ANNOUNCEMENTS_KEY, announcement)
+    else:
+        # If there are no sold out conferences,
+        # delete the memcache announcements entry
+        announcement = ""
+        memcache.delete(MEMCACHE_ANNOUNCEMENTS_KEY)
+    # only invalidate the clients' etags if the text really changed
+    if announcement != previous:
+        bumpVersion(MEMCACHE_ANNOUNCEMENTS_VERSION_KEY)
+
+    return announcement
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+
+"""capture.py
+
+Opt-in capture of the API calls as JSONL, one call per line, for replay.py:
+
+    {"time": 1466092800.25, "method": "registerForConference",
+     "user": "u-3f2a9c1be07d", "request": {"websafeConferenceKey": "..."}}
+
+Set CAPTURE_CALLS in the environment (app.yaml env_variables) to turn it
+on. Lines are appended to CAPTURE_FILE when it is set (dev_appserver,
+testbed), otherwise logged with the CAPTURE_LOG_PREFIX, to be cut out of
+the downloaded request logs:
+
+    appcfg.py request_logs . logs.txt
+    grep -o '{"method.*' logs.txt > capture.jsonl
+
+Calls are sanitised: the user is replaced by a stable pseudonym (salted
+with CAPTURE_SALT) and the personal fields of the request are dropped.
+
+"""
+
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+import endpoints
+from protorpc import protojson
+
+CAPTURE_CALLS = bool(os.environ.get('CAPTURE_CALLS'))
+CAPTURE_FILE = os.environ.get('CAPTURE_FILE')
+CAPTURE_SALT = os.environ.get('CAPTURE_SALT', '')
+CAPTURE_LOG_PREFIX = 'ApiCapture '
+# request fields never captured
+REDACTED_FIELDS = ('displayName',)
+
+_lock = threading.Lock()
+
+
+def pseudonym(email):
+    """Return the stable pseudonym standing for a user."""
+    return 'u-' + hashlib.sha1(CAPTURE_SALT + email.lower()).hexdigest()[:12]
+
+
+def sanitise(request):
+    """Return the fields of a request message as a JSON-able dict."""
+    fields = json.loads(protojson.encode_message(request))
+    for name in REDACTED_FIELDS:
+        fields.pop(name, None)
+    return fields
+
+
+def captureCall(name, request):
+    """Record one call of an API method; never fails the call."""
+    try:
+        user = endpoints.get_current_user()
+        line = json.dumps({
+            'method': name,
+            'time': time.time(),
+            'user': pseudonym(user.email()) if user else None,
+            'request': sanitise(request),
+        }, sort_keys=True)
+        if CAPTURE_FILE:
+            with _lock:
+                with open(CAPTURE_FILE, 'a') as f:
+                    f.write(line + '\n')
+        else:
+            logging.info(CAPTURE_LOG_PREFIX + line)
+    except Exception, e:
+        logging.warning('Could not capture %s: %s' % (name, e))
+
+
+def readCapture(lines):
+    """Return the captured calls of JSONL lines (or log lines), in time order."""
+    calls = []
+    for line in lines:
+        start = line.find('{"method"')
+        if start < 0:
+            continue
+        calls.append(json.loads(line[start:]))
+    calls.sort(key=lambda call: call['time'])
+    return calls
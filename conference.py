@@ -13,41 +13,66 @@ created by wesc on 2014 apr 21
 __author__ = 'wesc+api@google.com (Wesley Chun)'
 
 
+import base64
+from datetime import date
 from datetime import datetime
+from datetime import timedelta
+import hashlib
+import json
 
 import endpoints
 from protorpc import messages
 from protorpc import message_types
+from protorpc import protojson
 from protorpc import remote
 
 from google.appengine.api import memcache
 from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
 from google.appengine.ext import ndb
 
 import logging  # loggins de erro
 
-from models import ConflictException
 from models import Profile
-from models import ProfileMiniForm
-from models import ProfileForm
-from models import StringMessage
-from models import BooleanMessage
-from models import QueryForm
-from models import QueryForms
 from models import Conference
-from models import ConferenceForm
-from models import ConferenceForms
-from models import ConferenceQueryForm
-from models import ConferenceQueryForms
-from models import TeeShirtSize
 from models import Session
-from models import SessionForm
-from models import SessionForms
-from models import SessionQueryForm
-from models import SessionQueryForms
 from models import Speaker
-from models import SpeakerForm
-from models import SpeakerForms
+from models import Tombstone
+from models import DeletionJob
+from forms import ConflictException
+from forms import ProfileMiniForm
+from forms import ProfileForm
+from forms import StringMessage
+from forms import BooleanMessage
+from forms import QueryForm
+from forms import QueryForms
+from forms import QueryExplainForm
+from forms import ConferenceForm
+from forms import ConferenceForms
+from forms import ConferenceRangeForms
+from forms import WaitlistPositionForm
+from forms import TrendingConferenceForm
+from forms import TrendingConferenceForms
+from forms import ConferenceQueryForm
+from forms import ConferenceQueryForms
+from forms import TeeShirtSize
+from forms import SessionForm
+from forms import SessionForms
+from forms import SessionQueryForm
+from forms import AgendaConflictForm
+from forms import AgendaDayForm
+from forms import AgendaForm
+from forms import SessionQueryForms
+from forms import SpeakerForm
+from forms import SpeakerForms
+from forms import DeletionJobForm
+from forms import ChangeForm
+from forms import ChangeForms
+from forms import SuggestionForm
+from forms import SuggestionForms
+from forms import SessionSearchForms
+from forms import ConferenceFacetsForm
+from forms import FacetCountForm
 
 from settings import WEB_CLIENT_ID
 from settings import ANDROID_CLIENT_ID
@@ -56,12 +81,64 @@ from settings import ANDROID_AUDIENCE
 
 from utils import getUserId
 
+from apistats import instrumented
+
+from caching import MEMCACHE_ANNOUNCEMENTS_KEY
+from caching import MEMCACHE_ANNOUNCEMENTS_VERSION_KEY
+from caching import MEMCACHE_FEATURED_SPEAKER_PRE_KEY
+from caching import getVersion
+from caching import bumpVersion
+from caching import conferenceVersionKey
+from caching import bumpMonthVersions
+from caching import cacheAnnouncement
+
+from emails import enqueueEmail
+from notifications import startAttendeeNotification
+from deletion import startConferenceDeletion
+
+from indexes import describeIndex
+from indexes import findIndex
+from indexes import mergeJoinIndexes
+from indexes import projectionFor
+from indexes import requiredIndex
+from rpcstats import recording
+from indexadvisor import recordQueryShape
+from autocomplete import suggestNames
+from fulltext import enqueueIndexing
+from fulltext import search as searchIndex
+from speakerdirectory import bumpSpeakerGeneration
+from speakerdirectory import speakerDirectory
+from facets import FACET_FIELDS
+from facets import conferenceFacets
+from facets import enqueueFacetChange
+from facets import facetValues
+from monthpages import MAX_MONTH_PAGES
+from monthpages import MONTH_PAGE_SIZE
+from monthpages import inRange
+from monthpages import monthBounds
+from monthpages import monthOf
+from waitlist import enqueuePromotion
+from waitlist import joinWaitlist
+from waitlist import leaveWaitlist
+from waitlist import waitlistPosition
+from trending import TOP_K
+from trending import WINDOWS
+from trending import recordRegistration
+from trending import trendingConferences
+from recommendations import recommendSessions
+from agenda import agendaDays
+from agenda import cachedAgenda
+from agenda import formatMinutes
+
 EMAIL_SCOPE = endpoints.EMAIL_SCOPE
 API_EXPLORER_CLIENT_ID = endpoints.API_EXPLORER_CLIENT_ID
-MEMCACHE_ANNOUNCEMENTS_KEY = "RECENT_ANNOUNCEMENTS"
-MEMCACHE_FEATURED_SPEAKER_PRE_KEY = "FeaturedSpeaker|"
-ANNOUNCEMENT_TPL = ('Last chance to attend! The following conferences '
-                    'are nearly sold out: %s')
+# Kinds walked by the change feed, in this order
+CHANGE_FEED_KINDS = (Conference, Session, Speaker, Tombstone)
+CHANGE_FEED_PAGE_SIZE = 100
+# Changes younger than this are left for the next pass, so writes that are
+# not yet visible to the (eventually consistent) feed queries aren't skipped
+CHANGE_FEED_SETTLE_SECONDS = 30
+EPOCH = datetime(1970, 1, 1)
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 
 INEQUALITY_FILTERS = []
@@ -73,6 +150,11 @@ DEFAULTS = {
     "topics": [ "Default", "Topic" ],
 }
 
+# range of getConferencesInRange without an endDate
+DEFAULT_RANGE_DAYS = 30
+DEFAULT_RANGE_RESULTS = 20
+MAX_RANGE_DAYS = 366
+
 DEFAULT_SPEAKER = {
     "name": "Default Name",
     "biography": "Default bio",
@@ -96,11 +178,59 @@ FIELDS =    {
             'MAX_ATTENDEES': 'maxAttendees',
             }
 
+# Form fields that aren't read from an entity property of the same name
+# (None: not read from any property)
+FIELD_PROPERTIES = {
+            'websafeKey': None,
+            'etag': None,
+            'notModified': None,
+            'organizerDisplayName': 'organizerUserId',
+            }
+
 CONF_GET_REQUEST = endpoints.ResourceContainer(
     message_types.VoidMessage,
     websafeConferenceKey=messages.StringField(1),
 )
 
+CONF_CONDITIONAL_GET_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    websafeConferenceKey=messages.StringField(1),
+    ifNoneMatch=messages.StringField(2),
+    fields=messages.StringField(3, repeated=True),
+)
+
+CONF_RANGE_GET_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    startDate=messages.StringField(1),
+    endDate=messages.StringField(2),
+    city=messages.StringField(3),
+    topic=messages.StringField(4),
+    cursor=messages.StringField(5),
+    limit=messages.IntegerField(6),
+)
+
+TRENDING_GET_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    window=messages.StringField(1),
+    limit=messages.IntegerField(2),
+)
+
+RECOMMENDATIONS_GET_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    limit=messages.IntegerField(1),
+)
+
+CHANGES_GET_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    cursor=messages.StringField(1),
+    limit=messages.IntegerField(2),
+)
+
+ANNOUNCEMENT_GET_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    ifNoneMatch=messages.StringField(1),
+)
+
 CONF_POST_REQUEST = endpoints.ResourceContainer(
     ConferenceForm,
     websafeConferenceKey=messages.StringField(1),
@@ -143,6 +273,23 @@ SPEAKER_POST_REQUEST = endpoints.ResourceContainer(
     SpeakerForm,
 )
 
+SUGGEST_GET_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    kind=messages.StringField(1),
+    prefix=messages.StringField(2),
+    limit=messages.IntegerField(3, variant=messages.Variant.INT32),
+)
+
+SESSION_SEARCH_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    query=messages.StringField(1),
+    cursor=messages.StringField(2),
+    limit=messages.IntegerField(3, variant=messages.Variant.INT32),
+)
+
+# Kinds whose names the suggest endpoint completes
+SUGGEST_KINDS = {'conference': Conference, 'session': Session, 'speaker': Speaker}
+
 # - - - - - SuportFunctions - - - - - - - - - - - - - - - - -
 
 
@@ -199,6 +346,17 @@ def validadeInequalityFilter(inequality_filters, entity):
             check = False
     return check
 
+
+def toMicros(dt):
+    """Convert a naive UTC datetime to microseconds since the epoch."""
+    td = dt - EPOCH
+    return (td.days * 86400 + td.seconds) * 10**6 + td.microseconds
+
+
+def fromMicros(micros):
+    """Convert microseconds since the epoch to a naive UTC datetime."""
+    return EPOCH + timedelta(microseconds=micros)
+
 # - - - - API - - - - - - - - - - - - - - - - - - - - - - - -
 
 
@@ -210,14 +368,51 @@ class ConferenceApi(remote.Service):
 
 # - - - Conference objects - - - - - - - - - - - - - - - - -
 
-    def _copyConferenceToForm(self, conf, displayName):
-        """Copy relevant fields from Conference to ConferenceForm."""
+    def _selectedFields(self, formCls, fields):
+        """Validate a fields selector against formCls; None selects all fields."""
+        if not fields:
+            return None
+        valid = set(field.name for field in formCls.all_fields())
+        invalid = [f for f in fields if f not in valid]
+        if invalid:
+            raise endpoints.BadRequestException(
+                "Invalid fields: %s" % ', '.join(invalid))
+        return set(fields)
+
+
+    def _fieldsEtag(self, version, fields):
+        """Return the etag of a response holding the selected fields (from
+        _selectedFields) of data at version."""
+        if not fields:
+            return version
+        return '%s-%s' % (version, hashlib.md5(','.join(sorted(fields))).hexdigest()[:8])
+
+
+    def _propertiesFor(self, fields):
+        """Return the entity properties needed to fill the selected fields."""
+        props = set()
+        for field in fields:
+            prop = FIELD_PROPERTIES.get(field, field)
+            if prop:
+                props.add(prop)
+        return props
+
+
+    def _copyConferenceToForm(self, conf, displayName, fields=None):
+        """Copy relevant fields from Conference to ConferenceForm,
+        only the selected ones if fields is given."""
         cf = ConferenceForm()
         for field in cf.all_fields():
+            if fields is not None and field.name not in fields:
+                continue
             if hasattr(conf, field.name):
                 # convert Date to date string; just copy others
                 if field.name.endswith('Date'):
                     setattr(cf, field.name, str(getattr(conf, field.name)))
+                elif field.name == 'seatsAvailable' and conf.seatsAvailable is not None:
+                    # below zero after the capacity was cut under the
+                    # registrations: none to offer
+                    setattr(cf, field.name, max(0, conf.seatsAvailable))
                 else:
                     setattr(cf, field.name, getattr(conf, field.name))
             elif field.name == "websafeKey":
@@ -243,6 +438,8 @@ class ConferenceApi(remote.Service):
         data = {field.name: getattr(request, field.name) for field in request.all_fields()}
         del data['websafeKey']
         del data['organizerDisplayName']
+        del data['etag']
+        del data['notModified']
 
         # add default values for those missing (both data model & outbound Message)
         for df in DEFAULTS:
@@ -270,13 +467,14 @@ class ConferenceApi(remote.Service):
         data['key'] = c_key
         data['organizerUserId'] = request.organizerUserId = user_id
 
-        # create Conference, send email to organizer confirming
+        # create Conference, queue email to organizer confirming
         # creation of Conference & return (modified) ConferenceForm
-        Conference(**data).put()
-        taskqueue.add(params={'email': user.email(),
-            'conferenceInfo': repr(request)},
-            url='/tasks/send_confirmation_email'
-        )
+        conf = Conference(**data)
+        conf.put()
+        bumpVersion(conferenceVersionKey(c_key.urlsafe()))
+        bumpMonthVersions(conf.startDate)
+        enqueueFacetChange(c_key, {}, facetValues(conf))
+        enqueueEmail('conference_created', user.email(), c_key.urlsafe())
         return request
 
 
@@ -302,9 +500,18 @@ class ConferenceApi(remote.Service):
             raise endpoints.ForbiddenException(
                 'Only the owner can update the conference.')
 
+        # remember what attendees must be told about if it changes
+        notified = (conf.startDate, conf.endDate, conf.city)
+        description = conf.description
+        facets = facetValues(conf)
+        started = conf.startDate
+        capacity = conf.maxAttendees or 0
+
         # Not getting all the fields, so don't create a new object; just
         # copy relevant fields from ConferenceForm to Conference object
         for field in request.all_fields():
+            if field.name in ('etag', 'notModified'):
+                continue
             data = getattr(request, field.name)
             # only copy fields where we get data
             if data not in (None, []):
@@ -315,13 +522,31 @@ class ConferenceApi(remote.Service):
                         conf.month = data.month
                 # write to Conference object
                 setattr(conf, field.name, data)
+        if (conf.maxAttendees or 0) != capacity:
+            # the seats follow the capacity, going below zero when it is
+            # cut under the registrations so that raising it back doesn't
+            # overbook; new ones go to the waitlist
+            conf.seatsAvailable = (conf.seatsAvailable or 0) + \
+                (conf.maxAttendees or 0) - capacity
+            if conf.seatsAvailable > 0 and conf.waitlisted:
+                enqueuePromotion(conf.key)
         conf.put()
+        bumpVersion(conferenceVersionKey(request.websafeConferenceKey))
+        bumpMonthVersions(started, conf.startDate)
+        if (conf.startDate, conf.endDate, conf.city) != notified:
+            startAttendeeNotification(conf.key, 'conference_updated')
+        if conf.description != description:
+            # the description is part of its sessions' search documents
+            enqueueIndexing(conference_key=conf.key)
+        # queued when the transaction commits
+        enqueueFacetChange(conf.key, facets, facetValues(conf))
         prof = ndb.Key(Profile, user_id).get()
         return self._copyConferenceToForm(conf, getattr(prof, 'displayName'))
 
 
     @endpoints.method(ConferenceForm, ConferenceForm, path='conference',
             http_method='POST', name='createConference')
+    @instrumented
     def createConference(self, request):
         """Create new conference."""
         return self._createConferenceObject(request)
@@ -330,16 +555,77 @@ class ConferenceApi(remote.Service):
     @endpoints.method(CONF_POST_REQUEST, ConferenceForm,
             path='conference/{websafeConferenceKey}',
             http_method='PUT', name='updateConference')
+    @instrumented
     def updateConference(self, request):
         """Update conference w/provided fields & return w/updated info."""
         return self._updateConferenceObject(request)
 
 
-    @endpoints.method(CONF_GET_REQUEST, ConferenceForm,
+    def _copyDeletionJobToForm(self, job):
+        """Copy relevant fields from DeletionJob to DeletionJobForm."""
+        return DeletionJobForm(
+            websafeConferenceKey=job.key.id(),
+            phase=job.phase,
+            attendeesUpdated=job.attendeesUpdated,
+            wishlistsUpdated=job.wishlistsUpdated,
+            entitiesDeleted=job.entitiesDeleted,
+            done=job.phase == 'done',
+        )
+
+
+    @endpoints.method(CONF_GET_REQUEST, DeletionJobForm,
+            path='conference/{websafeConferenceKey}/delete',
+            http_method='POST', name='deleteConference')
+    @instrumented
+    def deleteConference(self, request):
+        """Delete conference with its sessions and the references to them.
+        Runs in the background; poll getConferenceDeletion for progress."""
+        user = endpoints.get_current_user()
+        if not user:
+            raise endpoints.UnauthorizedException('Authorization required')
+        user_id = getUserId(user)
+
+        conf = ndb.Key(urlsafe=request.websafeConferenceKey).get()
+        if not conf:
+            raise endpoints.NotFoundException(
+                'No conference found with key: %s' % request.websafeConferenceKey)
+        if user_id != conf.organizerUserId:
+            raise endpoints.ForbiddenException(
+                'Only the owner can delete the conference.')
+        return self._copyDeletionJobToForm(
+            startConferenceDeletion(conf.key, conf.organizerUserId))
+
+
+    @endpoints.method(CONF_GET_REQUEST, DeletionJobForm,
+            path='conference/{websafeConferenceKey}/delete',
+            http_method='GET', name='getConferenceDeletion')
+    @instrumented
+    def getConferenceDeletion(self, request):
+        """Return the progress of a conference deletion."""
+        wsck = ndb.Key(urlsafe=request.websafeConferenceKey).urlsafe()
+        job = ndb.Key(DeletionJob, wsck).get()
+        if not job:
+            raise endpoints.NotFoundException(
+                'No deletion found for conference: %s' % request.websafeConferenceKey)
+        return self._copyDeletionJobToForm(job)
+
+
+    @endpoints.method(CONF_CONDITIONAL_GET_REQUEST, ConferenceForm,
             path='conference/{websafeConferenceKey}',
             http_method='GET', name='getConference')
+    @instrumented
     def getConference(self, request):
-        """Return requested conference (by websafeConferenceKey)."""
+        """Return requested conference (by websafeConferenceKey).
+        Answer with notModified, without touching the datastore, when
+        ifNoneMatch still matches the current etag of the conference and the
+        selected fields."""
+        fields = self._selectedFields(ConferenceForm, request.fields)
+        # read the version before the entities, so a concurrent write can
+        # only make the returned etag older than the data, never newer
+        etag = self._fieldsEtag(
+            getVersion(conferenceVersionKey(request.websafeConferenceKey)), fields)
+        if request.ifNoneMatch == etag:
+            return ConferenceForm(etag=etag, notModified=True)
         # get Conference object from request; bail if not found
         conf = ndb.Key(urlsafe=request.websafeConferenceKey).get()
         if not conf:
@@ -347,12 +633,71 @@ class ConferenceApi(remote.Service):
                 'No conference found with key: %s' % request.websafeConferenceKey)
         prof = conf.key.parent().get()
         # return ConferenceForm
-        return self._copyConferenceToForm(conf, getattr(prof, 'displayName'))
+        cf = self._copyConferenceToForm(conf, getattr(prof, 'displayName'), fields)
+        cf.etag = etag
+        return cf
+
+
+    def _renderMonthPage(self, conferences):
+        """Return the cached form of a month page: (startDate, city, topics,
+        encoded ConferenceForm) per conference."""
+        profiles = ndb.get_multi([conf.key.parent() for conf in conferences])
+        return [(str(conf.startDate), conf.city, conf.topics,
+                 protojson.encode_message(self._copyConferenceToForm(
+                     conf, getattr(prof, 'displayName', None))))
+                for conf, prof in zip(conferences, profiles)]
+
+    @endpoints.method(CONF_RANGE_GET_REQUEST, ConferenceRangeForms,
+            path='getConferencesInRange',
+            http_method='GET', name='getConferencesInRange')
+    @instrumented
+    def getConferencesInRange(self, request):
+        """Return the conferences starting from startDate (default today) to
+        endDate (default 30 days later), both included, by start date; only
+        those in city and about topic if given, at most MAX_RANGE_DAYS apart.
+        Pass the returned cursor to get the next page; a page can hold fewer
+        than limit conferences, even none, and still have a cursor. Served
+        from the cached month pages."""
+        try:
+            first = datetime.strptime(request.startDate[:10], "%Y-%m-%d").date() \
+                if request.startDate else date.today()
+            last = datetime.strptime(request.endDate[:10], "%Y-%m-%d").date() \
+                if request.endDate else first + timedelta(days=DEFAULT_RANGE_DAYS)
+            position = None
+            if request.cursor:
+                month, index = request.cursor.split(':')
+                position = (monthOf(monthBounds(month)[0]), int(index))
+        except ValueError:
+            raise endpoints.BadRequestException('Invalid date or cursor.')
+        if last < first:
+            raise endpoints.BadRequestException('endDate is before startDate.')
+        if (last - first).days > MAX_RANGE_DAYS:
+            raise endpoints.BadRequestException(
+                'startDate and endDate are more than %d days apart.' % MAX_RANGE_DAYS)
+        if position and not (monthOf(first) <= position[0] <= monthOf(last) and
+                             0 <= position[1] < MAX_MONTH_PAGES * MONTH_PAGE_SIZE):
+            raise endpoints.BadRequestException('Invalid date or cursor.')
+        if request.limit is not None and request.limit <= 0:
+            raise endpoints.BadRequestException('limit must be positive.')
+
+        def matches(entry):
+            startDate, city, topics, encoded = entry
+            return str(first) <= startDate <= str(last) and \
+                (not request.city or city == request.city) and \
+                (not request.topic or request.topic in topics)
+
+        limit = min(request.limit or DEFAULT_RANGE_RESULTS, MONTH_PAGE_SIZE)
+        entries, position = inRange(first, last, matches, self._renderMonthPage,
+                                    position, limit)
+        return ConferenceRangeForms(
+            items=[protojson.decode_message(ConferenceForm, e[3]) for e in entries],
+            cursor='%s:%d' % position if position else None)
 
 
     @endpoints.method(message_types.VoidMessage, ConferenceForms,
             path='getConferencesCreated',
             http_method='POST', name='getConferencesCreated')
+    @instrumented
     def getConferencesCreated(self, request):
         """Return conferences created by user."""
         # make sure user is authed
@@ -373,6 +718,7 @@ class ConferenceApi(remote.Service):
         """Maps async to the inputed callback the generic query result."""
         q = cls.query()  # Get the cls(ndb.Model) object
         inequality_filters, filters = self._formatGenericFilters(request.filters, cls)
+        recordQueryShape(cls._get_kind(), [f["field"] for f in filters])
         #Filter the query in the equality filters
         for filtr in filters:
             formatted_query = ndb.query.FilterNode(filtr["field"], filtr["operator"], filtr["value"])
@@ -410,6 +756,10 @@ class ConferenceApi(remote.Service):
         else:
             q = q.order(ndb.GenericProperty(inequality_filter))
             q = q.order(Conference.name)
+        orders = [(inequality_filter, 'asc')] if inequality_filter else []
+        recordQueryShape('Conference',
+                         [f["field"] for f in filters if f["operator"] == "="],
+                         orders + [('name', 'asc')])
 
         for filtr in filters:
             if filtr["field"] in ["month", "maxAttendees"]:
@@ -447,37 +797,138 @@ class ConferenceApi(remote.Service):
         return (inequality_field, formatted_filters)
 
 
+    def _conferenceProjection(self, request, fields):
+        """Return the projection serving the selected fields for the query's
+        filters (None to load full entities) and the values fixed by its
+        equality filters, which a projection can't return."""
+        inequality_field, filters = self._formatFilters(request.filters)
+        equalities = {}
+        for filtr in filters:
+            if filtr["operator"] == "=":
+                equalities[filtr["field"]] = Conference.formatFilter(
+                    filtr["field"], filtr["value"])
+        orders = [('name', 'asc')]
+        if inequality_field:
+            orders.insert(0, (inequality_field, 'asc'))
+        projection = projectionFor(Conference, self._propertiesFor(fields),
+                                   equalities, orders)
+        return projection, equalities
+
+
+    def _describeFilter(self, filtr):
+        return '%s %s %s' % (filtr["field"], filtr["operator"], filtr["value"])
+
+    def _explainIndex(self, explain, kind, equalities, orders=(), projection=()):
+        """Set the index a query shape needs on its QueryExplainForm."""
+        try:
+            spec = findIndex(kind, False, equalities, orders, projection)
+        except LookupError:
+            joined = None if projection else mergeJoinIndexes(
+                kind, False, equalities, orders)
+            if joined:
+                explain.index = 'merge join of %s' % ', '.join(
+                    describeIndex(s) for s in joined)
+                explain.indexDeclared = True
+                return
+            explain.index = describeIndex(
+                requiredIndex(kind, False, equalities, orders, projection))
+            explain.indexDeclared = False
+            return
+        explain.indexDeclared = True
+        if spec:
+            explain.index = describeIndex(spec)
+        elif len(set(equalities)) > 1:
+            explain.index = 'built-in (merge join of %s)' % ', '.join(sorted(set(equalities)))
+        else:
+            explain.index = 'built-in'
+
+    def _explainConferenceQuery(self, request, projection):
+        """Return the plan of a queryConferences query: every filter runs
+        in the datastore, sorted on the inequality field (if any) and name."""
+        inequality_field, filters = self._formatFilters(request.filters)
+        orders = [('name', 'asc')]
+        if inequality_field:
+            orders.insert(0, (inequality_field, 'asc'))
+        explain = QueryExplainForm(
+            datastoreFilters=[self._describeFilter(f) for f in filters],
+            orders=[name for name, direction in orders],
+            projection=projection or [])
+        equalities = [f["field"] for f in filters if f["operator"] == "="]
+        self._explainIndex(explain, 'Conference', equalities, orders,
+                           projection or ())
+        return explain
+
+    def _explainGenericQuery(self, request, cls):
+        """Return the plan of a _getGenericQuery query: equality filters
+        run in the datastore, inequality filters in memory."""
+        inequality_filters, filters = self._formatGenericFilters(request.filters, cls)
+        explain = QueryExplainForm(
+            datastoreFilters=[self._describeFilter(f) for f in filters],
+            memoryFilters=[self._describeFilter(f) for f in inequality_filters])
+        self._explainIndex(explain, cls._get_kind(), [f["field"] for f in filters])
+        return explain
+
+
     @endpoints.method(ConferenceQueryForms, ConferenceForms,
             path='queryConferences',
             http_method='POST',
             name='queryConferences')
+    @instrumented
     def queryConferences(self, request):
-        """Query for conferences."""
-        conferences = self._getQuery(request)
+        """Query for conferences.
+        Only the selected fields are returned if a fields selector is given,
+        read with a projection query when index.yaml has an index for it.
+        With explain, the query plan is returned too; the query isn't run
+        if it needs an index missing from index.yaml."""
+        fields = self._selectedFields(ConferenceForm, request.fields)
+        projection, equalities = None, {}
+        if fields:
+            projection, equalities = self._conferenceProjection(request, fields)
+        explain = None
+        if request.explain:
+            explain = self._explainConferenceQuery(request, projection)
+            if not explain.indexDeclared:
+                return ConferenceForms(explain=explain)
+        with recording() as stats:
+            conferences = self._getQuery(request).fetch(projection=projection)
 
-        # need to fetch organiser displayName from profiles
-        # get all keys and use get_multi for speed
-        organisers = [(ndb.Key(Profile, conf.organizerUserId)) for conf in conferences]
-        profiles = ndb.get_multi(organisers)
-
-        # put display names in a dict for easier fetching
         names = {}
-        for profile in profiles:
-            names[profile.key.id()] = profile.displayName
+        if fields is None or 'organizerDisplayName' in fields:
+            # need to fetch organiser displayName from profiles
+            # get all keys and use get_multi for speed
+            organisers = [(ndb.Key(Profile, conf.organizerUserId)) for conf in conferences]
+            profiles = ndb.get_multi(organisers)
+
+            # put display names in a dict for easier fetching
+            for profile in profiles:
+                names[profile.key.id()] = profile.displayName
 
         # return individual ConferenceForm object per Conference
-        return ConferenceForms(
-                items=[self._copyConferenceToForm(conf, names[conf.organizerUserId]) for conf in \
-                conferences]
-        )
+        items = []
+        for conf in conferences:
+            cf = self._copyConferenceToForm(
+                conf, names.get(conf.organizerUserId) if names else None, fields)
+            if projection:
+                # fields fixed by an equality filter aren't projected
+                for name, value in equalities.items():
+                    if name in fields:
+                        setattr(cf, name, value)
+            items.append(cf)
+        if explain:
+            explain.scanned = stats.datastoreReads
+            explain.returned = len(items)
+        return ConferenceForms(items=items, explain=explain)
 
 
 # - - - Session objects - - - - - - - - - - - - - - - - -
 
-    def _copySessionToForm(self, sess):
-        """Copy relevant fields from Session to SessionForm."""
+    def _copySessionToForm(self, sess, fields=None):
+        """Copy relevant fields from Session to SessionForm,
+        only the selected ones if fields is given."""
         sf = SessionForm()
         for field in sf.all_fields():
+            if fields is not None and field.name not in fields:
+                continue
             if hasattr(sess, field.name):
                 # convert Date to date string; just copy others
                 if field.name in ['date','duration','start']:
@@ -524,30 +975,47 @@ class ConferenceApi(remote.Service):
 
         # creation of Session & return (modified) SessionForm
         Session(**data).put()
+        bumpVersion(conferenceVersionKey(request.websafeConferenceKey))
+        enqueueIndexing([s_key])
 
         return self._copySessionToForm(request)
 
-    @endpoints.method(CONF_GET_REQUEST, SessionForms,
+    @endpoints.method(CONF_CONDITIONAL_GET_REQUEST, SessionForms,
             path='getConferenceSessions',
             http_method='GET', name='getConferenceSessions')
+    @instrumented
     def getConferenceSessions(self, request):
-        """Return all sessions related to a conference (by websafeConferenceKey)."""
+        """Return all sessions related to a conference (by websafeConferenceKey).
+        Answer with notModified when ifNoneMatch matches the current etag.
+        Only the selected fields are returned if a fields selector is given,
+        read with a projection query when index.yaml has an index for it."""
+        fields = self._selectedFields(SessionForm, request.fields)
+        etag = self._fieldsEtag(
+            getVersion(conferenceVersionKey(request.websafeConferenceKey)), fields)
+        if request.ifNoneMatch == etag:
+            return SessionForms(etag=etag, notModified=True)
+        projection = None
+        if fields:
+            projection = projectionFor(Session, self._propertiesFor(fields),
+                                       ancestor=True)
         # get the Conference key from the urlSafe key
         confKey = ndb.Key(urlsafe=request.websafeConferenceKey)
         if not confKey:
             raise endpoints.NotFoundException(
                 'No conference found with key: %s' % request.websafeConferenceKey)
         # Query the sessions that have this conference as a parent
-        sessions = Session.query(ancestor=confKey).fetch()
+        sessions = Session.query(ancestor=confKey).fetch(projection=projection)
         # return SessionForms
         return SessionForms(
-                items=[self._copySessionToForm(sess) for sess in \
-                sessions]
+                items=[self._copySessionToForm(sess, fields) for sess in \
+                sessions],
+                etag=etag
         )
 
     @endpoints.method(SPEAKER_GET_BY_NAME_REQUEST, SessionForms,
             path='getSessionsBySpeaker',
             http_method='GET', name='getSessionsBySpeaker')
+    @instrumented
     def getSessionsBySpeaker(self, request):
         """Return all sessions related to a speaker (by speaker name)."""
         # check if the speaker is defined in the request
@@ -565,6 +1033,7 @@ class ConferenceApi(remote.Service):
     @endpoints.method(SESSION_GET_BY_TYPE_REQUEST, SessionForms,
             path='getConferenceSessionsByType',
             http_method='GET', name='getConferenceSessionsByType')
+    @instrumented
     def getConferenceSessionsByType(self, request):
         """Return all sessions related to a speaker (by speaker name)."""
         # check if the all the necessary fields are defined in the request
@@ -590,6 +1059,7 @@ class ConferenceApi(remote.Service):
     @endpoints.method(SESSION_GET_BY_COMPANY_REQUEST, SessionForms,
             path='getConferenceSessionsByCompany',
             http_method='GET', name='getConferenceSessionsByCompany')
+    @instrumented
     def getConferenceSessionsByCompany(self, request):
         """Return all sessions that have speakers that works for the inputed company."""
         # check if the all the necessary fields are defined in the request
@@ -621,6 +1091,7 @@ class ConferenceApi(remote.Service):
     @endpoints.method(SESSION_GET_BY_SPECIALTY_REQUEST, SessionForms,
             path='getConferenceSessionsBySpeakerSpecialty',
             http_method='GET', name='getConferenceSessionsBySpeakerSpecialty')
+    @instrumented
     def getConferenceSessionsBySpeakerSpecialty(self, request):
         """Return all sessions that have speakers with the desired specialty."""
         # check if the all the necessary fields are defined in the request
@@ -652,6 +1123,7 @@ class ConferenceApi(remote.Service):
     @endpoints.method(SESSION_POST_REQUEST, SessionForm, path='session',
             http_method='POST', name='createSession')
     #@ndb.transactional(xg=True) speacker don't have an ancestor so I cant make this a transactional method
+    @instrumented
     def createSession(self, request):
         """Create new session."""
         #Get the current user
@@ -679,6 +1151,7 @@ class ConferenceApi(remote.Service):
 
     @endpoints.method(SESSION_KEY, ProfileForm, path='addSessionToWishlist',
             http_method='POST', name='addSessionToWishlist')
+    @instrumented
     def addSessionToWishlist(self, request):
         """Add or remove(if the session is already in the list) a session to a user Wishlist."""
         swsk = request.websafeSessionKey
@@ -694,6 +1167,7 @@ class ConferenceApi(remote.Service):
 
     @endpoints.method(message_types.VoidMessage, SessionForms, path='getSessionsInWishlist',
             http_method='POST', name='getSessionsInWishlist')
+    @instrumented
     def getSessionsInWishlist(self, request):
         """Return all the sessions in the user Wishlist."""
         prof = self._getProfileFromUser()  # get user Profile
@@ -709,22 +1183,98 @@ class ConferenceApi(remote.Service):
             items=[self._copySessionToForm(s) for s in sessions]
         )
 
+    def _agendaToForm(self, agenda):
+        """Copy the agenda from agendaDays to an AgendaForm."""
+        days = []
+        conflicts = 0
+        for day, sessions, groups in agenda:
+            days.append(AgendaDayForm(
+                date=str(day) if day else None,
+                sessions=[self._copySessionToForm(s) for s in sessions],
+                conflicts=[AgendaConflictForm(
+                    websafeSessionKeys=[s.key.urlsafe() for s in group],
+                    start=formatMinutes(start), end=formatMinutes(end))
+                    for start, end, group in groups]))
+            conflicts += len(groups)
+        return AgendaForm(days=days, conflicts=conflicts)
+
+    @endpoints.method(message_types.VoidMessage, AgendaForm,
+            path='getMyAgenda',
+            http_method='GET', name='getMyAgenda')
+    @instrumented
+    def getMyAgenda(self, request):
+        """Return the sessions in the user Wishlist by date, with the groups
+        of sessions overlapping in time as conflicts."""
+        prof = self._getProfileFromUser()  # get user Profile
+        def build():
+            keys = []
+            for sess in prof.sessionWishlist:
+                try:
+                    keys.append(ndb.Key(urlsafe=str(sess)))
+                except Exception, e:
+                    logging.error('Invalid wishlist key %s: %s' % (sess, e))
+            sessions = [s for s in ndb.get_multi(keys) if s]
+            return protojson.encode_message(self._agendaToForm(agendaDays(sessions)))
+        return protojson.decode_message(AgendaForm,
+            cachedAgenda(prof.key.id(), prof.sessionWishlist, build))
+
+    @endpoints.method(RECOMMENDATIONS_GET_REQUEST, SessionForms,
+            path='getRecommendedSessions',
+            http_method='GET', name='getRecommendedSessions')
+    @instrumented
+    def getRecommendedSessions(self, request):
+        """Return the sessions most often wishlisted together with the ones
+        in the user Wishlist, best first; recomputed daily."""
+        prof = self._getProfileFromUser()  # get user Profile
+        keys = [ndb.Key(urlsafe=wssk) for wssk in
+                recommendSessions(prof.sessionWishlist, request.limit)]
+        # sessions deleted since are left out
+        return SessionForms(
+            items=[self._copySessionToForm(s) for s in ndb.get_multi(keys) if s]
+        )
+
     @endpoints.method(SESSION_KEY, SessionForm, path='getSessionByKey',
             http_method='POST', name='getSessionByKey')
+    @instrumented
     def getSessionByKey(self, request):
         '''Return the session based on the informed key'''
         return self._copySessionToForm(ndb.Key(urlsafe=request.websafeSessionKey).get())
 
+    @endpoints.method(SESSION_SEARCH_REQUEST, SessionSearchForms,
+            path='searchSessions',
+            http_method='GET', name='searchSessions')
+    @instrumented
+    def searchSessions(self, request):
+        """Return the sessions matching every keyword of query in their name,
+        highlights or conference description, best matches first; pass the
+        returned cursor to get the next page."""
+        try:
+            offset = int(request.cursor or 0)
+        except ValueError:
+            raise endpoints.BadRequestException('Invalid cursor: %s' % request.cursor)
+        sessions, end, total = searchIndex(request.query, offset, request.limit)
+        return SessionSearchForms(
+            items=[self._copySessionToForm(s) for s in sessions],
+            cursor=str(end) if end is not None else None,
+            total=total)
+
     @endpoints.method(QueryForms, SessionForms,
             path='querySessions',
             http_method='POST', name='querySessions')
+    @instrumented
     def querySessions(self, request):
-        """Return all sessions based on the inputed parameters, no limit of inequality filters."""
+        """Return all sessions based on the inputed parameters, no limit of inequality filters.
+        With explain, the query plan and the sessions scanned are returned too."""
         # Set the items list, it will recieve all the entities that passed the callback
         items = []
+        explain = self._explainGenericQuery(request, Session) if request.explain else None
         # Must call the get_result on the future object to ensure all the entities will be retrived
-        i = self._getGenericQuery(request, items, self._callbackQuerySessions, Session).get_result()
-        return SessionForms(items=items)
+        with recording() as stats:
+            i = self._getGenericQuery(request, items, self._callbackQuerySessions, Session).get_result()
+        if explain:
+            explain.scanned = stats.datastoreReads
+            explain.returned = len(items)
+        return SessionForms(items=items, explain=explain)
 
     def _callbackQuerySessions(self, entity, responseObj, inequality_filters):
         """Recieve every entity retrived in the generic query, check if it passes the inequality filters,
@@ -750,6 +1300,8 @@ class ConferenceApi(remote.Service):
             if conference.featuredSpeaker != speaker:
                 conference.featuredSpeaker = speaker
                 conference.put()
+                bumpVersion(conferenceVersionKey(conferenceKey))
+                bumpMonthVersions(conference.startDate)
             # Generate a featured mesage to cache
             featured = "The featured speaker is "+str(speaker)+', and the sessions are: '
             s = ', '.join(s.name for s in qSessions.fetch())
@@ -762,25 +1314,25 @@ class ConferenceApi(remote.Service):
         """Creates a default speaker with the inputed name."""
         data = DEFAULT_SPEAKER
         data['name'] = name
-        return Speaker(**data).put()
+        s_key = Speaker(**data).put()
+        bumpSpeakerGeneration([s_key])
+        return s_key
 
     def _getSpeakerByName(self, name):
         """Return the speaker (as a SpeakerForm) with the inputed name."""
-        speaker = Speaker.query(Speaker.name == name).get()
+        speaker = speakerDirectory().byName(name)
         return self._copySpeakerToForm(speaker) if speaker else False
 
     def _getSpeakerBycompany(self, company):
         """Return the speakers (as a list of speaker's names) from the inputed company."""
-        speakers = Speaker.query(Speaker.company == company).fetch()
-        return [speaker.name for speaker in speakers]
+        return speakerDirectory().namesByCompany(company)
 
     def _getSpeakerByspecialty(self, specialty):
         """Return the speakers (as a list of speaker's names) from the inputed specialty."""
-        speakers = Speaker.query(Speaker.specialty == specialty).fetch()
-        return [speaker.name for speaker in speakers]
+        return speakerDirectory().namesBySpecialty(specialty)
 
     def _copySpeakerToForm(self, spea):
-        """Copy relevant fields from Speaker to SpeakerForm."""
+        """Copy relevant fields from Speaker (or its SpeakerRecord) to SpeakerForm."""
         sf = SpeakerForm()
         for field in sf.all_fields():
             if hasattr(spea, field.name):
@@ -815,30 +1367,34 @@ class ConferenceApi(remote.Service):
 
         # creation of Speaker & return (modified) SpeakerForm
         Speaker(**data).put()
+        bumpSpeakerGeneration([s_key])
 
         return self._copySpeakerToForm(request)
 
     @endpoints.method(QueryForms, SpeakerForms,
             path='querySpeaker',
             http_method='POST', name='querySpeaker')
+    @instrumented
     def querySpeaker(self, request):
-        """Return all speakers based on the inputed parameters, no limit of inequality filters."""
-        # Set the items list, it will recieve all the entities that passed the callback
-        items = []
-        # Must call the get_result on the future object to ensure all the entities will be retrived
-        i = self._getGenericQuery(request, items, self._callbackQuerySpeakers, Speaker).get_result()
-        return SpeakerForms(items=items)
-
-    def _callbackQuerySpeakers(self, entity, responseObj, inequality_filters):
-        """Recieve every entity retrived in the generic query, check if it passes the inequality filters,
-        and if it does, transform it in a SpeakerForm and append it to the responseObj."""
-        # Check if the speaker pass in the inequality filters
-        if validadeInequalityFilter(inequality_filters, entity):
-            # Append in the response object the form version of the speaker
-            responseObj.append(self._copySpeakerToForm(entity))
+        """Return all speakers based on the inputed parameters, no limit of inequality filters.
+        Runs on the instance's speaker directory, not the datastore.
+        With explain, the query plan and the speakers scanned are returned too."""
+        inequality_filters, filters = self._formatGenericFilters(request.filters, Speaker)
+        records, scanned = speakerDirectory().query(
+            [(f["field"], f["value"]) for f in filters])
+        items = [self._copySpeakerToForm(r) for r in records
+                 if validadeInequalityFilter(inequality_filters, r)]
+        explain = None
+        if request.explain:
+            explain = QueryExplainForm(
+                memoryFilters=[self._describeFilter(f) for f in filters + inequality_filters],
+                index='in-memory speaker directory', indexDeclared=True,
+                scanned=scanned, returned=len(items))
+        return SpeakerForms(items=items, explain=explain)
 
     @endpoints.method(CONF_GET_REQUEST, StringMessage, path='getFeaturedSpeaker',
             http_method='POST', name='getFeaturedSpeaker')
+    @instrumented
     def getFeaturedSpeaker(self, request):
         """Return the conference's actual featured speaker."""
         msg = memcache.get(MEMCACHE_FEATURED_SPEAKER_PRE_KEY+request.websafeConferenceKey)
@@ -849,12 +1405,143 @@ class ConferenceApi(remote.Service):
 
     @endpoints.method(SPEAKER_POST_REQUEST, SpeakerForm, path='speaker',
             http_method='POST', name='createSpeaker')
+    @instrumented
     def createSpeaker(self, request):
         """Create new Speaker."""
         # Create a Speaker
         return self._createSpeakerObject(request)
 
 
+# - - - Facets - - - - - - - - - - - - - - - - - - - - - - -
+
+    @endpoints.method(message_types.VoidMessage, ConferenceFacetsForm,
+            path='getConferenceFacets',
+            http_method='GET', name='getConferenceFacets')
+    @instrumented
+    def getConferenceFacets(self, request):
+        """Return the number of conferences per city, topic and month, most
+        frequent first; the counts lag the writes by up to a minute."""
+        counts, recountedAt = conferenceFacets()
+        form = ConferenceFacetsForm(
+            recountedAt=str(recountedAt) if recountedAt else None)
+        for facet in FACET_FIELDS:
+            values = counts.get(facet, {})
+            setattr(form, facet, [FacetCountForm(value=v, count=values[v])
+                for v in sorted(values, key=lambda v: (-values[v], v))
+                if values[v] > 0])
+        return form
+
+
+# - - - Autocomplete - - - - - - - - - - - - - - - - - - - -
+
+    @endpoints.method(SUGGEST_GET_REQUEST, SuggestionForms, path='suggest',
+            http_method='GET', name='suggest')
+    @instrumented
+    def suggest(self, request):
+        """Return the conferences, sessions or speakers (kind) whose name,
+        or a word of it, starts with prefix; limit of them at most."""
+        cls = SUGGEST_KINDS.get((request.kind or '').lower())
+        if not cls:
+            raise endpoints.BadRequestException(
+                "kind must be one of: %s" % ', '.join(sorted(SUGGEST_KINDS)))
+        return SuggestionForms(items=[
+            SuggestionForm(name=name, websafeKey=key)
+            for name, key in suggestNames(cls, request.prefix, request.limit)])
+
+
+# - - - Change feed - - - - - - - - - - - - - - - - - - - - -
+
+    def _encodeChangeCursor(self, state):
+        """Encode the change feed position as an opaque cursor."""
+        return base64.urlsafe_b64encode(json.dumps(state))
+
+
+    def _decodeChangeCursor(self, cursor):
+        """Decode a change feed cursor; no cursor starts from the beginning.
+        A position is a pass over all CHANGE_FEED_KINDS for the changes in
+        (since, until], the kind being walked and the query cursor in it."""
+        if not cursor:
+            return {'since': 0, 'until': None, 'kind': 0, 'cursor': None}
+        try:
+            return json.loads(base64.urlsafe_b64decode(str(cursor)))
+        except (TypeError, ValueError):
+            raise endpoints.BadRequestException('Invalid cursor: %s' % cursor)
+
+
+    def _copyChangesToForms(self, entities):
+        """Copy a page of changed entities to ChangeForms."""
+        # fetch the organizers of the page's conferences in one batch
+        organisers = set(ndb.Key(Profile, e.organizerUserId) for e in entities
+                         if isinstance(e, Conference))
+        names = {}
+        for profile in ndb.get_multi(list(organisers)):
+            if profile:
+                names[profile.key.id()] = profile.displayName
+
+        forms = []
+        for e in entities:
+            cf = ChangeForm(updatedAt=str(e.updatedAt))
+            if isinstance(e, Tombstone):
+                cf.kind = e.kind
+                cf.websafeKey = e.websafeKey
+                cf.deleted = True
+            else:
+                cf.kind = e._get_kind()
+                cf.websafeKey = e.key.urlsafe()
+                cf.deleted = False
+                if isinstance(e, Conference):
+                    cf.conference = self._copyConferenceToForm(
+                        e, names.get(e.organizerUserId))
+                elif isinstance(e, Session):
+                    cf.session = self._copySessionToForm(e)
+                else:
+                    cf.speaker = self._copySpeakerToForm(e)
+            forms.append(cf)
+        return forms
+
+
+    @endpoints.method(CHANGES_GET_REQUEST, ChangeForms,
+            path='getChangesSince',
+            http_method='GET', name='getChangesSince')
+    @instrumented
+    def getChangesSince(self, request):
+        """Return a page of the conferences, sessions and speakers changed
+        (and tombstones of those deleted) since the cursor.
+        Keep calling with the returned cursor while more is set; the last
+        cursor of a pass is where the next sync starts from."""
+        state = self._decodeChangeCursor(request.cursor)
+        if state['until'] is None:
+            settled = datetime.utcnow() - timedelta(seconds=CHANGE_FEED_SETTLE_SECONDS)
+            state['until'] = max(state['since'], toMicros(settled))
+        since = fromMicros(state['since'])
+        until = fromMicros(state['until'])
+        limit = min(request.limit or CHANGE_FEED_PAGE_SIZE, CHANGE_FEED_PAGE_SIZE)
+
+        entities = []
+        while len(entities) < limit and state['kind'] < len(CHANGE_FEED_KINDS):
+            cls = CHANGE_FEED_KINDS[state['kind']]
+            q = cls.query(cls.updatedAt > since, cls.updatedAt <= until)
+            q = q.order(cls.updatedAt)
+            start = Cursor(urlsafe=state['cursor']) if state['cursor'] else None
+            page, next_cursor, more = q.fetch_page(
+                limit - len(entities), start_cursor=start)
+            entities.extend(page)
+            if more and next_cursor:
+                state['cursor'] = next_cursor.urlsafe()
+            else:
+                # this kind is done, move on to the next one
+                state['kind'] += 1
+                state['cursor'] = None
+
+        more = state['kind'] < len(CHANGE_FEED_KINDS)
+        if not more:
+            # pass complete: the next one starts where this one ended
+            state = {'since': state['until'], 'until': None, 'kind': 0, 'cursor': None}
+        return ChangeForms(items=self._copyChangesToForms(entities),
+                           cursor=self._encodeChangeCursor(state),
+                           more=more)
+
+
 # - - - Profile objects - - - - - - - - - - - - - - - - - - -
 
     def _copyProfileToForm(self, prof):
@@ -903,6 +1590,13 @@ class ConferenceApi(remote.Service):
 
         # if saveProfile(), process user-modifyable fields
         if save_request:
+            if save_request.displayName and \
+                    save_request.displayName != prof.displayName:
+                # organizerDisplayName is part of every conference the
+                # user organizes, so their etags are no longer valid
+                for conf in Conference.query(ancestor=prof.key):
+                    bumpVersion(conferenceVersionKey(conf.key.urlsafe()))
+                    bumpMonthVersions(conf.startDate)
             for field in ('displayName', 'teeShirtSize'):
                 if hasattr(save_request, field):
                     val = getattr(save_request, field)
@@ -920,6 +1614,7 @@ class ConferenceApi(remote.Service):
 
     @endpoints.method(message_types.VoidMessage, ProfileForm,
             path='profile', http_method='GET', name='getProfile')
+    @instrumented
     def getProfile(self, request):
         """Return user profile."""
         return self._doProfile()
@@ -927,6 +1622,7 @@ class ConferenceApi(remote.Service):
 
     @endpoints.method(ProfileMiniForm, ProfileForm,
             path='profile', http_method='POST', name='saveProfile')
+    @instrumented
     def saveProfile(self, request):
         """Update & return user profile."""
         return self._doProfile(request)
@@ -939,39 +1635,30 @@ class ConferenceApi(remote.Service):
         """Create Announcement & assign to memcache; used by
         memcache cron job & putAnnouncement().
         """
-        confs = Conference.query(ndb.AND(
-            Conference.seatsAvailable <= 5,
-            Conference.seatsAvailable > 0)
-        ).fetch(projection=[Conference.name])
-
-        if confs:
-            # If there are almost sold out conferences,
-            # format announcement and set it in memcache
-            announcement = ANNOUNCEMENT_TPL % (
-                ', '.join(conf.name for conf in confs))
-            memcache.set(MEMCACHE_ANNOUNCEMENTS_KEY, announcement)
-        else:
-            # If there are no sold out conferences,
-            # delete the memcache announcements entry
-            announcement = ""
-            memcache.delete(MEMCACHE_ANNOUNCEMENTS_KEY)
+        return cacheAnnouncement()
 
-        return announcement
 
-
-    @endpoints.method(message_types.VoidMessage, StringMessage,
+    @endpoints.method(ANNOUNCEMENT_GET_REQUEST, StringMessage,
             path='conference/announcement/get',
             http_method='GET', name='getAnnouncement')
+    @instrumented
     def getAnnouncement(self, request):
-        """Return Announcement from memcache."""
-        return StringMessage(data=memcache.get(MEMCACHE_ANNOUNCEMENTS_KEY) or "")
+        """Return Announcement from memcache.
+        Answer with notModified when ifNoneMatch matches the current etag."""
+        etag = getVersion(MEMCACHE_ANNOUNCEMENTS_VERSION_KEY)
+        if request.ifNoneMatch == etag:
+            return StringMessage(data="", etag=etag, notModified=True)
+        return StringMessage(data=memcache.get(MEMCACHE_ANNOUNCEMENTS_KEY) or "",
+                             etag=etag)
 
 
 # - - - Registration - - - - - - - - - - - - - - - - - - - -
 
     @ndb.transactional(xg=True)
     def _conferenceRegistration(self, request, reg=True):
-        """Register or unregister user for selected conference."""
+        """Register or unregister user for selected conference.
+        A full conference, or one with a waitlist, puts the user on its
+        waitlist instead (returning false); unregistering takes them off."""
         retval = None
         prof = self._getProfileFromUser() # get user Profile
 
@@ -990,15 +1677,16 @@ class ConferenceApi(remote.Service):
                 raise ConflictException(
                     "You have already registered for this conference")
 
-            # check if seats avail
-            if conf.seatsAvailable <= 0:
-                raise ConflictException(
-                    "There are no seats available.")
-
-            # register user, take away one seat
-            prof.conferenceKeysToAttend.append(wsck)
-            conf.seatsAvailable -= 1
-            retval = True
+            # check if seats avail; seats freed while people wait are theirs
+            if conf.seatsAvailable <= 0 or conf.waitlisted:
+                joinWaitlist(conf, prof)
+                retval = False
+            else:
+                # register user, take away one seat
+                prof.conferenceKeysToAttend.append(wsck)
+                conf.seatsAvailable -= 1
+                recordRegistration(wsck)
+                retval = True
 
         # unregister
         else:
@@ -1009,18 +1697,25 @@ class ConferenceApi(remote.Service):
                 prof.conferenceKeysToAttend.remove(wsck)
                 conf.seatsAvailable += 1
                 retval = True
+                if conf.waitlisted:
+                    enqueuePromotion(conf.key)
             else:
-                retval = False
+                retval = leaveWaitlist(conf, prof)
 
         # write things back to the datastore & return
         prof.put()
         conf.put()
+        # joining the waitlist (retval False) changes conf.waitlisted too
+        if retval or reg:
+            bumpVersion(conferenceVersionKey(wsck))
+            bumpMonthVersions(conf.startDate)
         return BooleanMessage(data=retval)
 
 
     @endpoints.method(message_types.VoidMessage, ConferenceForms,
             path='conferences/attending',
             http_method='GET', name='getConferencesToAttend')
+    @instrumented
     def getConferencesToAttend(self, request):
         """Get list of conferences that user has registered for."""
         prof = self._getProfileFromUser() # get user Profile
@@ -1045,22 +1740,74 @@ class ConferenceApi(remote.Service):
     @endpoints.method(CONF_GET_REQUEST, BooleanMessage,
             path='conference/{websafeConferenceKey}',
             http_method='POST', name='registerForConference')
+    @instrumented
     def registerForConference(self, request):
-        """Register user for selected conference."""
+        """Register user for selected conference; false if it is full and
+        the user was put on its waitlist instead (see getWaitlistPosition)."""
         return self._conferenceRegistration(request)
 
 
     @endpoints.method(CONF_GET_REQUEST, BooleanMessage,
             path='conference/{websafeConferenceKey}',
             http_method='DELETE', name='unregisterFromConference')
+    @instrumented
     def unregisterFromConference(self, request):
-        """Unregister user for selected conference."""
+        """Unregister user for selected conference, or take them off its waitlist."""
         return self._conferenceRegistration(request, reg=False)
 
 
+    @endpoints.method(CONF_GET_REQUEST, WaitlistPositionForm,
+            path='conference/{websafeConferenceKey}/waitlist',
+            http_method='GET', name='getWaitlistPosition')
+    @instrumented
+    def getWaitlistPosition(self, request):
+        """Return whether the user is registered for the conference, or their
+        position on its waitlist (none if they are not on it)."""
+        user = endpoints.get_current_user()
+        if not user:
+            raise endpoints.UnauthorizedException('Authorization required')
+        p_key = ndb.Key(Profile, getUserId(user))
+        wsck = request.websafeConferenceKey
+        position = waitlistPosition(wsck, p_key)
+        if position:
+            return WaitlistPositionForm(registered=False, position=position)
+        prof = p_key.get()
+        return WaitlistPositionForm(
+            registered=bool(prof and wsck in prof.conferenceKeysToAttend))
+
+
+    @endpoints.method(TRENDING_GET_REQUEST, TrendingConferenceForms,
+            path='getTrendingConferences',
+            http_method='GET', name='getTrendingConferences')
+    @instrumented
+    def getTrendingConferences(self, request):
+        """Return the conferences with the most registrations in the last
+        hour (window=hour, the default) or day (window=day), most first;
+        recomputed every 10 minutes."""
+        window = request.window or 'hour'
+        if window not in WINDOWS:
+            raise endpoints.BadRequestException(
+                'window must be one of: %s' % ', '.join(sorted(WINDOWS)))
+        top, computedAt = trendingConferences(window)
+        top = top[:min(request.limit or TOP_K, TOP_K)]
+        conferences = ndb.get_multi([ndb.Key(urlsafe=wsck) for wsck, count in top])
+        profiles = ndb.get_multi([conf.key.parent() for conf in conferences if conf])
+        names = dict((prof.key, prof.displayName) for prof in profiles if prof)
+        items = []
+        for conf, (wsck, count) in zip(conferences, top):
+            # conferences deleted since are left out
+            if conf:
+                items.append(TrendingConferenceForm(
+                    conference=self._copyConferenceToForm(conf, names.get(conf.key.parent())),
+                    registrations=count))
+        return TrendingConferenceForms(items=items, window=window,
+            computedAt=str(computedAt) if computedAt else None)
+
+
     @endpoints.method(message_types.VoidMessage, ConferenceForms,
             path='filterPlayground',
             http_method='GET', name='filterPlayground')
+    @instrumented
     def filterPlayground(self, request):
         """Filter Playground"""
         q = Conference.query()
@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+
+"""deletion.py
+
+Cascading deletion of a conference, run in the background by chained
+/tasks/delete_conference tasks. A DeletionJob records the progress; each
+task does one bounded step of the current phase and checkpoints:
+
+    conference  delete the Conference itself and invalidate its caches
+    attendees   remove it from Profile.conferenceKeysToAttend, by pages
+    waitlist    delete its WaitlistEntry entities, by pages
+    wishlists   remove its sessions from Profile.sessionWishlist, by pages
+    entities    delete the rest of its entity group with keys-only queries
+
+Profiles are updated each in its own transaction that re-reads them, so
+a registration or wishlist change committed meanwhile is kept.
+
+"""
+
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+
+from caching import MEMCACHE_FEATURED_SPEAKER_PRE_KEY
+from caching import bumpVersion
+from caching import conferenceVersionKey
+from caching import bumpMonthVersions
+from facets import enqueueFacetChange
+from facets import facetValues
+from fulltext import enqueueIndexing
+from models import DeletionJob
+from models import Profile
+from models import Session
+from models import Tombstone
+from models import WaitlistEntry
+
+PROFILES_PAGE_SIZE = 100
+DELETE_BATCH_SIZE = 500
+
+
+def startConferenceDeletion(conf_key, organizerUserId=None):
+    """Start deleting a conference unless it is already being deleted;
+    return its DeletionJob."""
+    return _startDeletion(ndb.Key(DeletionJob, conf_key.urlsafe()), organizerUserId)
+
+
+@ndb.transactional()
+def _startDeletion(job_key, organizerUserId):
+    job = job_key.get()
+    if not job:
+        job = DeletionJob(key=job_key, organizerUserId=organizerUserId)
+        job.put()
+        _enqueueStep(job_key, 0)
+    return job
+
+
+def _enqueueStep(job_key, step):
+    """Queue the task running one step of a deletion."""
+    taskqueue.add(params={'job': job_key.urlsafe(), 'step': step},
+        url='/tasks/delete_conference',
+        transactional=ndb.in_transaction()
+    )
+
+
+def runDeletionStep(job_key, step):
+    """Run one step of a deletion and checkpoint it."""
+    job = job_key.get()
+    if not job or job.phase == 'done' or job.step != step:
+        # duplicate of a step that was already checkpointed
+        return
+    conf_key = ndb.Key(urlsafe=job_key.id())
+    PHASES[job.phase](job, conf_key)
+    _checkpoint(job, step)
+
+
+@ndb.transactional()
+def _checkpoint(job, step):
+    """Record a finished step and chain the next one, if any."""
+    if job.key.get().step != step:
+        return
+    job.step = step + 1
+    job.put()
+    if job.phase != 'done':
+        _enqueueStep(job.key, job.step)
+
+
+def _deleteConference(job, conf_key):
+    """Delete the Conference entity and invalidate its caches."""
+    wsck = conf_key.urlsafe()
+    conf = conf_key.get()
+    if conf:
+        Tombstone(kind='Conference', websafeKey=wsck).put()
+        conf_key.delete()
+        enqueueFacetChange(conf_key, facetValues(conf), {})
+        bumpMonthVersions(conf.startDate)
+    memcache.delete(MEMCACHE_FEATURED_SPEAKER_PRE_KEY + wsck)
+    bumpVersion(conferenceVersionKey(wsck))
+    # the announcement may list the conference
+    taskqueue.add(url='/crons/set_announcement', method='GET')
+    job.phase = 'attendees'
+
+
+@ndb.transactional_tasklet
+def _removeFromProfile(profile_key, field, value):
+    """Remove value from a list field of a profile, read again in the
+    transaction; return whether it was there."""
+    prof = yield profile_key.get_async()
+    if not prof or value not in getattr(prof, field):
+        raise ndb.Return(False)
+    setattr(prof, field, [v for v in getattr(prof, field) if v != value])
+    yield prof.put_async()
+    raise ndb.Return(True)
+
+
+def _removeFromProfiles(keys, field, value):
+    """Remove value from a list field of the profiles of keys, one
+    transaction each, in parallel."""
+    futures = [_removeFromProfile(key, field, value) for key in keys]
+    ndb.Future.wait_all(futures)
+    for future in futures:
+        # raise the first failure so the step is retried
+        future.check_success()
+
+
+def _removeAttendees(job, conf_key):
+    """Remove the conference from one page of attendee profiles."""
+    wsck = conf_key.urlsafe()
+    q = Profile.query(Profile.conferenceKeysToAttend == wsck)
+    start = Cursor(urlsafe=job.cursor) if job.cursor else None
+    keys, cursor, more = q.fetch_page(PROFILES_PAGE_SIZE, start_cursor=start,
+                                      keys_only=True)
+    _removeFromProfiles(keys, 'conferenceKeysToAttend', wsck)
+    job.attendeesUpdated += len(keys)
+    if more and cursor:
+        job.cursor = cursor.urlsafe()
+    else:
+        job.phase = 'waitlist'
+        job.cursor = None
+
+
+def _clearWaitlist(job, conf_key):
+    """Delete one page of the conference's waitlist entries."""
+    keys = WaitlistEntry.query(WaitlistEntry.conference == conf_key.urlsafe()
+                               ).fetch(PROFILES_PAGE_SIZE, keys_only=True)
+    ndb.delete_multi(keys)
+    job.entitiesDeleted += len(keys)
+    if len(keys) < PROFILES_PAGE_SIZE:
+        job.phase = 'wishlists'
+
+
+def _removeFromWishlists(job, conf_key):
+    """Remove one of the conference's sessions from one page of wishlists.
+    Sessions are walked one at a time (job.session, job.sessionCursor),
+    the wishlists holding the current one by pages (job.cursor)."""
+    if not job.session:
+        start = Cursor(urlsafe=job.sessionCursor) if job.sessionCursor else None
+        keys, cursor, more = Session.query(ancestor=conf_key).fetch_page(
+            1, keys_only=True, start_cursor=start)
+        if not keys:
+            job.phase = 'entities'
+            job.sessionCursor = None
+            return
+        job.session = keys[0].urlsafe()
+        job.sessionCursor = cursor.urlsafe() if cursor else None
+        job.cursor = None
+
+    q = Profile.query(Profile.sessionWishlist == job.session)
+    start = Cursor(urlsafe=job.cursor) if job.cursor else None
+    keys, cursor, more = q.fetch_page(PROFILES_PAGE_SIZE, start_cursor=start,
+                                      keys_only=True)
+    _removeFromProfiles(keys, 'sessionWishlist', job.session)
+    job.wishlistsUpdated += len(keys)
+    if more and cursor:
+        job.cursor = cursor.urlsafe()
+    else:
+        job.session = None
+        job.cursor = None
+
+
+def _deleteEntities(job, conf_key):
+    """Delete one batch of the conference's entity group (its Sessions and
+    any other child), keys only."""
+    keys = ndb.Query(ancestor=conf_key).fetch(DELETE_BATCH_SIZE, keys_only=True)
+    sessions = [key for key in keys if key.kind() == 'Session']
+    ndb.put_multi([Tombstone(kind=key.kind(), websafeKey=key.urlsafe())
+                   for key in sessions])
+    ndb.delete_multi(keys)
+    # take the deleted sessions out of the search index
+    enqueueIndexing(sessions)
+    job.entitiesDeleted += len(keys)
+    if len(keys) < DELETE_BATCH_SIZE:
+        job.phase = 'done'
+
+
+PHASES = {
+    'conference': _deleteConference,
+    'attendees': _removeAttendees,
+    'waitlist': _clearWaitlist,
+    'wishlists': _removeFromWishlists,
+    'entities': _deleteEntities,
+}
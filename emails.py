@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+
+"""emails.py
+
+Outgoing email pipeline: emails are queued as pull tasks by the API and
+leased in batches, rendered from templates/email and sent by the
+/crons/send_emails consumer.
+
+"""
+
+import json
+import logging
+import os
+import Queue
+import string
+import threading
+
+from google.appengine.api import app_identity
+from google.appengine.api import mail
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+EMAIL_QUEUE = 'email'
+LEASE_SECONDS = 120
+LEASE_BATCH_SIZE = 100
+# batches leased per consumer run, so a run ends well before the next one
+MAX_LEASE_BATCHES = 10
+SEND_CONCURRENCY = 5
+# an email failing more often than this is dropped
+MAX_RETRIES = 5
+TEMPLATE_DIR = os.path.join(os.path.dirname(__file__), 'templates', 'email')
+
+_templates = {}
+
+
+def enqueueEmail(template, to, conferenceKey, **params):
+    """Queue an email about a conference, rendered from template at send time."""
+    payload = json.dumps({
+        'template': template,
+        'to': to,
+        'conferenceKey': conferenceKey,
+        'params': params,
+    })
+    taskqueue.Queue(EMAIL_QUEUE).add(
+        taskqueue.Task(payload=payload, method='PULL', tag=conferenceKey))
+
+
+def enqueueEmails(template, recipients, conferenceKey, name=None, **params):
+    """Queue the same email about a conference to many recipients in one
+    call (at most 100). Named batches are only queued once, so a retried
+    producer doesn't send them twice."""
+    tasks = []
+    for i, to in enumerate(recipients):
+        payload = json.dumps({
+            'template': template,
+            'to': to,
+            'conferenceKey': conferenceKey,
+            'params': params,
+        })
+        tasks.append(taskqueue.Task(
+            payload=payload, method='PULL', tag=conferenceKey,
+            name='%s-%d' % (name, i) if name else None))
+    if not tasks:
+        return
+    try:
+        taskqueue.Queue(EMAIL_QUEUE).add(tasks)
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        # the batch was already queued by an earlier try
+        pass
+
+
+def _loadTemplate(name):
+    """Return the (subject, body) templates of templates/email/<name>.txt;
+    the first line of the file is "Subject: <subject>"."""
+    if name not in _templates:
+        with open(os.path.join(TEMPLATE_DIR, name + '.txt')) as f:
+            subject, body = f.read().split('\n', 1)
+        _templates[name] = (string.Template(subject[len('Subject:'):].strip()),
+                            string.Template(body))
+    return _templates[name]
+
+
+def renderEmail(template, context):
+    """Render template with context, returning (subject, body)."""
+    subject, body = _loadTemplate(template)
+    return subject.safe_substitute(context), body.safe_substitute(context)
+
+
+def conferenceContext(conf):
+    """Return the template variables describing a conference."""
+    def text(value):
+        return u'' if value is None else unicode(value)
+    return {
+        'name': conf.name,
+        'description': text(conf.description),
+        'city': text(conf.city),
+        'startDate': text(conf.startDate),
+        'endDate': text(conf.endDate),
+        'topics': ', '.join(conf.topics),
+        'maxAttendees': text(conf.maxAttendees),
+        'websafeKey': conf.key.urlsafe(),
+    }
+
+
+def sendPendingEmails():
+    """Lease and send queued emails until the queue is empty or
+    MAX_LEASE_BATCHES batches were processed; return the number sent."""
+    queue = taskqueue.Queue(EMAIL_QUEUE)
+    sent = 0
+    for i in range(MAX_LEASE_BATCHES):
+        tasks = queue.lease_tasks(LEASE_SECONDS, LEASE_BATCH_SIZE)
+        if not tasks:
+            break
+        sent += _sendBatch(queue, tasks)
+    return sent
+
+
+def _sendBatch(queue, tasks):
+    """Send one leased batch; return the number of emails sent.
+    Tasks asking for the same email about the same conference are sent
+    once. Tasks of failed emails are left to their lease expiring, so they
+    are retried by a later run until MAX_RETRIES."""
+    done = []       # tasks to delete
+    emails = {}     # (template, to, conferenceKey) -> message
+    owners = {}     # (template, to, conferenceKey) -> tasks
+    for task in tasks:
+        try:
+            msg = json.loads(task.payload)
+            msg['key'] = ndb.Key(urlsafe=msg['conferenceKey'])
+        except Exception, e:
+            logging.error('Dropping malformed email task %s: %s' % (task.name, e))
+            done.append(task)
+            continue
+        if task.retry_count > MAX_RETRIES:
+            logging.error('Dropping email task %s after %d retries'
+                          % (task.name, task.retry_count))
+            done.append(task)
+            continue
+        key = (msg['template'], msg['to'], msg['conferenceKey'])
+        emails.setdefault(key, msg)
+        owners.setdefault(key, []).append(task)
+
+    # load every conference of the batch at once
+    conf_keys = list(set(msg['key'] for msg in emails.values()))
+    confs = dict(zip(conf_keys, ndb.get_multi(conf_keys)))
+
+    outbox = []
+    for key, msg in emails.items():
+        conf = confs[msg['key']]
+        if not conf:
+            # conference deleted meanwhile, nothing to tell
+            done.extend(owners[key])
+            continue
+        try:
+            context = conferenceContext(conf)
+            context.update(msg.get('params') or {})
+            subject, body = renderEmail(msg['template'], context)
+        except Exception, e:
+            # left to its lease expiring, like a failed send
+            logging.error('Error rendering email %s to %s: %s'
+                          % (msg['template'], msg['to'], e))
+            continue
+        outbox.append((key, msg['to'], subject, body))
+
+    failed = _sendAll(outbox)
+    for key, to, subject, body in outbox:
+        if key not in failed:
+            done.extend(owners[key])
+    if done:
+        queue.delete_tasks(done)
+    return len(outbox) - len(failed)
+
+
+def _sendAll(outbox):
+    """Send the rendered emails with at most SEND_CONCURRENCY threads;
+    return the keys of the emails that failed."""
+    sender = 'noreply@%s.appspotmail.com' % app_identity.get_application_id()
+    pending = Queue.Queue()
+    for item in outbox:
+        pending.put(item)
+    failed = set()
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            try:
+                key, to, subject, body = pending.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                mail.send_mail(sender, to, subject, body)
+            except Exception, e:
+                logging.warning('Error sending email to %s: %s' % (to, e))
+                with lock:
+                    failed.add(key)
+
+    threads = [threading.Thread(target=worker)
+               for i in range(min(SEND_CONCURRENCY, len(outbox)))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return failed
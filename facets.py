@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+
+"""facets.py
+
+Number of conferences per city, topic and month, for the search UI.
+The counts live in one ConferenceFacets entity. Conference writes queue
+the change of their facet values as pull tasks; /crons/apply_facets
+leases them in batches, sums them and applies each batch in a single
+transaction, so no write contends on the counts. getConferenceFacets
+reads them from memcache, refreshed after every change.
+
+A delta lost between a commit and its task, or applied twice, makes
+the counts drift; /crons/recount_facets recounts every conference and
+corrects them:
+
+  - it marks its start in a transaction: from then on, deltas queued
+    before it are dropped (the recount sees their conferences), and the
+    facet values a conference had before its first delta queued after it
+    are recorded (deltas carry the conference key and its values before)
+  - it walks the conferences by keys-only pages and reads them with
+    get_multi, which returns their committed values. It counts those not
+    written since its start, keeping their keys in memory, and skips the
+    others
+  - it applies the queued deltas, then in a transaction adds to the
+    stored counts the difference between its count and the counts at its
+    start, and the recorded values of the conferences it didn't count.
+    Every conference then weighs its counted value or its value at the
+    start plus its deltas, never both. The conferences it skipped whose
+    delta is still queued get their recorded value when it is applied.
+
+A conference written in the same instant as the recount start, or
+created just before it and missed by the index of the query, can still
+be off until the next recount; so can the counts of a recount that fails
+after marking its start.
+
+"""
+
+import copy
+import json
+import logging
+import time
+from datetime import datetime
+
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+from caching import MEMCACHE_FACETS_KEY
+from models import Conference
+from models import ConferenceFacets
+
+FACET_QUEUE = 'facets'
+FACET_FIELDS = ('city', 'topics', 'month')
+FACETS_KEY = ndb.Key(ConferenceFacets, 'conferences')
+LEASE_SECONDS = 60
+LEASE_BATCH_SIZE = 1000
+# batches leased per cron run, so a run ends well before the next one
+MAX_LEASE_BATCHES = 10
+RECOUNT_BATCH_SIZE = 500
+
+
+def facetValues(conf):
+    """Return the facet values of a conference: {facet: [values]}."""
+    if conf is None:
+        return {}
+    return {
+        'city': [conf.city] if conf.city else [],
+        'topics': sorted(set(conf.topics or [])),
+        # month 0 means no start date
+        'month': [str(conf.month)] if conf.month else [],
+    }
+
+
+def facetDeltas(before, after):
+    """Return the count changes {facet: {value: delta}} turning the facet
+    values before into after."""
+    deltas = {}
+    for facet in FACET_FIELDS:
+        old, new = set(before.get(facet, ())), set(after.get(facet, ()))
+        changes = dict([(v, -1) for v in old - new] + [(v, 1) for v in new - old])
+        if changes:
+            deltas[facet] = changes
+    return deltas
+
+
+def enqueueFacetChange(conf_key, before, after):
+    """Queue the change of a conference's facet values (from facetValues).
+    Inside a transaction it is only queued once the transaction commits."""
+    deltas = facetDeltas(before, after)
+    if not deltas:
+        return
+    payload = json.dumps({'deltas': deltas, 'time': time.time(),
+                          'conference': conf_key.urlsafe(), 'before': before})
+    ndb.get_context().call_on_commit(lambda: taskqueue.Queue(FACET_QUEUE).add(
+        taskqueue.Task(payload=payload, method='PULL')))
+
+
+def _addTo(counts, deltas):
+    # a removal can be applied before its addition: counts may go below
+    # zero for a while, only the ones back at zero are dropped
+    for facet, changes in deltas.items():
+        values = counts.setdefault(facet, {})
+        for value, delta in changes.items():
+            values[value] = values.get(value, 0) + delta
+            if not values[value]:
+                del values[value]
+
+
+def _negated(counts):
+    return dict((facet, dict((value, -count) for value, count in values.items()))
+                for facet, values in counts.items())
+
+
+@ndb.transactional()
+def _applyBatch(changes):
+    """Add the changes (payloads of enqueueFacetChange) to the counts;
+    return the entity."""
+    facets = FACETS_KEY.get() or ConferenceFacets(key=FACETS_KEY)
+    counts = facets.counts or {}
+    recounted = facets.recountedAt
+    awaited = set(facets.recountAwaited or ())
+    for change in sorted(changes, key=lambda change: change['time']):
+        queued = change['time']
+        if recounted and datetime.utcfromtimestamp(queued) < recounted:
+            continue
+        _addTo(counts, change['deltas'])
+        wsck = change.get('conference')
+        if wsck is None:
+            continue
+        if facets.recountBefore is not None:
+            first = facets.recountBefore.get(wsck)
+            if not first or queued < first[0]:
+                facets.recountBefore[wsck] = [queued, change['before']]
+        elif wsck in awaited:
+            # skipped by the last recount: add its value at the recount start
+            _addTo(counts, facetDeltas({}, change['before']))
+            awaited.discard(wsck)
+    facets.counts = counts
+    facets.recountAwaited = sorted(awaited) or None
+    facets.put()
+    return facets
+
+
+def applyFacetChanges():
+    """Lease and apply the queued facet changes until the queue is empty or
+    MAX_LEASE_BATCHES batches were processed; return the number applied."""
+    queue = taskqueue.Queue(FACET_QUEUE)
+    applied = 0
+    facets = None
+    for i in range(MAX_LEASE_BATCHES):
+        tasks = queue.lease_tasks(LEASE_SECONDS, LEASE_BATCH_SIZE)
+        if not tasks:
+            break
+        changes = []
+        for task in tasks:
+            try:
+                msg = json.loads(task.payload)
+                changes.append({'time': msg['time'], 'deltas': msg['deltas'],
+                                'conference': msg.get('conference'),
+                                'before': msg.get('before')})
+            except Exception, e:
+                logging.error('Dropping malformed facet task %s: %s' % (task.name, e))
+        facets = _applyBatch(changes)
+        queue.delete_tasks(tasks)
+        applied += len(changes)
+    if facets:
+        _cacheFacets(facets)
+    return applied
+
+
+@ndb.transactional()
+def _startRecount(started):
+    """Drop the deltas queued before started and record the values before
+    the next ones from now on; return the counts at this point."""
+    facets = FACETS_KEY.get() or ConferenceFacets(key=FACETS_KEY)
+    facets.recountedAt = started
+    facets.recountBefore = {}
+    facets.recountAwaited = None
+    facets.put()
+    # a copy: the cached entity's counts change with the next batches
+    return copy.deepcopy(facets.counts or {})
+
+
+@ndb.transactional()
+def _correctCounts(counts, base, counted, skipped):
+    """Add the difference between the recounted counts and the counts at
+    the recount start, and the values before their deltas of the written
+    conferences that weren't counted, to the stored counts; return the
+    entity."""
+    facets = FACETS_KEY.get() or ConferenceFacets(key=FACETS_KEY)
+    corrected = facets.counts or {}
+    _addTo(corrected, counts)
+    _addTo(corrected, _negated(base))
+    before = facets.recountBefore or {}
+    for wsck, (queued, values) in before.items():
+        if wsck not in counted:
+            _addTo(corrected, facetDeltas({}, values))
+    facets.counts = corrected
+    facets.recountBefore = None
+    facets.recountAwaited = sorted(skipped - set(before)) or None
+    facets.put()
+    return facets
+
+
+def recountFacets():
+    """Count the facet values of every conference and correct the counts;
+    return the recounted counts."""
+    started = datetime.utcnow()
+    base = _startRecount(started)
+    counts = {}
+    counted, skipped = set(), set()
+    cursor, more = None, True
+    while more:
+        keys, cursor, more = Conference.query().fetch_page(
+            RECOUNT_BATCH_SIZE, start_cursor=cursor, keys_only=True)
+        for key, conf in zip(keys, ndb.get_multi(keys)):
+            if conf is None or (conf.updatedAt and conf.updatedAt >= started):
+                # deleted or written since the start: left to its deltas
+                skipped.add(key.urlsafe())
+                continue
+            counted.add(key.urlsafe())
+            _addTo(counts, facetDeltas({}, facetValues(conf)))
+    # record the values before the deltas queued meanwhile
+    applyFacetChanges()
+    facets = _correctCounts(counts, base, counted, skipped)
+    _cacheFacets(facets)
+    return counts
+
+
+def _cacheFacets(facets):
+    memcache.set(MEMCACHE_FACETS_KEY, (facets.counts or {}, facets.recountedAt))
+
+
+def conferenceFacets():
+    """Return the counts, {facet: {value: count}}, and when they were last
+    recounted. Counts below one are transient and left to the caller."""
+    cached = memcache.get(MEMCACHE_FACETS_KEY)
+    if cached is None:
+        facets = FACETS_KEY.get() or ConferenceFacets(key=FACETS_KEY)
+        cached = (facets.counts or {}, facets.recountedAt)
+        memcache.add(MEMCACHE_FACETS_KEY, cached)
+    return cached
@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+
+"""forms.py
+
+ProtoRPC messages and exceptions of the conference API, kept apart from
+models.py so that the task and cron handlers can use the datastore
+models without loading endpoints and protorpc.
+
+"""
+
+import httplib
+import endpoints
+from protorpc import messages
+
+#------ Exception -------#
+
+class ConflictException(endpoints.ServiceException):
+    """ConflictException -- exception mapped to HTTP 409 response"""
+    http_status = httplib.CONFLICT
+
+#------ Profile -------#
+
+class ProfileMiniForm(messages.Message):
+    """ProfileMiniForm -- update Profile form message"""
+    displayName = messages.StringField(1)
+    teeShirtSize = messages.EnumField('TeeShirtSize', 2)
+
+class ProfileForm(messages.Message):
+    """ProfileForm -- Profile outbound form message"""
+    displayName = messages.StringField(1)
+    mainEmail = messages.StringField(2)
+    teeShirtSize = messages.EnumField('TeeShirtSize', 3)
+    conferenceKeysToAttend = messages.StringField(4, repeated=True)
+    sessionWishlist = messages.StringField(5, repeated=True)
+
+#------ Messages -------#
+
+class StringMessage(messages.Message):
+    """StringMessage-- outbound (single) string message"""
+    data = messages.StringField(1, required=True)
+    etag = messages.StringField(2)
+    notModified = messages.BooleanField(3)
+
+class BooleanMessage(messages.Message):
+    """BooleanMessage-- outbound Boolean value message"""
+    data = messages.BooleanField(1)
+
+class QueryForm(messages.Message):
+    """QueryForm --  query inbound form message"""
+    field = messages.StringField(1)
+    operator = messages.StringField(2)
+    value = messages.StringField(3)
+    '''entity = messages.StringField(4)'''
+
+class QueryForms(messages.Message):
+    """QueryForms -- multiple QueryForm inbound form message"""
+    filters = messages.MessageField(QueryForm, 1, repeated=True)
+    explain = messages.BooleanField(2)
+
+class QueryExplainForm(messages.Message):
+    """QueryExplainForm -- how a query ran, outbound form message"""
+    datastoreFilters = messages.StringField(1, repeated=True)
+    memoryFilters   = messages.StringField(2, repeated=True)
+    orders          = messages.StringField(3, repeated=True)
+    projection      = messages.StringField(4, repeated=True)
+    index           = messages.StringField(5)
+    indexDeclared   = messages.BooleanField(6)
+    scanned         = messages.IntegerField(7)
+    returned        = messages.IntegerField(8)
+
+#------ Conference -------#
+
+class ConferenceForm(messages.Message):
+    """ConferenceForm -- Conference outbound form message"""
+    name            = messages.StringField(1)
+    description     = messages.StringField(2)
+    organizerUserId = messages.StringField(3)
+    topics          = messages.StringField(4, repeated=True)
+    city            = messages.StringField(5)
+    startDate       = messages.StringField(6) #DateTimeField()
+    month           = messages.IntegerField(7)
+    maxAttendees    = messages.IntegerField(8)
+    seatsAvailable  = messages.IntegerField(9)
+    featuredSpeaker = messages.StringField(10)
+    endDate         = messages.StringField(11) #DateTimeField()
+    websafeKey      = messages.StringField(12)
+    organizerDisplayName = messages.StringField(13)
+    etag            = messages.StringField(14)
+    notModified     = messages.BooleanField(15)
+
+class ConferenceForms(messages.Message):
+    """ConferenceForms -- multiple Conference outbound form message"""
+    items = messages.MessageField(ConferenceForm, 1, repeated=True)
+    explain = messages.MessageField(QueryExplainForm, 2)
+
+class ConferenceRangeForms(messages.Message):
+    """ConferenceRangeForms -- conferences in a date range page outbound form message"""
+    items = messages.MessageField(ConferenceForm, 1, repeated=True)
+    cursor = messages.StringField(2)
+
+class WaitlistPositionForm(messages.Message):
+    """WaitlistPositionForm -- place of the user on a conference's waitlist"""
+    registered      = messages.BooleanField(1)
+    position        = messages.IntegerField(2)
+
+class TeeShirtSize(messages.Enum):
+    """TeeShirtSize -- t-shirt size enumeration value"""
+    NOT_SPECIFIED = 1
+    XS_M = 2
+    XS_W = 3
+    S_M = 4
+    S_W = 5
+    M_M = 6
+    M_W = 7
+    L_M = 8
+    L_W = 9
+    XL_M = 10
+    XL_W = 11
+    XXL_M = 12
+    XXL_W = 13
+    XXXL_M = 14
+    XXXL_W = 15
+
+class ConferenceQueryForm(messages.Message):
+    """ConferenceQueryForm -- Conference query inbound form message"""
+    field = messages.StringField(1)
+    operator = messages.StringField(2)
+    value = messages.StringField(3)
+
+class ConferenceQueryForms(messages.Message):
+    """ConferenceQueryForms -- multiple ConferenceQueryForm inbound form message"""
+    filters = messages.MessageField(ConferenceQueryForm, 1, repeated=True)
+    fields = messages.StringField(2, repeated=True)
+    explain = messages.BooleanField(3)
+
+#------ Session -------#
+
+class SessionForm(messages.Message):
+    """SessionForm -- Session outbound form message"""
+    name            = messages.StringField(1)
+    highlights      = messages.StringField(2)
+    speaker         = messages.StringField(3, repeated=True)
+    duration        = messages.StringField(4)  # DateTimeField()
+    typeOfSession   = messages.StringField(5)
+    date            = messages.StringField(6)  # DateTimeField()
+    start           = messages.StringField(7)  # DateTimeField()
+    websafeKey      = messages.StringField(8)
+
+class SessionForms(messages.Message):
+    """SessionForms -- multiple Session outbound form message"""
+    items = messages.MessageField(SessionForm, 1, repeated=True)
+    etag = messages.StringField(2)
+    notModified = messages.BooleanField(3)
+    explain = messages.MessageField(QueryExplainForm, 4)
+
+class AgendaConflictForm(messages.Message):
+    """AgendaConflictForm -- sessions of a day overlapping in time"""
+    websafeSessionKeys = messages.StringField(1, repeated=True)
+    start           = messages.StringField(2)
+    end             = messages.StringField(3)
+
+class AgendaDayForm(messages.Message):
+    """AgendaDayForm -- the wishlist sessions of one date"""
+    date            = messages.StringField(1)
+    sessions        = messages.MessageField(SessionForm, 2, repeated=True)
+    conflicts       = messages.MessageField(AgendaConflictForm, 3, repeated=True)
+
+class AgendaForm(messages.Message):
+    """AgendaForm -- the user's agenda outbound form message"""
+    days            = messages.MessageField(AgendaDayForm, 1, repeated=True)
+    conflicts       = messages.IntegerField(2)
+
+class SessionQueryForm(messages.Message):
+    """SessionQueryForm -- Session query inbound form message"""
+    field = messages.StringField(1)
+    operator = messages.StringField(2)
+    value = messages.StringField(3)
+
+class SessionQueryForms(messages.Message):
+    """SessionQueryForms -- multiple SessionQueryForm inbound form message"""
+    filters = messages.MessageField(SessionQueryForm, 1, repeated=True)
+
+#------ Speaker -------#
+
+class SpeakerForm(messages.Message):
+    """SpeakerForm -- Speaker outbound form message"""
+    name            = messages.StringField(1)
+    biography       = messages.StringField(2)
+    specialty       = messages.StringField(3, repeated=True)
+    company       = messages.StringField(4)
+    websafeKey      = messages.StringField(5)
+
+class SpeakerForms(messages.Message):
+    """SpeakerForms -- multiple Speaker outbound form message"""
+    items = messages.MessageField(SpeakerForm, 1, repeated=True)
+    explain = messages.MessageField(QueryExplainForm, 2)
+
+#------ Notifications -------#
+
+class DeletionJobForm(messages.Message):
+    """DeletionJobForm -- conference deletion progress outbound form message"""
+    websafeConferenceKey = messages.StringField(1)
+    phase           = messages.StringField(2)
+    attendeesUpdated = messages.IntegerField(3)
+    wishlistsUpdated = messages.IntegerField(4)
+    entitiesDeleted = messages.IntegerField(5)
+    done            = messages.BooleanField(6)
+
+#------ Autocomplete -------#
+
+class SuggestionForm(messages.Message):
+    """SuggestionForm -- one name matching a typeahead prefix"""
+    name            = messages.StringField(1)
+    websafeKey      = messages.StringField(2)
+
+class SuggestionForms(messages.Message):
+    """SuggestionForms -- multiple SuggestionForm outbound form message"""
+    items = messages.MessageField(SuggestionForm, 1, repeated=True)
+
+#------ Full-text search -------#
+
+class SessionSearchForms(messages.Message):
+    """SessionSearchForms -- search results page outbound form message"""
+    items = messages.MessageField(SessionForm, 1, repeated=True)
+    cursor = messages.StringField(2)
+    total = messages.IntegerField(3)
+
+#------ Facets -------#
+
+class FacetCountForm(messages.Message):
+    """FacetCountForm -- number of conferences with one facet value"""
+    value           = messages.StringField(1)
+    count           = messages.IntegerField(2)
+
+class ConferenceFacetsForm(messages.Message):
+    """ConferenceFacetsForm -- conference counts per facet outbound form message"""
+    city            = messages.MessageField(FacetCountForm, 1, repeated=True)
+    topics          = messages.MessageField(FacetCountForm, 2, repeated=True)
+    month           = messages.MessageField(FacetCountForm, 3, repeated=True)
+    recountedAt     = messages.StringField(4)
+
+#------ Trending -------#
+
+class TrendingConferenceForm(messages.Message):
+    """TrendingConferenceForm -- a conference and its recent registrations"""
+    conference      = messages.MessageField(ConferenceForm, 1)
+    registrations   = messages.IntegerField(2)
+
+class TrendingConferenceForms(messages.Message):
+    """TrendingConferenceForms -- trending conferences outbound form message"""
+    items = messages.MessageField(TrendingConferenceForm, 1, repeated=True)
+    window = messages.StringField(2)
+    computedAt = messages.StringField(3)
+
+#------ Change feed -------#
+
+class ChangeForm(messages.Message):
+    """ChangeForm -- one changed (or deleted) entity of the change feed"""
+    kind            = messages.StringField(1)
+    websafeKey      = messages.StringField(2)
+    deleted         = messages.BooleanField(3)
+    updatedAt       = messages.StringField(4)
+    conference      = messages.MessageField(ConferenceForm, 5)
+    session         = messages.MessageField(SessionForm, 6)
+    speaker         = messages.MessageField(SpeakerForm, 7)
+
+class ChangeForms(messages.Message):
+    """ChangeForms -- change feed page outbound form message"""
+    items = messages.MessageField(ChangeForm, 1, repeated=True)
+    cursor = messages.StringField(2)
+    more = messages.BooleanField(3)
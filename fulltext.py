@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+
+"""fulltext.py
+
+Keyword search over sessions with an inverted index in the datastore, no
+external search service needed. A session's document is its name (terms
+counted NAME_WEIGHT times), highlights and its conference's description;
+the text is normalised, split into words, stripped of stop words and
+stemmed into terms.
+
+Every term has POSTING_SHARDS Posting entities (keyed term|shard) listing
+the sessions holding it with their term frequency, a session going to
+the shard picked by a hash of its key. Sharding bounds the size of the
+postings of common terms and spreads their writes over several entity
+groups. A SearchDocument per session keeps its indexed frequencies, so
+reindexing only rewrites the postings that changed. Indexing runs in
+/tasks/index_sessions tasks queued on session writes, deletions and
+conference description changes. A search gets every shard of its terms,
+merges them, intersects the terms and ranks the sessions by the sum of
+their term frequencies.
+
+"""
+
+import logging
+import zlib
+
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+from autocomplete import normalise
+from models import Posting
+from models import SearchDocument
+from models import Session
+
+NAME_WEIGHT = 2
+MIN_TERM_LENGTH = 2
+# sessions per indexing task (and task queue batch add)
+INDEX_BATCH_SIZE = 100
+# a shard holds about 20000 sessions under the 1MB entity limit
+POSTING_SHARDS = 16
+DEFAULT_RESULTS = 20
+MAX_RESULTS = 50
+
+STOP_WORDS = frozenset("""
+a an and are as at be but by for from has have how i in into is it its of on
+or our so that the their this to was we what when where which who will with
+you your
+""".split())
+
+# suffixes stripped by stem(), longest first: (suffix, replacement)
+SUFFIXES = [
+    ('ational', 'ate'), ('ization', 'ize'), ('fulness', 'ful'),
+    ('iveness', 'ive'), ('ousness', 'ous'), ('tional', 'tion'),
+    ('ations', 'ate'), ('ation', 'ate'), ('ements', ''), ('ement', ''),
+    ('ments', ''), ('ment', ''), ('ness', ''), ('ings', ''), ('ing', ''),
+    ('ies', 'y'), ('ied', 'y'), ('ers', ''), ('er', ''), ('ed', ''),
+    ('ly', ''), ('es', ''), ('s', ''),
+]
+VOWELS = frozenset('aeiouy')
+
+
+def stem(word):
+    """Strip the common English suffixes of a word (a light Porter stemmer):
+    'programming', 'programs' and 'programmed' all give 'program', 'engine'
+    and 'engines' both 'engin'."""
+    if len(word) <= 3 or word.isdigit():
+        return word
+    for suffix, replacement in SUFFIXES:
+        if not word.endswith(suffix) or word.endswith('ss'):
+            continue
+        base = word[:-len(suffix)]
+        if suffix == 'es' and not base.endswith(('s', 'x', 'z', 'ch', 'sh')):
+            # 'engines' loses its s only
+            continue
+        # what is left must keep a vowel: 'sing' stays 'sing'
+        if len(base) < 3 or not VOWELS & set(base):
+            continue
+        word = base + replacement
+        # 'programm' -> 'program'
+        if suffix in ('ing', 'ings', 'ed', 'er', 'ers') and \
+                word[-1] == word[-2] and word[-1] not in 'lsz':
+            word = word[:-1]
+        break
+    if len(word) > 4 and word.endswith('e'):
+        word = word[:-1]
+    return word
+
+
+def terms(text):
+    """Return the terms of a text, in order, repeats included."""
+    return [stem(word) for word in normalise(text).split()
+            if len(word) >= MIN_TERM_LENGTH and word not in STOP_WORDS]
+
+
+def documentTerms(session, conference=None):
+    """Return the term frequencies of a session's document."""
+    frequencies = {}
+    fields = [(session.name, NAME_WEIGHT), (session.highlights, 1)]
+    if conference:
+        fields.append((conference.description, 1))
+    for text, weight in fields:
+        for term in terms(text):
+            frequencies[term] = frequencies.get(term, 0) + weight
+    return frequencies
+
+
+def postingKey(term, session_key):
+    """Return the key of the Posting shard of term holding session_key."""
+    shard = (zlib.crc32(session_key.urlsafe()) & 0xffffffff) % POSTING_SHARDS
+    return ndb.Key(Posting, '%s|%d' % (term, shard))
+
+
+def enqueueIndexing(session_keys=(), conference_key=None):
+    """Queue the (re)indexing of sessions, or of all a conference's ones.
+    Inside a transaction they are only queued once it commits, so the
+    tasks index the committed text."""
+    tasks = []
+    if conference_key:
+        tasks.append(taskqueue.Task(url='/tasks/index_sessions',
+                                    params={'conference': conference_key.urlsafe()}))
+    keys = [key.urlsafe() for key in session_keys]
+    for i in range(0, len(keys), INDEX_BATCH_SIZE):
+        tasks.append(taskqueue.Task(url='/tasks/index_sessions',
+            params={'sessions': ','.join(keys[i:i + INDEX_BATCH_SIZE])}))
+    def add():
+        for i in range(0, len(tasks), INDEX_BATCH_SIZE):
+            taskqueue.Queue().add(tasks[i:i + INDEX_BATCH_SIZE])
+    ndb.get_context().call_on_commit(add)
+
+
+def indexConference(conference_key):
+    """Reindex every session of a conference."""
+    keys = Session.query(ancestor=conference_key).fetch(keys_only=True)
+    for key in keys:
+        indexSession(key)
+
+
+def indexSession(session_key, rebuild=False):
+    """Bring the postings of a session up to date with its text; remove it
+    from the index if it was deleted. rebuild rewrites every posting of
+    the session, not only the ones its SearchDocument says changed."""
+    doc_key = ndb.Key(SearchDocument, session_key.urlsafe())
+    session, doc = ndb.get_multi([session_key, doc_key])
+    frequencies = {}
+    if session:
+        frequencies = documentTerms(session, session_key.parent().get())
+    indexed = dict(zip(doc.terms, doc.frequencies)) if doc and not rebuild else {}
+    changed = [term for term in set(indexed) | set(frequencies)
+               if indexed.get(term) != frequencies.get(term)]
+    # every posting in its own transaction: a document has more terms
+    # than a cross-group transaction can hold
+    futures = [_updatePosting(term, session_key, frequencies.get(term, 0))
+               for term in changed]
+    ndb.Future.wait_all(futures)
+    for future in futures:
+        # raise the first failure so the task is retried
+        future.check_success()
+    if frequencies:
+        names = sorted(frequencies)
+        SearchDocument(key=doc_key, terms=names,
+                       frequencies=[frequencies[t] for t in names]).put()
+    elif doc:
+        doc_key.delete()
+    logging.debug('Indexed %s: %d terms changed' % (session_key, len(changed)))
+
+
+@ndb.transactional_tasklet
+def _updatePosting(term, session_key, frequency):
+    """Set (or remove, for frequency 0) a session in a term's posting."""
+    key = postingKey(term, session_key)
+    existing = yield key.get_async()
+    posting = existing or Posting(key=key)
+    entries = dict(zip(posting.sessions, posting.frequencies))
+    if frequency:
+        entries[session_key] = frequency
+    else:
+        entries.pop(session_key, None)
+    if entries:
+        posting.sessions = sorted(entries)
+        posting.frequencies = [entries[k] for k in posting.sessions]
+        yield posting.put_async()
+    elif existing:
+        yield key.delete_async()
+
+
+def search(text, offset=0, limit=DEFAULT_RESULTS):
+    """Return a page of the sessions holding every term of text, best
+    ranked first, from offset: (sessions, next offset or None, matches)."""
+    wanted = sorted(set(terms(text)))
+    if not wanted:
+        return [], None, 0
+    shards = ndb.get_multi([ndb.Key(Posting, '%s|%d' % (term, shard))
+                            for term in wanted for shard in range(POSTING_SHARDS)])
+    # {session key: frequency} of every term, merged from its shards
+    postings = []
+    for i in range(0, len(shards), POSTING_SHARDS):
+        frequencies = {}
+        for posting in shards[i:i + POSTING_SHARDS]:
+            if posting:
+                frequencies.update(zip(posting.sessions, posting.frequencies))
+        if not frequencies:
+            return [], None, 0
+        postings.append(frequencies)
+    # intersect from the shortest posting
+    postings.sort(key=len)
+    scores = dict(postings[0])
+    for frequencies in postings[1:]:
+        scores = dict((key, score + frequencies[key])
+                      for key, score in scores.items() if key in frequencies)
+        if not scores:
+            return [], None, 0
+    ranked = sorted(scores, key=lambda key: (-scores[key], key.urlsafe()))
+    limit = min(limit or DEFAULT_RESULTS, MAX_RESULTS)
+    page = ranked[offset:offset + limit]
+    end = offset + len(page)
+    # sessions deleted since they were indexed are skipped
+    return ([s for s in ndb.get_multi(page) if s],
+            end if end < len(ranked) else None, len(ranked))
@@ -0,0 +1,262 @@
+#!/usr/bin/env python
+
+"""indexadvisor.py
+
+Composite index advice from the query shapes seen in production.
+_getQuery and _getGenericQuery record the shape of every query (kind,
+equality properties, sort orders) in per instance counts, added to
+QueryShape entities at most every FLUSH_SECONDS, one transaction per
+shape; the counts of a failed transaction wait for the next flush.
+
+advise() then computes a small index set serving every observed shape,
+for the advised kinds: per group of shapes sharing their sort orders,
+either one index per set of equality properties, or one index per
+equality property merged by a zigzag merge join at query time, whichever
+writes fewer index rows per put (sampled from the stored entities). It
+flags the autogenerated indexes serving no observed shape (unused) or
+replaced by the proposal (redundant). /admin/indexes serves the report;
+/admin/indexes?format=yaml the proposed index.yaml, with the advised
+indexes above the AUTOGENERATED marker so dev_appserver keeps them.
+
+"""
+
+import logging
+import threading
+import time
+
+from google.appengine.ext import ndb
+
+from indexes import INDEX_YAML
+from indexes import describeIndex
+from indexes import indexMatches
+from indexes import mergeJoinIndexes
+from indexes import parseIndexes
+from indexes import requiredIndex
+from indexes import requiresComposite
+from models import Conference
+from models import QueryShape
+from models import Session
+from models import Speaker
+
+FLUSH_SECONDS = 60
+AUTOGENERATED_MARKER = '# AUTOGENERATED'
+# kinds whose queries all go through _getQuery or _getGenericQuery
+ADVISED_KINDS = {'Conference': Conference, 'Session': Session, 'Speaker': Speaker}
+# entities sampled per kind to estimate the index rows written per put
+SAMPLE_SIZE = 100
+
+_lock = threading.Lock()
+_pending = {}       # shape id -> (kind, equalities, orders, count)
+_lastFlush = [time.time()]
+
+
+def shapeId(kind, equalities, orders):
+    """Return the description identifying a query shape."""
+    return '%s|%s|%s' % (kind, ','.join(equalities),
+                         ','.join('%s %s' % order for order in orders))
+
+
+def recordQueryShape(kind, equalities=(), orders=()):
+    """Count one query of the given shape; flush the counts when due."""
+    equalities = sorted(set(equalities))
+    orders = [(name, direction or 'asc') for name, direction in orders]
+    sid = shapeId(kind, equalities, orders)
+    with _lock:
+        count = _pending[sid][3] if sid in _pending else 0
+        _pending[sid] = (kind, equalities, orders, count + 1)
+        due = time.time() - _lastFlush[0] >= FLUSH_SECONDS
+        if due:
+            counts = dict(_pending)
+            _pending.clear()
+            _lastFlush[0] = time.time()
+    if due:
+        flush(counts)
+
+
+@ndb.transactional_tasklet
+def _addCount(sid, kind, equalities, orders, count):
+    """Add count to the QueryShape of sid, read again in the transaction."""
+    key = ndb.Key(QueryShape, sid)
+    shape = yield key.get_async()
+    if not shape:
+        shape = QueryShape(key=key, kind=kind, equalities=equalities,
+            orders=['%s %s' % order for order in orders])
+    shape.count += count
+    yield shape.put_async()
+
+
+def flush(counts):
+    """Add the counts to the QueryShape entities, one transaction per shape
+    in parallel; put the counts that failed back for the next flush."""
+    futures = [(sid, _addCount(sid, *counts[sid])) for sid in counts]
+    ndb.Future.wait_all([future for sid, future in futures])
+    failed = [sid for sid, future in futures if future.get_exception()]
+    if not failed:
+        return
+    # advice is best effort, never fail the request
+    logging.warning('Could not flush %d query shapes: %s'
+                    % (len(failed), dict(futures)[failed[0]].get_exception()))
+    with _lock:
+        for sid in failed:
+            kind, equalities, orders, count = counts[sid]
+            pending = _pending[sid][3] if sid in _pending else 0
+            _pending[sid] = (kind, equalities, orders, pending + count)
+
+
+def observedShapes():
+    """Return the recorded shapes: (kind, equalities, orders, count)."""
+    return [(s.kind, s.equalities,
+             [tuple(order.split(' ')) for order in s.orders], s.count)
+            for s in QueryShape.query()]
+
+
+def valueCounts(model, size=SAMPLE_SIZE):
+    """Return the mean number of values of the repeated properties of a
+    model, from a sample of its entities (1 for the others)."""
+    sample = model.query().fetch(size)
+    counts = {}
+    for name, prop in model._properties.items():
+        if prop._repeated and sample:
+            counts[name] = float(sum(len(getattr(e, name)) for e in sample)) / len(sample)
+    return counts
+
+
+def indexRows(spec, counts):
+    """Return the index rows a put writes to the index, on average."""
+    rows = 1.0
+    for name, direction in spec[2]:
+        rows *= counts.get(name, 1.0)
+    return rows
+
+
+def splitIndexYaml(text):
+    """Return the manual and autogenerated parts of an index.yaml."""
+    at = text.find(AUTOGENERATED_MARKER)
+    if at < 0:
+        return text, ''
+    return text[:at], text[at:]
+
+
+def _servingIndexes(shape, specs):
+    """Return the indexes of specs serving a shape (exactly, or by merge
+    join), or None."""
+    kind, equalities, orders = shape[:3]
+    for spec in specs:
+        if indexMatches(spec, kind, False, equalities, orders, ()):
+            return [spec]
+    return mergeJoinIndexes(kind, False, equalities, orders, specs)
+
+
+def _proposeGroup(kind, orders, equality_sets, counts):
+    """Return the cheapest index set serving shapes sharing sort orders."""
+    exact = [requiredIndex(kind, False, eq, orders) for eq in equality_sets]
+    singles = sorted(set(name for eq in equality_sets for name in eq))
+    zigzag = [requiredIndex(kind, False, [name], orders) for name in singles]
+    if () in equality_sets:
+        zigzag.append(requiredIndex(kind, False, (), orders))
+    cost = lambda specs: sum(indexRows(spec, counts) for spec in specs)
+    return zigzag if cost(zigzag) < cost(exact) else exact
+
+
+def advise(shapes, text, counts=None):
+    """Return the advice for the observed shapes and the index.yaml text:
+    {'proposed', 'unused', 'redundant', 'shapes', 'rowsPerPut', 'yaml'}.
+    counts maps a kind to its valueCounts (sampled when missing)."""
+    counts = counts if counts is not None else \
+        dict((kind, valueCounts(model)) for kind, model in ADVISED_KINDS.items())
+    manual_text, auto_text = splitIndexYaml(text)
+    manual = parseIndexes(manual_text)
+    # the entries below the marker continue the list of the manual part
+    auto = parseIndexes('indexes:\n' + auto_text)
+    advised = [s for s in auto if s[0] in ADVISED_KINDS and not s[1]]
+    kept = [s for s in auto if s not in advised]
+
+    # shapes that need a composite index the manual part doesn't provide
+    groups = {}
+    for kind, equalities, orders, count in shapes:
+        if kind not in ADVISED_KINDS or \
+                not requiresComposite(False, equalities, orders):
+            continue
+        if _servingIndexes((kind, equalities, orders), manual):
+            continue
+        group = groups.setdefault((kind, tuple(orders)), set())
+        group.add(tuple(sorted(equalities)))
+    proposed = []
+    for (kind, orders), equality_sets in sorted(groups.items()):
+        for spec in _proposeGroup(kind, orders, sorted(equality_sets),
+                                  counts.get(kind, {})):
+            if spec not in proposed:
+                proposed.append(spec)
+
+    used = set()
+    report = []
+    for kind, equalities, orders, count in shapes:
+        if requiresComposite(False, equalities, orders):
+            served = _servingIndexes((kind, equalities, orders), manual + advised)
+            used.update(served or ())
+            served = [describeIndex(s) for s in served or ()]
+            after = _servingIndexes((kind, equalities, orders), manual + proposed)
+            after = [describeIndex(s) for s in after or ()]
+        else:
+            served = after = ['built-in']
+        report.append({
+            'kind': kind,
+            'equalities': list(equalities),
+            'orders': ['%s %s' % order for order in orders],
+            'count': count,
+            'servedBy': served,
+            'proposed': after,
+        })
+    rows = {}
+    for kind in ADVISED_KINDS:
+        before = [s for s in manual + auto if s[0] == kind]
+        after = [s for s in manual + kept + proposed if s[0] == kind]
+        rows[kind] = {
+            'current': sum(indexRows(s, counts.get(kind, {})) for s in before),
+            'proposed': sum(indexRows(s, counts.get(kind, {})) for s in after),
+        }
+    return {
+        'proposed': [describeIndex(s) for s in proposed],
+        'unused': [describeIndex(s) for s in advised
+                   if s not in used and s not in proposed],
+        'redundant': [describeIndex(s) for s in advised
+                      if s in used and s not in proposed],
+        'shapes': sorted(report, key=lambda r: -r['count']),
+        'rowsPerPut': rows,
+        'yaml': proposedYaml(manual_text, auto_text, proposed, kept),
+    }
+
+
+def formatIndex(spec):
+    """Return an index spec as an index.yaml entry."""
+    kind, ancestor, props = spec
+    lines = ['- kind: %s' % kind]
+    if ancestor:
+        lines.append('  ancestor: yes')
+    lines.append('  properties:')
+    for name, direction in props:
+        lines.append('  - name: %s' % name)
+        if direction == 'desc':
+            lines.append('    direction: desc')
+    return '\n'.join(lines) + '\n'
+
+
+def proposedYaml(manual_text, auto_text, proposed, kept):
+    """Return index.yaml with the proposed indexes appended to the manual
+    part and only the kept ones left in the autogenerated part."""
+    header = auto_text.split('\n- kind')[0].rstrip() + '\n'
+    parts = [manual_text.rstrip() + '\n']
+    if proposed:
+        parts.append('\n# Proposed by indexadvisor.py from the observed query '
+                     'shapes.\n')
+        parts.extend('\n' + formatIndex(s) for s in proposed)
+    parts.append('\n' + header)
+    parts.extend('\n' + formatIndex(s) for s in kept)
+    return ''.join(parts)
+
+
+def currentAdvice(path=INDEX_YAML):
+    """Return the advice for the recorded shapes and the deployed index.yaml."""
+    with open(path) as f:
+        text = f.read()
+    return advise(observedShapes(), text)
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+
+"""indexes.py
+
+Knowledge about the composite indexes declared in index.yaml: which index a
+query shape needs and whether the deployed index set can serve it.
+
+"""
+
+import os
+
+import yaml
+
+INDEX_YAML = os.path.join(os.path.dirname(__file__), 'index.yaml')
+
+_declared = None
+
+
+def indexSpec(kind, ancestor=False, properties=()):
+    """Return the hashable form of an index: (kind, ancestor, properties),
+    properties being a tuple of (name, direction) pairs."""
+    return (kind, bool(ancestor),
+            tuple((name, direction or 'asc') for name, direction in properties))
+
+
+def loadIndexes(path=INDEX_YAML):
+    """Parse index.yaml into a list of index specs."""
+    with open(path) as f:
+        return parseIndexes(f.read())
+
+
+def parseIndexes(text):
+    """Parse the text of an index.yaml into a list of index specs."""
+    doc = yaml.safe_load(text) or {}
+    specs = []
+    for index in doc.get('indexes') or []:
+        props = [(p['name'], p.get('direction', 'asc'))
+                 for p in index.get('properties') or []]
+        # yaml reads "ancestor: yes" as True already
+        specs.append(indexSpec(index['kind'], index.get('ancestor'), props))
+    return specs
+
+
+def declaredIndexes():
+    """Return the index specs of index.yaml, parsed once per instance."""
+    global _declared
+    if _declared is None:
+        _declared = loadIndexes()
+    return _declared
+
+
+def requiresComposite(ancestor=False, equalities=(), orders=(), projection=()):
+    """Check if a query shape can't be served by the built-in indexes."""
+    equalities = set(equalities)
+    projection = set(projection)
+    order_names = set(name for name, direction in orders)
+    # equality filters alone (with or without ancestor) use a merge join
+    if not orders and not projection:
+        return False
+    # a single property, no ancestor: the built-in property index
+    if not ancestor and len(equalities | order_names | projection) <= 1:
+        return False
+    return True
+
+
+def indexMatches(spec, kind, ancestor, equalities, orders, projection):
+    """Check if the index spec serves the query shape.
+    Equality properties come first in any order, then the sort orders in
+    order, then the remaining projected properties in any order."""
+    s_kind, s_ancestor, props = spec
+    if s_kind != kind or s_ancestor != bool(ancestor):
+        return False
+    equalities = set(equalities)
+    orders = [(name, direction or 'asc') for name, direction in orders]
+    rest = set(projection) - equalities - set(name for name, d in orders)
+    if len(props) != len(equalities) + len(orders) + len(rest):
+        return False
+    n = len(equalities)
+    m = n + len(orders)
+    return set(name for name, d in props[:n]) == equalities and \
+        list(props[n:m]) == orders and \
+        set(name for name, d in props[m:]) == rest
+
+
+def findIndex(kind, ancestor=False, equalities=(), orders=(), projection=()):
+    """Return the declared index serving the query shape, None for built-in
+    indexes, or raise LookupError if the query would need a missing index."""
+    if not requiresComposite(ancestor, equalities, orders, projection):
+        return None
+    for spec in declaredIndexes():
+        if indexMatches(spec, kind, ancestor, equalities, orders, projection):
+            return spec
+    raise LookupError('No index for %s query' % kind)
+
+
+def mergeJoinIndexes(kind, ancestor=False, equalities=(), orders=(), specs=None):
+    """Return the indexes (declared ones by default) whose merge join
+    (zigzag) serves a query shape without projection, or None. Each ends
+    with the sort orders after some of the equality properties; together
+    they hold all of them."""
+    specs = declaredIndexes() if specs is None else specs
+    equalities = set(equalities)
+    orders = [(name, direction or 'asc') for name, direction in orders]
+    joined = []
+    covered = set()
+    for spec in specs:
+        s_kind, s_ancestor, props = spec
+        n = len(props) - len(orders)
+        if s_kind != kind or s_ancestor != bool(ancestor) or n < 1:
+            continue
+        names = set(name for name, direction in props[:n])
+        if list(props[n:]) == orders and names <= equalities \
+                and not names <= covered:
+            joined.append(spec)
+            covered |= names
+    return joined if joined and covered == equalities else None
+
+
+def requiredIndex(kind, ancestor=False, equalities=(), orders=(), projection=()):
+    """Return the spec of the composite index serving a query shape."""
+    orders = [(name, direction or 'asc') for name, direction in orders]
+    ordered = set(name for name, direction in orders)
+    rest = set(projection) - set(equalities) - ordered
+    props = [(name, 'asc') for name in sorted(set(equalities) - ordered)]
+    return indexSpec(kind, ancestor,
+                     props + orders + [(name, 'asc') for name in sorted(rest)])
+
+
+def describeIndex(spec):
+    """Return an index spec as text, e.g. Conference(city, name desc)."""
+    kind, ancestor, props = spec
+    names = ['%s desc' % name if direction == 'desc' else name
+             for name, direction in props]
+    if ancestor:
+        names.insert(0, 'ancestor')
+    return '%s(%s)' % (kind, ', '.join(names))
+
+
+def projectionFor(cls, properties, equalities=(), orders=(), ancestor=False):
+    """Return the property names to project a query of cls on, or None when
+    the query must load full entities.
+    Properties fixed by an equality filter are left out of the projection
+    (the datastore forbids projecting them; the caller knows their value)."""
+    for name in properties:
+        prop = cls._properties.get(name)
+        # repeated properties return one result per value, unindexed
+        # ones can't be projected at all
+        if prop is None or prop._repeated or not prop._indexed:
+            return None
+    projection = set(properties) - set(equalities)
+    if not projection:
+        return None
+    try:
+        findIndex(cls._get_kind(), ancestor, equalities, orders, projection)
+    except LookupError:
+        return None
+    return sorted(projection)
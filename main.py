@@ -12,24 +12,31 @@ created by wesc on 2014 may 24
 
 __author__ = 'wesc+api@google.com (Wesley Chun)'
 
+import warmup   # first, to time the instance start
+import json
+import time
 import webapp2
-from google.appengine.api import app_identity
-from google.appengine.api import mail
-from conference import ConferenceApi
 
 import logging  # loggins de erro
 
+# Handlers import what they use when they run: a task or cron request
+# must not pay for loading the endpoints API and every model.
+
 
 class SetAnnouncementHandler(webapp2.RequestHandler):
     def get(self):
         """Set Announcement in Memcache."""
-        ConferenceApi._cacheAnnouncement()
+        from caching import cacheAnnouncement
+        cacheAnnouncement()
         self.response.set_status(204)
 
 
 class SendConfirmationEmailHandler(webapp2.RequestHandler):
     def post(self):
-        """Send email confirming Conference creation."""
+        """Send email confirming Conference creation.
+        Kept to drain the push tasks queued before the email pull queue."""
+        from google.appengine.api import app_identity
+        from google.appengine.api import mail
         mail.send_mail(
             'noreply@%s.appspotmail.com' % (
                 app_identity.get_application_id()),     # from
@@ -41,9 +48,208 @@ class SendConfirmationEmailHandler(webapp2.RequestHandler):
         )
 
 
+class SendEmailsHandler(webapp2.RequestHandler):
+    def get(self):
+        """Send the emails waiting in the email pull queue."""
+        from emails import sendPendingEmails
+        sent = sendPendingEmails()
+        logging.info('Sent %d emails' % sent)
+        self.response.set_status(204)
+
+
+class ApplyFacetsHandler(webapp2.RequestHandler):
+    def get(self):
+        """Apply the queued changes to the conference facet counts."""
+        from facets import applyFacetChanges
+        applied = applyFacetChanges()
+        logging.info('Applied %d facet changes' % applied)
+        self.response.set_status(204)
+
+
+class RecountFacetsHandler(webapp2.RequestHandler):
+    def get(self):
+        """Recount the conference facets from scratch."""
+        from facets import recountFacets
+        counts = recountFacets()
+        logging.info('Recounted facets: %s' % ', '.join(
+            '%d %s values' % (len(values), facet) for facet, values in sorted(counts.items())))
+        self.response.set_status(204)
+
+
+class TrendingHandler(webapp2.RequestHandler):
+    def get(self):
+        """Merge the registration counters into the trending conferences."""
+        from trending import mergeShards
+        trending = mergeShards()
+        logging.info('Trending: %s' % ', '.join(
+            '%d conferences this %s' % (len(top), window)
+            for window, top in sorted(trending.top.items())))
+        self.response.set_status(204)
+
+
+class RecommendationsHandler(webapp2.RequestHandler):
+    def get(self):
+        """Start recomputing the session recommendations."""
+        from recommendations import startRecommendationJob
+        job = startRecommendationJob()
+        logging.info('Recommendation job %s at step %d' % (job.key.id(), job.step))
+        self.response.set_status(204)
+
+
+class AnalyticsHandler(webapp2.RequestHandler):
+    def get(self):
+        """Start the analytics job."""
+        from analytics import startAnalyticsJob
+        job = startAnalyticsJob()
+        logging.info('Analytics job %s at step %d' % (job.key.id(), job.step))
+        self.response.set_status(204)
+
+
+class NotifyAttendeesHandler(webapp2.RequestHandler):
+    def post(self):
+        """Notify one page of the attendees of a conference."""
+        from google.appengine.ext import ndb
+        from notifications import notifyAttendeesPage
+        notifyAttendeesPage(ndb.Key(urlsafe=self.request.get('job')),
+                            int(self.request.get('page')))
+        self.response.set_status(204)
+
+
+class DeleteConferenceHandler(webapp2.RequestHandler):
+    def post(self):
+        """Run one step of a conference deletion."""
+        from google.appengine.ext import ndb
+        from deletion import runDeletionStep
+        runDeletionStep(ndb.Key(urlsafe=self.request.get('job')),
+                        int(self.request.get('step')))
+        self.response.set_status(204)
+
+
+class RecommendationStepHandler(webapp2.RequestHandler):
+    def post(self):
+        """Run one step of the session recommendations job."""
+        from google.appengine.ext import ndb
+        from recommendations import runRecommendationStep
+        runRecommendationStep(ndb.Key(urlsafe=self.request.get('job')),
+                              int(self.request.get('step')))
+        self.response.set_status(204)
+
+
+class AnalyticsStepHandler(webapp2.RequestHandler):
+    def post(self):
+        """Run one step of the analytics job."""
+        from google.appengine.ext import ndb
+        from analytics import runAnalyticsStep
+        runAnalyticsStep(ndb.Key(urlsafe=self.request.get('job')),
+                         int(self.request.get('step')))
+        self.response.set_status(204)
+
+
+class IndexSessionsHandler(webapp2.RequestHandler):
+    def post(self):
+        """Update the search index for some sessions, or a conference's."""
+        from google.appengine.ext import ndb
+        from fulltext import indexConference
+        from fulltext import indexSession
+        if self.request.get('conference'):
+            indexConference(ndb.Key(urlsafe=self.request.get('conference')))
+        for key in filter(None, self.request.get('sessions').split(',')):
+            indexSession(ndb.Key(urlsafe=key))
+        self.response.set_status(204)
+
+
+class PromoteWaitlistHandler(webapp2.RequestHandler):
+    def post(self):
+        """Give the free seats of a conference to its waitlist."""
+        from google.appengine.ext import ndb
+        from waitlist import promoteWaitlist
+        promoted = promoteWaitlist(ndb.Key(urlsafe=self.request.get('conference')))
+        logging.info('Promoted %d waitlisted users' % promoted)
+        self.response.set_status(204)
+
+
+class MigrateHandler(webapp2.RequestHandler):
+    def post(self):
+        """Run one batch of a schema migration."""
+        from migrations import runMigrationBatch
+        runMigrationBatch(self.request.get('name'), int(self.request.get('step')))
+        self.response.set_status(204)
+
+
+class MigrationsAdminHandler(webapp2.RequestHandler):
+    def get(self):
+        """Return the progress of every schema migration as JSON."""
+        from migrations import migrationStatus
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(migrationStatus()))
+
+    def post(self):
+        """Start the schema migration named in the request."""
+        from migrations import startMigration
+        try:
+            startMigration(self.request.get('name'))
+        except ValueError, e:
+            self.abort(400, str(e))
+        self.get()
+
+
+class AnalyticsAdminHandler(webapp2.RequestHandler):
+    def get(self):
+        """Return the last analytics snapshot as JSON."""
+        from analytics import latestSnapshot
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(latestSnapshot(), indent=2, sort_keys=True))
+
+    def post(self):
+        """Start the analytics job."""
+        from analytics import startAnalyticsJob
+        startAnalyticsJob()
+        self.get()
+
+
+class StatsAdminHandler(webapp2.RequestHandler):
+    def get(self):
+        """Return the API's per endpoint totals (and the warmups') as JSON."""
+        from apistats import WARMUP_METHOD
+        from apistats import readTotals
+        from conference import ConferenceApi
+        methods = sorted(ConferenceApi.all_remote_methods()) + [WARMUP_METHOD]
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(readTotals(methods), indent=2, sort_keys=True))
+
+
+class IndexAdvisorHandler(webapp2.RequestHandler):
+    def get(self):
+        """Return the index advice for the recorded query shapes as JSON,
+        or the proposed index.yaml with format=yaml."""
+        from indexadvisor import currentAdvice
+        advice = currentAdvice()
+        if self.request.get('format') == 'yaml':
+            self.response.headers['Content-Type'] = 'text/plain'
+            self.response.write(advice['yaml'])
+            return
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(advice, indent=2, sort_keys=True))
+
+
+class WarmupHandler(webapp2.RequestHandler):
+    def get(self):
+        """Warm up a new instance before it gets traffic; return the
+        duration of every step as JSON."""
+        from apistats import recordWarmup
+        from rpcstats import recording
+        started = time.time()
+        with recording() as stats:
+            timings = warmup.warmup()
+        recordWarmup((time.time() - started) * 1000, stats)
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(timings, sort_keys=True))
+
+
 class UpdateFeaturedSpeakerHandler(webapp2.RequestHandler):
     def post(self):
         """Update the featured speaker in Memcache."""
+        from conference import ConferenceApi
         c = ConferenceApi()
         msg = c._updateFeaturedSpeaker(self.request.get('speaker'), self.request.get('conferenceKey'))
         self.response.set_status(204)
@@ -51,6 +257,24 @@ class UpdateFeaturedSpeakerHandler(webapp2.RequestHandler):
 
 app = webapp2.WSGIApplication([
     ('/crons/set_announcement', SetAnnouncementHandler),
+    ('/crons/send_emails', SendEmailsHandler),
+    ('/crons/apply_facets', ApplyFacetsHandler),
+    ('/crons/recount_facets', RecountFacetsHandler),
+    ('/crons/trending', TrendingHandler),
+    ('/crons/recommendations', RecommendationsHandler),
+    ('/crons/analytics', AnalyticsHandler),
     ('/tasks/send_confirmation_email', SendConfirmationEmailHandler),
     ('/tasks/update_featured_speaker', UpdateFeaturedSpeakerHandler),
+    ('/tasks/notify_attendees', NotifyAttendeesHandler),
+    ('/tasks/delete_conference', DeleteConferenceHandler),
+    ('/tasks/migrate', MigrateHandler),
+    ('/tasks/index_sessions', IndexSessionsHandler),
+    ('/tasks/promote_waitlist', PromoteWaitlistHandler),
+    ('/tasks/recommendations', RecommendationStepHandler),
+    ('/tasks/analytics', AnalyticsStepHandler),
+    ('/admin/migrate', MigrationsAdminHandler),
+    ('/admin/stats', StatsAdminHandler),
+    ('/admin/analytics', AnalyticsAdminHandler),
+    ('/admin/indexes', IndexAdvisorHandler),
+    ('/_ah/warmup', WarmupHandler),
 ], debug=True)
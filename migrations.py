@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+
+"""migrations.py
+
+Resumable batched schema migrations. A migration is an idempotent
+per-entity transform over one kind, registered with @migration. Running
+it walks the kind by cursor in batches, writes the changed entities with
+put_multi and checkpoints the cursor and metrics in a MigrationState, so
+it can resume from the last batch after any failure. The cache versions
+of the written entities (conference, month, speaker directory) are bumped
+with every batch, so no cached response outlives the rewrite.
+
+In production every batch is a /tasks/migrate task chaining the next one
+(POST name=<name> to /admin/migrate to start one). Locally, or against the
+testbed datastore stub, runMigration(name) runs the batches in a loop.
+
+"""
+
+import logging
+import time
+
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+
+from caching import bumpMonthVersions
+from caching import bumpVersion
+from caching import conferenceVersionKey
+from fulltext import indexSession
+from models import Conference
+from models import MigrationState
+from models import Posting
+from models import Session
+from models import Speaker
+from speakerdirectory import bumpSpeakerGeneration
+
+BATCH_SIZE = 100
+
+MIGRATIONS = {}
+
+
+class Migration(object):
+    """Migration -- a named transform over the entities of a model"""
+
+    def __init__(self, name, model, transform, batch_size=BATCH_SIZE):
+        self.name = name
+        self.model = model
+        self.transform = transform
+        self.batch_size = batch_size
+
+
+def migration(name, model, batch_size=BATCH_SIZE):
+    """Register the decorated function as the transform of a migration.
+    It receives one entity, changes it in place and returns True if it has
+    to be written. It must be idempotent: batches can run more than once."""
+    def register(transform):
+        MIGRATIONS[name] = Migration(name, model, transform, batch_size)
+        return transform
+    return register
+
+
+def startMigration(name):
+    """Start (or restart from scratch) a migration in the task queue."""
+    _getMigration(name)
+    state = MigrationState(id=name)
+    state.put()
+    _enqueueBatch(name, 0)
+    return state
+
+
+def _getMigration(name):
+    try:
+        return MIGRATIONS[name]
+    except KeyError:
+        raise ValueError('Unknown migration: %s' % name)
+
+
+def _enqueueBatch(name, step):
+    """Queue the task migrating one batch."""
+    taskqueue.add(params={'name': name, 'step': step},
+        url='/tasks/migrate',
+        transactional=ndb.in_transaction()
+    )
+
+
+def runMigrationBatch(name, step):
+    """Migrate one batch and chain the next one (task queue entry point)."""
+    state = ndb.Key(MigrationState, name).get()
+    if not state or state.done or state.step != step:
+        # duplicate of a batch that was already checkpointed
+        return
+    _migrateBatch(_getMigration(name), state)
+    _checkpoint(state, step, chain=True)
+
+
+def runMigration(name, resume=True):
+    """Run a whole migration in this process; return its MigrationState."""
+    m = _getMigration(name)
+    state = ndb.Key(MigrationState, name).get() if resume else None
+    if not state or state.done:
+        state = MigrationState(id=name)
+        state.put()
+    while not state.done:
+        step = state.step
+        _migrateBatch(m, state)
+        _checkpoint(state, step, chain=False)
+    return state
+
+
+def _migrateBatch(m, state):
+    """Transform and write one batch, updating the state in memory."""
+    started = time.time()
+    start = Cursor(urlsafe=state.cursor) if state.cursor else None
+    entities, cursor, more = m.model.query().fetch_page(
+        m.batch_size, start_cursor=start)
+    changed = [e for e in entities if m.transform(e)]
+    ndb.put_multi(changed)
+    _bumpVersions(changed)
+
+    state.processed += len(entities)
+    state.updated += len(changed)
+    state.seconds += time.time() - started
+    state.cursor = cursor.urlsafe() if more and cursor else None
+    state.done = state.cursor is None
+    logging.info('Migration %s: %d processed, %d updated, %.1f entities/s'
+                 % (m.name, state.processed, state.updated, throughput(state)))
+
+
+def _bumpVersions(entities):
+    """Invalidate the cached responses holding rewritten entities."""
+    conferences = set()
+    startDates = []
+    for entity in entities:
+        if isinstance(entity, Conference):
+            conferences.add(entity.key)
+            startDates.append(entity.startDate)
+        elif isinstance(entity, Session):
+            conferences.add(entity.key.parent())
+    for c_key in conferences:
+        bumpVersion(conferenceVersionKey(c_key.urlsafe()))
+    bumpMonthVersions(*startDates)
+    speakers = [e.key for e in entities if isinstance(e, Speaker)]
+    if speakers:
+        bumpSpeakerGeneration(speakers)
+
+
+@ndb.transactional()
+def _checkpoint(state, step, chain):
+    """Record a migrated batch and, for task runs, chain the next one."""
+    if state.key.get().step != step:
+        return
+    state.step = step + 1
+    state.put()
+    if chain and not state.done:
+        _enqueueBatch(state.key.id(), state.step)
+
+
+def throughput(state):
+    """Return the entities processed per second of a migration."""
+    return state.processed / state.seconds if state.seconds else 0.0
+
+
+def migrationStatus():
+    """Return the state of every registered migration as dicts."""
+    states = ndb.get_multi([ndb.Key(MigrationState, name) for name in sorted(MIGRATIONS)])
+    status = []
+    for name, state in zip(sorted(MIGRATIONS), states):
+        status.append({
+            'name': name,
+            'kind': MIGRATIONS[name].model._get_kind(),
+            'started': state is not None,
+            'done': bool(state and state.done),
+            'processed': state.processed if state else 0,
+            'updated': state.updated if state else 0,
+            'entitiesPerSecond': throughput(state) if state else 0.0,
+        })
+    return status
+
+# - - - Migrations - - - - - - - - - - - - - - - - - - - - -
+
+
+@migration('conference_month', Conference)
+def conferenceMonth(conf):
+    """Recompute the month denormalised from startDate."""
+    month = conf.startDate.month if conf.startDate else 0
+    if conf.month == month:
+        return False
+    conf.month = month
+    return True
+
+
+def _backfillUpdatedAt(entity):
+    """Give entities written before updatedAt existed one (auto_now sets
+    it on put), so they enter the change feed."""
+    return entity.updatedAt is None
+
+migration('conference_updated_at', Conference)(_backfillUpdatedAt)
+migration('session_updated_at', Session)(_backfillUpdatedAt)
+migration('speaker_updated_at', Speaker)(_backfillUpdatedAt)
+
+
+def _storeNamePrefixes(entity):
+    """Write entities again so their computed namePrefixes get stored
+    (autocomplete); it can't be read back to tell if it already is."""
+    return True
+
+migration('conference_name_prefixes', Conference)(_storeNamePrefixes)
+migration('session_name_prefixes', Session)(_storeNamePrefixes)
+migration('speaker_name_prefixes', Speaker)(_storeNamePrefixes)
+
+
+@migration('session_search_index', Session, batch_size=20)
+def sessionSearchIndex(session):
+    """Index the sessions written before full-text search existed."""
+    indexSession(session.key)
+    return False
+
+
+@migration('session_search_shards', Session, batch_size=20)
+def sessionSearchShards(session):
+    """Write the sessions indexed before the postings were sharded to
+    their shards; run posting_unsharded_cleanup after it."""
+    indexSession(session.key, rebuild=True)
+    return False
+
+
+@migration('posting_unsharded_cleanup', Posting)
+def postingUnshardedCleanup(posting):
+    """Delete the postings of before sharding, keyed by the bare term."""
+    if '|' not in posting.key.id():
+        posting.key.delete()
+    return False
@@ -2,7 +2,8 @@
 
 """models.py
 
-Udacity conference server-side Python App Engine data & ProtoRPC models
+Udacity conference server-side Python App Engine data models (the
+ProtoRPC messages are in forms.py)
 
 $Id: models.py,v 1.1 2014/05/24 22:01:10 wesc Exp $
 
@@ -12,17 +13,10 @@ created/forked from conferences.py by wesc on 2014 may 24
 
 __author__ = 'wesc+api@google.com (Wesley Chun)'
 
-import httplib
-import endpoints
-from protorpc import messages
 from google.appengine.ext import ndb
 from datetime import datetime
 
-#------ Exception -------#
-
-class ConflictException(endpoints.ServiceException):
-    """ConflictException -- exception mapped to HTTP 409 response"""
-    http_status = httplib.CONFLICT
+from autocomplete import edgeNgrams
 
 #------ Profile -------#
 
@@ -40,40 +34,6 @@ class Profile(ndb.Model):
         index = {'displayName':str, 'mainEmail':str, 'teeShirtSize':str, 'conferenceKeysToAttend':str, 'sessionWishlist':str}
         return index[field](value)
 
-class ProfileMiniForm(messages.Message):
-    """ProfileMiniForm -- update Profile form message"""
-    displayName = messages.StringField(1)
-    teeShirtSize = messages.EnumField('TeeShirtSize', 2)
-
-class ProfileForm(messages.Message):
-    """ProfileForm -- Profile outbound form message"""
-    displayName = messages.StringField(1)
-    mainEmail = messages.StringField(2)
-    teeShirtSize = messages.EnumField('TeeShirtSize', 3)
-    conferenceKeysToAttend = messages.StringField(4, repeated=True)
-    sessionWishlist = messages.StringField(5, repeated=True)
-
-#------ Messages -------#
-
-class StringMessage(messages.Message):
-    """StringMessage-- outbound (single) string message"""
-    data = messages.StringField(1, required=True)
-
-class BooleanMessage(messages.Message):
-    """BooleanMessage-- outbound Boolean value message"""
-    data = messages.BooleanField(1)
-
-class QueryForm(messages.Message):
-    """QueryForm --  query inbound form message"""
-    field = messages.StringField(1)
-    operator = messages.StringField(2)
-    value = messages.StringField(3)
-    '''entity = messages.StringField(4)'''
-
-class QueryForms(messages.Message):
-    """QueryForms -- multiple QueryForm inbound form message"""
-    filters = messages.MessageField(QueryForm, 1, repeated=True)
-
 #------ Conference -------#
 
 class Conference(ndb.Model):
@@ -89,6 +49,9 @@ class Conference(ndb.Model):
     maxAttendees    = ndb.IntegerProperty()
     seatsAvailable  = ndb.IntegerProperty()
     featuredSpeaker = ndb.StringProperty()
+    waitlisted      = ndb.IntegerProperty(default=0)
+    updatedAt       = ndb.DateTimeProperty(auto_now=True)
+    namePrefixes    = ndb.ComputedProperty(lambda self: edgeNgrams(self.name), repeated=True)
 
     @classmethod
     def formatFilter(cls, field, value):
@@ -96,53 +59,11 @@ class Conference(ndb.Model):
         index = {'name':str, 'description':str, 'organizerUserId':str, 'topics':str, 'city':str, 'startDate':formatDate, 'month':int,'endDate':formatDate, 'maxAttendees':int,'seatsAvailable':int, 'featuredSpeaker':str}
         return index[field](value)
 
-class ConferenceForm(messages.Message):
-    """ConferenceForm -- Conference outbound form message"""
-    name            = messages.StringField(1)
-    description     = messages.StringField(2)
-    organizerUserId = messages.StringField(3)
-    topics          = messages.StringField(4, repeated=True)
-    city            = messages.StringField(5)
-    startDate       = messages.StringField(6) #DateTimeField()
-    month           = messages.IntegerField(7)
-    maxAttendees    = messages.IntegerField(8)
-    seatsAvailable  = messages.IntegerField(9)
-    featuredSpeaker = messages.StringField(10)
-    endDate         = messages.StringField(11) #DateTimeField()
-    websafeKey      = messages.StringField(12)
-    organizerDisplayName = messages.StringField(13)
-
-class ConferenceForms(messages.Message):
-    """ConferenceForms -- multiple Conference outbound form message"""
-    items = messages.MessageField(ConferenceForm, 1, repeated=True)
-
-class TeeShirtSize(messages.Enum):
-    """TeeShirtSize -- t-shirt size enumeration value"""
-    NOT_SPECIFIED = 1
-    XS_M = 2
-    XS_W = 3
-    S_M = 4
-    S_W = 5
-    M_M = 6
-    M_W = 7
-    L_M = 8
-    L_W = 9
-    XL_M = 10
-    XL_W = 11
-    XXL_M = 12
-    XXL_W = 13
-    XXXL_M = 14
-    XXXL_W = 15
-
-class ConferenceQueryForm(messages.Message):
-    """ConferenceQueryForm -- Conference query inbound form message"""
-    field = messages.StringField(1)
-    operator = messages.StringField(2)
-    value = messages.StringField(3)
-
-class ConferenceQueryForms(messages.Message):
-    """ConferenceQueryForms -- multiple ConferenceQueryForm inbound form message"""
-    filters = messages.MessageField(ConferenceQueryForm, 1, repeated=True)
+class WaitlistEntry(ndb.Model):
+    """WaitlistEntry -- a user waiting for a seat of a full conference,
+    child of their Profile, keyed by the websafe conference key"""
+    conference      = ndb.StringProperty()
+    joinedAt        = ndb.DateTimeProperty(auto_now_add=True)
 
 #------ Session -------#
 
@@ -155,6 +76,8 @@ class Session(ndb.Model):
     typeOfSession   = ndb.StringProperty()
     date            = ndb.DateProperty()
     start           = ndb.TimeProperty()
+    updatedAt       = ndb.DateTimeProperty(auto_now=True)
+    namePrefixes    = ndb.ComputedProperty(lambda self: edgeNgrams(self.name), repeated=True)
 
     @classmethod
     def formatFilter(cls, field, value):
@@ -162,31 +85,6 @@ class Session(ndb.Model):
         index = {'name':str, 'highlights':str, 'speaker':str, 'duration':formatTime, 'typeOfSession':str, 'date':formatDate, 'start':formatTime}
         return index[field](value)
 
-class SessionForm(messages.Message):
-    """SessionForm -- Session outbound form message"""
-    name            = messages.StringField(1)
-    highlights      = messages.StringField(2)
-    speaker         = messages.StringField(3, repeated=True)
-    duration        = messages.StringField(4)  # DateTimeField()
-    typeOfSession   = messages.StringField(5)
-    date            = messages.StringField(6)  # DateTimeField()
-    start           = messages.StringField(7)  # DateTimeField()
-    websafeKey      = messages.StringField(8)
-
-class SessionForms(messages.Message):
-    """SessionForms -- multiple Session outbound form message"""
-    items = messages.MessageField(SessionForm, 1, repeated=True)
-
-class SessionQueryForm(messages.Message):
-    """SessionQueryForm -- Session query inbound form message"""
-    field = messages.StringField(1)
-    operator = messages.StringField(2)
-    value = messages.StringField(3)
-
-class SessionQueryForms(messages.Message):
-    """SessionQueryForms -- multiple SessionQueryForm inbound form message"""
-    filters = messages.MessageField(SessionQueryForm, 1, repeated=True)
-
 #------ Speaker -------#
 
 class Speaker(ndb.Model):
@@ -195,6 +93,8 @@ class Speaker(ndb.Model):
     biography       = ndb.StringProperty()
     specialty       = ndb.StringProperty(repeated=True)
     company         = ndb.StringProperty()
+    updatedAt       = ndb.DateTimeProperty(auto_now=True)
+    namePrefixes    = ndb.ComputedProperty(lambda self: edgeNgrams(self.name), repeated=True)
 
     @classmethod
     def formatFilter(cls, field, value):
@@ -202,22 +102,163 @@ class Speaker(ndb.Model):
         index = {'name':str, 'biography':str, 'specialty':str, 'company':str}
         return index[field](value)
 
-class SpeakerForm(messages.Message):
-    """SpeakerForm -- Speaker outbound form message"""
-    name            = messages.StringField(1)
-    biography       = messages.StringField(2)
-    specialty       = messages.StringField(3, repeated=True)
-    company       = messages.StringField(4)
-    websafeKey      = messages.StringField(5)
-
-class SpeakerForms(messages.Message):
-    """SpeakerForms -- multiple Speaker outbound form message"""
-    items = messages.MessageField(SpeakerForm, 1, repeated=True)
-
+#------ Notifications -------#
+
+class NotificationJob(ndb.Model):
+    """NotificationJob -- checkpoint of an attendee notification fan-out,
+    child of the Conference whose attendees are notified"""
+    template        = ndb.StringProperty(indexed=False)
+    cursor          = ndb.StringProperty(indexed=False)
+    page            = ndb.IntegerProperty(default=0)
+    notified        = ndb.IntegerProperty(default=0)
+    done            = ndb.BooleanProperty(default=False)
+    updatedAt       = ndb.DateTimeProperty(auto_now=True)
+
+class DeletionJob(ndb.Model):
+    """DeletionJob -- progress of a cascading conference deletion,
+    keyed by the websafe key of the deleted Conference"""
+    organizerUserId = ndb.StringProperty()
+    phase           = ndb.StringProperty(default='conference')
+    step            = ndb.IntegerProperty(default=0)
+    cursor          = ndb.StringProperty(indexed=False)
+    session         = ndb.StringProperty(indexed=False)
+    sessionCursor   = ndb.StringProperty(indexed=False)
+    attendeesUpdated = ndb.IntegerProperty(default=0)
+    wishlistsUpdated = ndb.IntegerProperty(default=0)
+    entitiesDeleted = ndb.IntegerProperty(default=0)
+    updatedAt       = ndb.DateTimeProperty(auto_now=True)
+
+#------ Migrations -------#
+
+class MigrationState(ndb.Model):
+    """MigrationState -- checkpoint and metrics of a schema migration,
+    keyed by the migration name"""
+    step            = ndb.IntegerProperty(default=0)
+    cursor          = ndb.StringProperty(indexed=False)
+    processed       = ndb.IntegerProperty(default=0)
+    updated         = ndb.IntegerProperty(default=0)
+    seconds         = ndb.FloatProperty(default=0.0)
+    done            = ndb.BooleanProperty(default=False)
+    startedAt       = ndb.DateTimeProperty(auto_now_add=True)
+    updatedAt       = ndb.DateTimeProperty(auto_now=True)
+
+#------ Full-text search -------#
+
+class Posting(ndb.Model):
+    """Posting -- one shard of the sessions holding a search term and its
+    frequency in each, keyed term|shard"""
+    sessions        = ndb.KeyProperty(repeated=True, indexed=False)
+    frequencies     = ndb.IntegerProperty(repeated=True, indexed=False)
+
+class SearchDocument(ndb.Model):
+    """SearchDocument -- the term frequencies a session is indexed with,
+    keyed by the websafe session key"""
+    terms           = ndb.StringProperty(repeated=True, indexed=False)
+    frequencies     = ndb.IntegerProperty(repeated=True, indexed=False)
+
+#------ Facets -------#
+
+class ConferenceFacets(ndb.Model):
+    """ConferenceFacets -- number of conferences per value of the city,
+    topics and month facets: counts is {facet: {value: count}}"""
+    counts          = ndb.JsonProperty()
+    recountedAt     = ndb.DateTimeProperty()
+    # while a recount runs, {conference: [time, values before]} of the
+    # conferences written since its start; after it, the conferences it
+    # skipped whose first delta wasn't applied yet
+    recountBefore   = ndb.JsonProperty(compressed=True)
+    recountAwaited  = ndb.JsonProperty()
+    updatedAt       = ndb.DateTimeProperty(auto_now=True)
+
+#------ Trending -------#
+
+class RegistrationShard(ndb.Model):
+    """RegistrationShard -- one shard of the registrations of a conference
+    in a time bucket, keyed bucket|websafe conference key|shard"""
+    bucket          = ndb.IntegerProperty()
+    conference      = ndb.StringProperty(indexed=False)
+    count           = ndb.IntegerProperty(default=0, indexed=False)
+
+class TrendingList(ndb.Model):
+    """TrendingList -- the conferences with the most recent registrations:
+    top is {window: [[websafe conference key, registrations]]}"""
+    top             = ndb.JsonProperty()
+    computedAt      = ndb.DateTimeProperty()
+
+#------ Recommendations -------#
+
+class RecommendationJob(ndb.Model):
+    """RecommendationJob -- checkpoint and metrics of a run of the session
+    recommendations job"""
+    phase           = ndb.StringProperty(default='profiles', indexed=False)
+    step            = ndb.IntegerProperty(default=0, indexed=False)
+    cursor          = ndb.StringProperty(indexed=False)
+    profilesRead    = ndb.IntegerProperty(default=0, indexed=False)
+    sessionsScored  = ndb.IntegerProperty(default=0, indexed=False)
+    done            = ndb.BooleanProperty(default=False)
+    startedAt       = ndb.DateTimeProperty(auto_now_add=True)
+    updatedAt       = ndb.DateTimeProperty(auto_now=True)
+
+class CoOccurrence(ndb.Model):
+    """CoOccurrence -- sparse matrix of the sessions of a conference
+    wishlisted together, a child of the RecommendationJob keyed by the
+    websafe conference key. The arrays are zlib compressed int64 arrays,
+    pairs and counts indexed by pair, totals by session."""
+    sessions        = ndb.StringProperty(repeated=True, indexed=False)
+    pairs           = ndb.BlobProperty()
+    counts          = ndb.BlobProperty()
+    totals          = ndb.BlobProperty()
+
+class SessionNeighbours(ndb.Model):
+    """SessionNeighbours -- sessions most often wishlisted with a session,
+    keyed by its websafe key, best first"""
+    sessions        = ndb.StringProperty(repeated=True, indexed=False)
+    scores          = ndb.FloatProperty(repeated=True, indexed=False)
+    computedAt      = ndb.DateTimeProperty()
+
+#------ Analytics -------#
+
+class AnalyticsJob(ndb.Model):
+    """AnalyticsJob -- checkpoint and running totals of a run of the
+    analytics job: totals is {group: {label: [sums]}}"""
+    phase           = ndb.StringProperty(indexed=False)
+    step            = ndb.IntegerProperty(default=0, indexed=False)
+    cursor          = ndb.StringProperty(indexed=False)
+    totals          = ndb.JsonProperty(compressed=True)
+    entitiesRead    = ndb.IntegerProperty(default=0, indexed=False)
+    done            = ndb.BooleanProperty(default=False)
+    startedAt       = ndb.DateTimeProperty(auto_now_add=True)
+    updatedAt       = ndb.DateTimeProperty(auto_now=True)
+
+class AnalyticsSnapshot(ndb.Model):
+    """AnalyticsSnapshot -- fill rates and session mix computed by an
+    AnalyticsJob, its child"""
+    results         = ndb.JsonProperty(compressed=True)
+    entitiesRead    = ndb.IntegerProperty(indexed=False)
+    computedAt      = ndb.DateTimeProperty()
+
+#------ Change feed -------#
+
+class Tombstone(ndb.Model):
+    """Tombstone -- marks a deleted entity for the change feed"""
+    kind            = ndb.StringProperty()
+    websafeKey      = ndb.StringProperty(indexed=False)
+    updatedAt       = ndb.DateTimeProperty(auto_now=True)
+
+#------ Index advisor -------#
+
+class QueryShape(ndb.Model):
+    """QueryShape -- a query shape seen by the index advisor and how often
+    it ran, keyed by its description"""
+    kind            = ndb.StringProperty(indexed=False)
+    equalities      = ndb.StringProperty(repeated=True, indexed=False)
+    orders          = ndb.StringProperty(repeated=True, indexed=False)
+    count           = ndb.IntegerProperty(default=0, indexed=False)
+    lastSeen        = ndb.DateTimeProperty(auto_now=True, indexed=False)
 
 #-------UTILITY--------
 def formatTime(value):
     return datetime.strptime(value, "%H:%M").time()
 
 def formatDate(value):
-    return datetime.strptime(value, "%Y-%m-%d").date()
\ No newline at end of file
+    return datetime.strptime(value, "%Y-%m-%d").date()
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+
+"""monthpages.py
+
+Conferences by start date for the calendar view, read from pages
+materialised in memcache per calendar month. A month's conferences are
+read with a single startDate range query (the built-in index), ordered
+by startDate, MONTH_PAGE_SIZE at a time. Every page is cached with the
+cursor to the next one, under the month's version counter. A conference
+write bumps the version of its month, old and new, so the next read
+rebuilds the pages from the datastore.
+
+The range query is eventually consistent: pages rebuilt right after a
+bump may still miss the write. They are only cached for
+CONSISTENCY_SECONDS, then rebuilt under the same version from results
+that include it.
+
+inRange bounds the work of one call: it stops after MAX_SCANNED entries
+and returns the position to continue from, however few matched, and
+only serves the first MAX_MONTH_PAGES pages of a month.
+
+"""
+
+import time
+from datetime import date
+
+from google.appengine.api import memcache
+from google.appengine.datastore.datastore_query import Cursor
+
+from caching import MEMCACHE_MONTH_PAGE_PRE_KEY
+from caching import getVersion
+from caching import monthBumpedAt
+from caching import monthVersionKey
+from models import Conference
+
+MONTH_PAGE_SIZE = 100
+# pages of an older version are never read again, only left to expire
+MONTH_PAGE_SECONDS = 24 * 3600
+# time the range query may take to see a write
+CONSISTENCY_SECONDS = 30
+# entries read by one inRange call, matching or not
+MAX_SCANNED = 500
+MAX_MONTH_PAGES = 100
+
+
+def monthOf(day):
+    return day.strftime('%Y-%m')
+
+
+def monthBounds(month):
+    """Return the first day of month ('YYYY-MM') and of the next one."""
+    year, number = [int(part) for part in month.split('-')]
+    first = date(year, number, 1)
+    if number == 12:
+        return first, date(year + 1, 1, 1)
+    return first, date(year, number + 1, 1)
+
+
+def nextMonth(month):
+    return monthOf(monthBounds(month)[1])
+
+
+def _pageKey(month, version, page):
+    return MEMCACHE_MONTH_PAGE_PRE_KEY + '%s|%s|%d' % (month, version, page)
+
+
+def _loadPage(month, version, page, render, ttl):
+    """Return the cached (items, cursor to the next page or None) of a
+    page, building it and the missing pages before it."""
+    keys = [_pageKey(month, version, p) for p in range(page + 1)]
+    cached = memcache.get_multi(keys)
+    if keys[page] in cached:
+        return cached[keys[page]]
+    # start after the last page still cached: the cursor to a page is
+    # kept in the one before it
+    built = [p for p in range(page) if keys[p] in cached]
+    p = built[-1] + 1 if built else 0
+    cursor = cached[keys[p - 1]][1] if p else None
+    first, last = monthBounds(month)
+    q = Conference.query(Conference.startDate >= first,
+                         Conference.startDate < last)
+    q = q.order(Conference.startDate)
+    pages = {}
+    while True:
+        if p and cursor is None:
+            # the month has fewer pages
+            entry = ([], None)
+            break
+        start = Cursor(urlsafe=cursor) if cursor else None
+        conferences, next_cursor, more = q.fetch_page(MONTH_PAGE_SIZE, start_cursor=start)
+        entry = (render(conferences),
+                 next_cursor.urlsafe() if more and next_cursor else None)
+        pages[keys[p]] = entry
+        if p == page:
+            break
+        p, cursor = p + 1, entry[1]
+    memcache.set_multi(pages, time=ttl)
+    return entry
+
+
+def monthPage(month, page, render):
+    """Return page (from 0) of the conferences starting in month as
+    (items, more). Items are render(conferences), which must return a
+    list of values memcache can hold."""
+    # read the version first: a write committed after it leaves its pages
+    # under an older version. Pages built soon after the bump may still
+    # miss the write, so they are cached briefly.
+    version = getVersion(monthVersionKey(month))
+    recent = time.time() - monthBumpedAt(month) < CONSISTENCY_SECONDS
+    items, cursor = _loadPage(month, version, page, render,
+                              CONSISTENCY_SECONDS if recent else MONTH_PAGE_SECONDS)
+    return items, cursor is not None
+
+
+def inRange(first, last, matches, render, position=None, limit=MONTH_PAGE_SIZE,
+            scan=MAX_SCANNED):
+    """Return the items of the conferences starting from first to last
+    (dates, both included) for which matches(item) is true, in startDate
+    order: (items, position of the next one or None). position is the
+    (month, index in the month) returned by an earlier call. At most scan
+    entries are read: fewer than limit items may come with a position."""
+    month, index = position or (monthOf(first), 0)
+    items = []
+    scanned = 0
+    while month <= monthOf(last):
+        page, offset = divmod(index, MONTH_PAGE_SIZE)
+        entries, more = monthPage(month, page, render) \
+            if page < MAX_MONTH_PAGES else ([], False)
+        for i in range(offset, len(entries)):
+            index += 1
+            scanned += 1
+            if matches(entries[i]):
+                items.append(entries[i])
+            if len(items) == limit or scanned == scan:
+                if i + 1 < len(entries) or more:
+                    return items, (month, index)
+                break
+        if not more:
+            month, index = nextMonth(month), 0
+        if len(items) == limit or scanned >= scan:
+            break
+    return items, (month, index) if month <= monthOf(last) else None
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+
+"""notifications.py
+
+Fan-out of notification emails to the attendees of a conference. A
+NotificationJob checkpoints the fan-out; each /tasks/notify_attendees task
+handles one page of attendees and chains the next page when its
+checkpoint commits, so any task can be retried and no task handles more
+than one page.
+
+"""
+
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+
+from emails import enqueueEmails
+from models import NotificationJob
+from models import Profile
+
+# attendees per task; also the max number of tasks added in one call
+ATTENDEES_PAGE_SIZE = 100
+
+
+def startAttendeeNotification(conf_key, template):
+    """Start notifying the attendees of a conference with template.
+    Meant to be called in the transaction writing the conference: the
+    fan-out only starts if it commits."""
+    job = NotificationJob(parent=conf_key, template=template)
+    job.put()
+    _enqueuePage(job.key, 0)
+    return job.key
+
+
+def _enqueuePage(job_key, page):
+    """Queue the task handling one page of a fan-out."""
+    taskqueue.add(params={'job': job_key.urlsafe(), 'page': page},
+        url='/tasks/notify_attendees',
+        transactional=ndb.in_transaction()
+    )
+
+
+def notifyAttendeesPage(job_key, page):
+    """Queue the emails of one page of attendees and checkpoint the job."""
+    job = job_key.get()
+    if not job or job.done or job.page != page:
+        # duplicate of a page that was already checkpointed
+        return
+    wsck = job_key.parent().urlsafe()
+    q = Profile.query(Profile.conferenceKeysToAttend == wsck)
+    start = Cursor(urlsafe=job.cursor) if job.cursor else None
+    profiles, next_cursor, more = q.fetch_page(
+        ATTENDEES_PAGE_SIZE, start_cursor=start)
+    # named after the job and page, so a retry of this task can't queue
+    # the same emails twice
+    enqueueEmails(job.template, [p.mainEmail for p in profiles if p.mainEmail],
+                  wsck, name='notify-%s-%d' % (job_key.urlsafe(), page))
+    _checkpoint(job_key, page, next_cursor if more else None, len(profiles))
+
+
+@ndb.transactional()
+def _checkpoint(job_key, page, cursor, notified):
+    """Record a handled page and chain the next one, if any."""
+    job = job_key.get()
+    if job.page != page:
+        return
+    job.page += 1
+    job.notified += notified
+    job.cursor = cursor.urlsafe() if cursor else None
+    job.done = cursor is None
+    job.put()
+    if not job.done:
+        _enqueuePage(job_key, job.page)
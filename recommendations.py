@@ -0,0 +1,307 @@
+#!/usr/bin/env python
+
+"""recommendations.py
+
+Session recommendations from the co-interest of the wishlists: sessions
+wishlisted together by many users are neighbours. A RecommendationJob,
+started daily by /crons/recommendations, runs in chained
+/tasks/recommendations tasks; each task does one bounded step of the
+current phase and checkpoints:
+
+    profiles    read one page of profiles and add the pairs of sessions
+                wishlisted together, per conference, to the CoOccurrence
+                children of the job (a sparse matrix per conference)
+    neighbours  score the pairs of a few conferences (cosine similarity
+                of the sessions' wishlist vectors) and store the TOP_N
+                neighbours of every session as SessionNeighbours
+    cleanup     delete the matrices (the job's and any left by abandoned
+                jobs) and the neighbours of sessions no longer wishlisted
+                with any other
+
+A job that made no progress for JOB_TIMEOUT_SECONDS (a step failing
+every time) is abandoned by the next start. A matrix keeps at most
+MAX_SESSIONS sessions and the MAX_PAIRS most frequent pairs, well within
+the 1MB entity limit.
+
+A profiles step writes its matrices and the checkpoint in one transaction
+(they share the job's entity group), so a retried task never counts a
+page twice. It ends its page early rather than touch more than
+MATRICES_PER_STEP matrices (unless its first profile alone does), so
+the transaction and memory stay bounded by the page and those matrices. getRecommendedSessions merges the neighbours of the user's
+wishlist. NumPy is only imported by the job, so API instances don't load
+it.
+
+"""
+
+import logging
+import zlib
+from datetime import datetime
+from datetime import timedelta
+
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+
+from models import CoOccurrence
+from models import Profile
+from models import RecommendationJob
+from models import SessionNeighbours
+
+PROFILES_PAGE_SIZE = 500
+# matrices written by one profiles step, up to ~0.7MB each
+MATRICES_PER_STEP = 5
+# matrices scored per neighbours step
+CONFERENCES_PAGE_SIZE = 10
+DELETE_BATCH_SIZE = 500
+TOP_N = 10
+DEFAULT_RECOMMENDATIONS = 10
+MAX_RECOMMENDATIONS = 50
+JOB_TIMEOUT_SECONDS = 6 * 3600
+# 16 bytes a pair before compression
+MAX_PAIRS = 40000
+MAX_SESSIONS = 2000
+
+
+def startRecommendationJob():
+    """Start a job unless one is running; return the running job. A job
+    with no progress for JOB_TIMEOUT_SECONDS is abandoned."""
+    timeout = datetime.utcnow() - timedelta(seconds=JOB_TIMEOUT_SECONDS)
+    for running in RecommendationJob.query(RecommendationJob.done == False):
+        if running.updatedAt > timeout:
+            return running
+        _abandon(running.key)
+    job = RecommendationJob()
+    job.put()
+    _enqueueStep(job.key, 0)
+    return job
+
+
+@ndb.transactional()
+def _abandon(job_key):
+    """Mark a stuck job done, so that its pending steps do nothing."""
+    job = job_key.get()
+    if job and not job.done:
+        logging.warning('Abandoning recommendation job %s stuck at step %d (%s)'
+                        % (job_key.id(), job.step, job.phase))
+        job.phase = 'abandoned'
+        job.done = True
+        job.put()
+
+
+def _enqueueStep(job_key, step):
+    """Queue the task running one step of a job."""
+    taskqueue.add(params={'job': job_key.urlsafe(), 'step': step},
+        url='/tasks/recommendations',
+        transactional=ndb.in_transaction()
+    )
+
+
+def runRecommendationStep(job_key, step):
+    """Run one step of a job and checkpoint it."""
+    job = job_key.get()
+    if not job or job.done or job.step != step:
+        # duplicate of a step that was already checkpointed
+        return
+    PHASES[job.phase](job, step)
+
+
+def _countProfiles(job, step):
+    """Add the wishlist pairs of one page of profiles to the matrices; the
+    page ends before the profile that would add a matrix past
+    MATRICES_PER_STEP."""
+    start = Cursor(urlsafe=job.cursor) if job.cursor else None
+    profiles = Profile.query().iter(start_cursor=start, produce_cursors=True,
+                                    batch_size=PROFILES_PAGE_SIZE)
+    # wishlisted sessions of every profile, by conference
+    wishlists = {}
+    read, cursor, more = 0, start, False
+    for prof in profiles:
+        byConference = {}
+        for wssk in set(prof.sessionWishlist):
+            try:
+                wsck = ndb.Key(urlsafe=wssk).parent().urlsafe()
+            except Exception:
+                continue
+            byConference.setdefault(wsck, []).append(wssk)
+        if wishlists and len(set(wishlists) | set(byConference)) > MATRICES_PER_STEP:
+            more = True
+            break
+        for wsck, sessions in byConference.items():
+            wishlists.setdefault(wsck, []).append(sessions)
+        read += 1
+        cursor = profiles.cursor_after()
+        if read == PROFILES_PAGE_SIZE:
+            more = True
+            break
+    _storeCounts(job.key, step, wishlists, read,
+                 cursor.urlsafe() if more and cursor else None)
+
+
+@ndb.transactional()
+def _storeCounts(job_key, step, wishlists, read, cursor):
+    job = job_key.get()
+    if job.done or job.step != step:
+        return
+    keys = [ndb.Key(CoOccurrence, wsck, parent=job_key) for wsck in wishlists]
+    matrices = ndb.get_multi(keys)
+    for i, key in enumerate(keys):
+        matrix = matrices[i] or CoOccurrence(key=key)
+        addWishlists(matrix, wishlists[key.id()])
+        matrices[i] = matrix
+    ndb.put_multi(matrices)
+    job.profilesRead += read
+    job.cursor = cursor
+    if cursor is None:
+        job.phase = 'neighbours'
+    _checkpoint(job)
+
+
+def _checkpoint(job):
+    """Record a finished step and chain the next one, if any."""
+    job.step += 1
+    job.done = job.phase == 'done'
+    job.put()
+    if not job.done:
+        _enqueueStep(job.key, job.step)
+
+
+def _arrays(matrix):
+    """Return the (pair ids, pair counts, session totals) arrays of a
+    CoOccurrence; a pair id is i << 32 | j for session indexes i < j."""
+    import numpy as np
+    def decode(blob):
+        if not blob:
+            return np.zeros(0, np.int64)
+        return np.fromstring(zlib.decompress(blob), np.int64)
+    totals = decode(matrix.totals)
+    return (decode(matrix.pairs), decode(matrix.counts),
+            np.concatenate([totals, np.zeros(len(matrix.sessions) - len(totals), np.int64)]))
+
+
+def addWishlists(matrix, wishlists):
+    """Add wishlists (lists of websafe session keys of the matrix's
+    conference) to a CoOccurrence matrix. Sessions past MAX_SESSIONS are
+    left out, and only the MAX_PAIRS most frequent pairs are kept."""
+    import numpy as np
+    index = dict((wssk, i) for i, wssk in enumerate(matrix.sessions))
+    pairs, counts, totals = _arrays(matrix)
+    wished, new_pairs = [], []
+    for sessions in wishlists:
+        for wssk in sessions:
+            if wssk not in index and len(matrix.sessions) < MAX_SESSIONS:
+                index[wssk] = len(matrix.sessions)
+                matrix.sessions.append(wssk)
+        ids = np.array(sorted(index[wssk] for wssk in sessions if wssk in index),
+                       np.int64)
+        wished.append(ids)
+        if len(ids) > 1:
+            i, j = np.triu_indices(len(ids), 1)
+            new_pairs.append((ids[i] << 32) | ids[j])
+    totals = np.concatenate([totals, np.zeros(len(matrix.sessions) - len(totals), np.int64)])
+    if wished:
+        totals += np.bincount(np.concatenate(wished), minlength=len(totals)).astype(np.int64)
+    if new_pairs:
+        added = np.concatenate(new_pairs)
+        ids, inverse = np.unique(np.concatenate([pairs, added]), return_inverse=True)
+        weights = np.concatenate([counts, np.ones(len(added), np.int64)])
+        pairs, counts = ids, np.bincount(inverse, weights=weights).astype(np.int64)
+    if len(pairs) > MAX_PAIRS:
+        # the rarest pairs go first; pairs stay sorted by id
+        keep = np.sort(np.argsort(-counts, kind='mergesort')[:MAX_PAIRS])
+        pairs, counts = pairs[keep], counts[keep]
+    matrix.pairs = zlib.compress(pairs.tostring())
+    matrix.counts = zlib.compress(counts.tostring())
+    matrix.totals = zlib.compress(totals.tostring())
+
+
+def topNeighbours(matrix, n=TOP_N):
+    """Return {websafe session key: [(neighbour, score)]} of a matrix, the
+    n most similar first, by the cosine similarity of the sessions'
+    wishlist vectors: pairs / sqrt(total i * total j)."""
+    import numpy as np
+    pairs, counts, totals = _arrays(matrix)
+    if not len(pairs):
+        return {}
+    i, j = pairs >> 32, pairs & 0xffffffff
+    rows, cols = np.concatenate([i, j]), np.concatenate([j, i])
+    scores = np.concatenate([counts, counts]).astype(float) / \
+        np.sqrt(totals[rows].astype(float) * totals[cols])
+    # by row, best score first; keep the first n of every row
+    order = np.lexsort((-scores, rows))
+    rows, cols, scores = rows[order], cols[order], scores[order]
+    starts = np.searchsorted(rows, rows)
+    keep = (np.arange(len(rows)) - starts) < n
+    neighbours = {}
+    for row, col, score in zip(rows[keep], cols[keep], scores[keep]):
+        neighbours.setdefault(matrix.sessions[row], []).append(
+            (matrix.sessions[col], float(score)))
+    return neighbours
+
+
+def _scoreConferences(job, step):
+    """Store the neighbours of the sessions of a few conferences."""
+    start = Cursor(urlsafe=job.cursor) if job.cursor else None
+    matrices, cursor, more = CoOccurrence.query(ancestor=job.key).fetch_page(
+        CONFERENCES_PAGE_SIZE, start_cursor=start)
+    stored = []
+    computedAt = datetime.utcnow()
+    for matrix in matrices:
+        for wssk, neighbours in topNeighbours(matrix).items():
+            stored.append(SessionNeighbours(
+                id=wssk, sessions=[s for s, score in neighbours],
+                scores=[score for s, score in neighbours],
+                computedAt=computedAt))
+    ndb.put_multi(stored)
+    job.sessionsScored += len(stored)
+    job.cursor = cursor.urlsafe() if more and cursor else None
+    if job.cursor is None:
+        job.phase = 'cleanup'
+    _checkpointStep(job.key, step, job)
+
+
+def _cleanup(job, step):
+    """Delete one batch of the matrices, the job's and those of abandoned
+    jobs, then of the neighbours the job didn't recompute."""
+    keys = CoOccurrence.query().fetch(DELETE_BATCH_SIZE, keys_only=True)
+    if not keys:
+        keys = SessionNeighbours.query(
+            SessionNeighbours.computedAt < job.startedAt).fetch(
+            DELETE_BATCH_SIZE, keys_only=True)
+        if len(keys) < DELETE_BATCH_SIZE:
+            job.phase = 'done'
+    ndb.delete_multi(keys)
+    if job.phase == 'done':
+        logging.info('Recommendations: %d profiles read, %d sessions scored'
+                     % (job.profilesRead, job.sessionsScored))
+    _checkpointStep(job.key, step, job)
+
+
+@ndb.transactional()
+def _checkpointStep(job_key, step, job):
+    stored = job_key.get()
+    if stored.done or stored.step != step:
+        return
+    _checkpoint(job)
+
+
+PHASES = {
+    'profiles': _countProfiles,
+    'neighbours': _scoreConferences,
+    'cleanup': _cleanup,
+}
+
+
+def recommendSessions(wishlist, limit=DEFAULT_RECOMMENDATIONS):
+    """Return the websafe keys of the sessions most similar to the
+    wishlisted ones, best first, summing the scores of every wishlisted
+    session they neighbour; wishlisted sessions are left out."""
+    limit = min(limit or DEFAULT_RECOMMENDATIONS, MAX_RECOMMENDATIONS)
+    wished = set(wishlist)
+    scores = {}
+    for neighbours in ndb.get_multi([ndb.Key(SessionNeighbours, wssk) for wssk in wished]):
+        if not neighbours:
+            continue
+        for wssk, score in zip(neighbours.sessions, neighbours.scores):
+            if wssk not in wished:
+                scores[wssk] = scores.get(wssk, 0.0) + score
+    return sorted(scores, key=lambda wssk: (-scores[wssk], wssk))[:limit]
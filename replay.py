@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+
+"""replay.py
+
+Replay of captured API calls (capture.py) on the App Engine testbed
+stubs, to rehearse traffic such as a registration day before it happens.
+The calls run against the data set of benchmark.py: every captured
+conference, session and user is mapped to a generated one, in order of
+appearance, so the shape of the traffic (hot conferences, returning
+users) is kept.
+
+    python replay.py --sdk ~/google_appengine --input capture.jsonl \
+        --scale 1000 --concurrency 20 --speed 10
+
+--speed compresses time: 10 replays an hour of traffic in 6 minutes, 0
+sends the calls as fast as the workers take them. The report (JSON) has
+the throughput, error rates and latency percentiles, overall and per
+method, and how late the calls started against their schedule.
+
+"""
+
+import argparse
+import json
+import os
+import Queue
+import sys
+import threading
+import time
+
+from benchmark import currentCommit
+from benchmark import generate
+from benchmark import percentile
+from benchmark import runCall
+from benchmark import setupSdk
+from benchmark import setupTestbed
+
+# captured request fields and the DataSet values they are mapped to
+MAPPED_FIELDS = {
+    'websafeConferenceKey': 'conferences',
+    'websafeSessionKey': 'sessions',
+}
+# methods that only the organizer of the conference may call
+ORGANIZER_METHODS = ('updateConference', 'createSession', 'deleteConference')
+
+
+class Remapper(object):
+    """Remapper -- maps captured keys and users to generated ones"""
+
+    def __init__(self, data):
+        self.data = data
+        self.mapped = {}    # pool -> {captured value: generated value}
+
+    def value(self, pool, captured):
+        mapped = self.mapped.setdefault(pool, {})
+        if captured not in mapped:
+            values = getattr(self.data, pool)
+            mapped[captured] = values[len(mapped) % len(values)]
+        return mapped[captured]
+
+    def call(self, call):
+        """Return the (user email, request fields) to replay a call with."""
+        fields = dict(call['request'])
+        for field, pool in MAPPED_FIELDS.items():
+            if fields.get(field):
+                fields[field] = self.value(pool, fields[field])
+        email = self.value('emails', call['user']) if call['user'] else None
+        wsck = fields.get('websafeConferenceKey')
+        if call['method'] in ORGANIZER_METHODS and wsck in self.data.organizers:
+            email = self.data.organizers[wsck]
+        return email, fields
+
+
+def requestType(api, name):
+    """Return the request message class of an API method."""
+    request_type = getattr(api, name).remote.request_type
+    return getattr(request_type, 'combined_message_class', request_type)
+
+
+def replay(calls, data, concurrency, speed):
+    """Replay calls on concurrency threads; return (results, seconds).
+    Results are (method, lag seconds, seconds, error) tuples."""
+    from google.appengine.runtime import request_environment
+    from protorpc import protojson
+    from conference import ConferenceApi
+
+    # every worker gets its own os.environ, as in the python27 runtime,
+    # so the user of one call does not leak into another
+    environ = dict(os.environ)
+    request_environment.PatchOsEnviron()
+    request_environment.current_request.Init(None, dict(environ))
+
+    api = ConferenceApi()
+    remapper = Remapper(data)
+    jobs = Queue.Queue(maxsize=concurrency * 2)
+    results = []
+    lock = threading.Lock()
+
+    def worker():
+        request_environment.current_request.Init(None, dict(environ))
+        while True:
+            job = jobs.get()
+            if job is None:
+                return
+            name, email, request, due = job
+            lag = max(0.0, time.time() - due)
+            seconds, stats, error = runCall(api, name, email, request)
+            with lock:
+                results.append((name, lag, seconds, error))
+
+    threads = [threading.Thread(target=worker) for i in range(concurrency)]
+    for t in threads:
+        t.start()
+    started = time.time()
+    first = calls[0]['time'] if calls else 0
+    for call in calls:
+        name = call['method']
+        email, fields = remapper.call(call)
+        request = protojson.decode_message(requestType(api, name),
+                                           json.dumps(fields))
+        due = started + (call['time'] - first) / speed if speed else time.time()
+        wait = due - time.time()
+        if wait > 0:
+            time.sleep(wait)
+        jobs.put((name, email, request, due))
+    for t in threads:
+        jobs.put(None)
+    for t in threads:
+        t.join()
+    return results, time.time() - started
+
+
+def summarise(results, seconds):
+    """Return the throughput, error and latency figures of a replay."""
+    def figures(rows):
+        times = [r[2] * 1000 for r in rows]
+        errors = sum(1 for r in rows if r[3])
+        return {
+            'calls': len(rows),
+            'errors': errors,
+            'errorRate': float(errors) / len(rows) if rows else None,
+            'latencyMs': {
+                'p50': percentile(times, 50),
+                'p95': percentile(times, 95),
+                'p99': percentile(times, 99),
+                'max': max(times) if times else None,
+            },
+        }
+
+    summary = figures(results)
+    summary['seconds'] = seconds
+    summary['callsPerSecond'] = len(results) / seconds if seconds else None
+    summary['lagMs'] = {
+        'p95': percentile([r[1] * 1000 for r in results], 95),
+        'max': max([r[1] * 1000 for r in results] or [None]),
+    }
+    methods = {}
+    for row in results:
+        methods.setdefault(row[0], []).append(row)
+    summary['methods'] = {}
+    for name, rows in methods.items():
+        summary['methods'][name] = figures(rows)
+        failed = [r[3] for r in rows if r[3]]
+        if failed:
+            summary['methods'][name]['firstError'] = failed[0]
+    return summary
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Replay captured API calls.')
+    parser.add_argument('--sdk', default=os.environ.get('APPENGINE_SDK'),
+                        help='App Engine SDK directory (default: $APPENGINE_SDK)')
+    parser.add_argument('--input', required=True,
+                        help='captured calls (JSONL, or logs with capture lines)')
+    parser.add_argument('--scale', type=int, default=1000,
+                        help='number of profiles of the data set (default: 1000)')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--concurrency', type=int, default=10,
+                        help='calls running at once (default: 10)')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='time compression factor, 0 for no pauses (default: 1)')
+    parser.add_argument('--output', help='write the JSON report here instead of stdout')
+    args = parser.parse_args(argv)
+
+    setupSdk(args.sdk)
+    from capture import readCapture
+    with open(args.input) as f:
+        calls = readCapture(f)
+
+    tb = setupTestbed()
+    try:
+        data = generate(args.scale, args.seed)
+        results, seconds = replay(calls, data, args.concurrency, args.speed)
+    finally:
+        tb.deactivate()
+
+    report = summarise(results, seconds)
+    report.update({
+        'commit': currentCommit(),
+        'input': args.input,
+        'scale': args.scale,
+        'concurrency': args.concurrency,
+        'speed': args.speed,
+    })
+    out = open(args.output, 'w') if args.output else sys.stdout
+    json.dump(report, out, indent=2, sort_keys=True)
+    out.write('\n')
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+
+"""rpcstats.py
+
+Counting of the App Engine API calls (datastore, memcache, task queue)
+made while a block of code runs, through an apiproxy post-call hook:
+
+    with recording() as stats:
+        api.queryConferences(request)
+    stats.datastoreReads, stats.memcacheHits, ...
+
+RpcTrace also flags wasteful patterns (identical queries run again, one
+query per item of a loop, runs of single gets), and tests can hold a block to an RPC budget:
+
+    with rpcBudget(queries=1, datastoreRpcs=3):
+        api.getConferenceSessions(request)
+
+"""
+
+import os
+import threading
+from contextlib import contextmanager
+
+from google.appengine.api import apiproxy_stub_map
+
+HOOK_NAME = 'rpcstats'
+# single gets of one kind, or queries of one shape differing only by their
+# filter values, in a block from which batching is advised
+N_PLUS_ONE_THRESHOLD = 3
+# trace every instrumented request on the dev server or when asked to
+TRACE_REQUESTS = os.environ.get('SERVER_SOFTWARE', '').startswith('Development') \
+    or bool(os.environ.get('RPC_TRACE'))
+
+_local = threading.local()
+_installed = []
+
+
+class RpcStats(object):
+    """RpcStats -- API call counters of one recorded block"""
+
+    FIELDS = ('datastoreRpcs', 'datastoreReads', 'datastoreWrites', 'queries',
+              'memcacheRpcs', 'memcacheHits', 'memcacheMisses', 'tasksAdded')
+
+    def __init__(self):
+        for field in self.FIELDS:
+            setattr(self, field, 0)
+
+    def add(self, other):
+        """Add the counters of other to these."""
+        for field in self.FIELDS:
+            setattr(self, field, getattr(self, field) + getattr(other, field))
+
+    def toDict(self):
+        return dict((field, getattr(self, field)) for field in self.FIELDS)
+
+    def record(self, service, call, request, response):
+        """Count one finished API call."""
+        if service == 'datastore_v3':
+            self.datastoreRpcs += 1
+            if call == 'Get':
+                self.datastoreReads += sum(
+                    1 for e in response.entity_list() if e.has_entity())
+            elif call in ('RunQuery', 'Next'):
+                if call == 'RunQuery':
+                    self.queries += 1
+                self.datastoreReads += response.result_size()
+            elif call == 'Put':
+                self.datastoreWrites += request.entity_size()
+            elif call == 'Delete':
+                self.datastoreWrites += request.key_size()
+        elif service == 'memcache':
+            self.memcacheRpcs += 1
+            if call == 'Get':
+                hits = response.item_size()
+                self.memcacheHits += hits
+                self.memcacheMisses += request.key_size() - hits
+        elif service == 'taskqueue':
+            if call == 'BulkAdd':
+                self.tasksAdded += request.add_request_size()
+            elif call == 'Add':
+                self.tasksAdded += 1
+
+    def memcacheHitRate(self):
+        lookups = self.memcacheHits + self.memcacheMisses
+        return float(self.memcacheHits) / lookups if lookups else None
+
+
+class RpcTrace(RpcStats):
+    """RpcTrace -- RpcStats also tracking the queries run and single-key
+    gets made, to flag repeated queries and gets that could be batched"""
+
+    def __init__(self):
+        super(RpcTrace, self).__init__()
+        self.queryRuns = {}     # query signature -> times run
+        self.queryShapes = {}   # query shape -> distinct signatures run
+        self.singleGets = {}    # kind -> single-key gets
+
+    def record(self, service, call, request, response):
+        super(RpcTrace, self).record(service, call, request, response)
+        if service != 'datastore_v3':
+            return
+        if call == 'RunQuery':
+            signature = _querySignature(request)
+            if signature not in self.queryRuns:
+                shape = _queryShape(request)
+                self.queryShapes[shape] = self.queryShapes.get(shape, 0) + 1
+            self.queryRuns[signature] = self.queryRuns.get(signature, 0) + 1
+        elif call == 'Get' and request.key_size() == 1:
+            kind = request.key(0).path().element_list()[-1].type()
+            self.singleGets[kind] = self.singleGets.get(kind, 0) + 1
+
+    def findings(self):
+        """Return the wasteful patterns seen, as messages."""
+        found = []
+        for signature, runs in sorted(self.queryRuns.items()):
+            if runs > 1:
+                found.append('%s query run %d times (repeated, or iterated '
+                             'more than once): %s' % (signature[0], runs,
+                                                      _describe(signature)))
+        for shape, count in sorted(self.queryShapes.items()):
+            if count >= N_PLUS_ONE_THRESHOLD:
+                found.append('%d %s queries differing only by filter values '
+                             '(one per item?): %s' % (count, shape[0],
+                                                      _describe(shape)))
+        for kind, gets in sorted(self.singleGets.items()):
+            if gets >= N_PLUS_ONE_THRESHOLD:
+                found.append('%d single gets of %s could be one get_multi'
+                             % (gets, kind))
+        return found
+
+    def report(self):
+        """Return a one line summary of the counters and findings."""
+        counters = ', '.join('%s=%d' % (field, getattr(self, field))
+                             for field in self.FIELDS)
+        findings = self.findings()
+        if findings:
+            counters += '; ' + '; '.join(findings)
+        return counters
+
+
+def _querySignature(query):
+    """Return what identifies a datastore query, whatever its batch size;
+    a cursor or offset makes it another query (e.g. the next page)."""
+    return (
+        query.kind(),
+        str(query.ancestor()) if query.has_ancestor() else None,
+        tuple(str(f) for f in query.filter_list()),
+        tuple(str(o) for o in query.order_list()),
+        tuple(query.property_name_list()),
+        query.keys_only(),
+        str(query.compiled_cursor()) if query.has_compiled_cursor() else None,
+        query.offset(),
+    )
+
+
+def _queryShape(query):
+    """Return a query signature without its filter values."""
+    return (
+        query.kind(),
+        query.has_ancestor(),
+        tuple('%s %s' % (','.join(p.name() for p in f.property_list()), f.op())
+              for f in query.filter_list()),
+        tuple(str(o) for o in query.order_list()),
+        tuple(query.property_name_list()),
+        query.keys_only(),
+    )
+
+
+def _describe(signature):
+    kind, ancestor, filters, orders, projection, keys_only = signature[:6]
+    parts = []
+    if ancestor:
+        parts.append('ancestor')
+    parts.extend(' '.join(f.split()) for f in filters)
+    parts.extend('order ' + ' '.join(o.split()) for o in orders)
+    if projection:
+        parts.append('projection ' + ','.join(projection))
+    if keys_only:
+        parts.append('keys only')
+    return ' | '.join(parts) or 'no filters'
+
+
+def _hook(service, call, request, response):
+    """Post-call hook feeding every stats object recording in this thread."""
+    for stats in getattr(_local, 'active', ()):
+        stats.record(service, call, request, response)
+
+
+def install():
+    """Install the post-call hook, once per process."""
+    if not _installed:
+        apiproxy_stub_map.apiproxy.GetPostCallHooks().Append(HOOK_NAME, _hook)
+        _installed.append(True)
+
+
+@contextmanager
+def recording(stats=None):
+    """Count the API calls made by this thread within the block."""
+    install()
+    stats = stats if stats is not None else RpcStats()
+    active = getattr(_local, 'active', None)
+    if active is None:
+        active = _local.active = []
+    active.append(stats)
+    try:
+        yield stats
+    finally:
+        active.remove(stats)
+
+
+@contextmanager
+def rpcBudget(allowFindings=False, **limits):
+    """Fail (AssertionError) if the block exceeds any of the limits, given
+    as RpcStats field=maximum, or shows wasteful patterns unless
+    allowFindings."""
+    for field in limits:
+        if field not in RpcStats.FIELDS:
+            raise ValueError('Unknown RPC counter: %s' % field)
+    with recording(RpcTrace()) as trace:
+        yield trace
+    exceeded = ['%s=%d > %d' % (field, getattr(trace, field), limit)
+                for field, limit in sorted(limits.items())
+                if getattr(trace, field) > limit]
+    if not allowFindings:
+        exceeded.extend(trace.findings())
+    if exceeded:
+        raise AssertionError('RPC budget exceeded: %s (%s)'
+                             % ('; '.join(exceeded), trace.report()))
@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+
+"""speakerdirectory.py
+
+Instance-local snapshot of the Speaker kind, which is small and rarely
+written, for the speaker read paths. Every instance keeps an immutable
+SpeakerDirectory of compact records indexed by name, company and
+specialty, and loads a new one when the generation counter in memcache
+no longer matches the one its snapshot was loaded at. Every Speaker
+write bumps the counter (bumpSpeakerGeneration), so a read costs one
+memcache get, and the first read after a write one Speaker query.
+
+That query is eventually consistent and may not see the latest writes
+yet, so each bump also records the keys it wrote under its generation
+number: a load gets the speakers written by the last RECENT_GENERATIONS
+bumps by key, which is strongly consistent, over the query's results.
+Snapshots are also reloaded after SNAPSHOT_SECONDS, in case those
+records were evicted, or after INCOMPLETE_SECONDS if the record of the
+current generation wasn't there (not stored yet, or evicted).
+
+"""
+
+import collections
+import threading
+import time
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+from caching import MEMCACHE_SPEAKER_GENERATION_KEY
+from caching import MEMCACHE_SPEAKER_WRITES_PRE_KEY
+from caching import getVersion
+from caching import incrementVersion
+from models import Speaker
+
+LOAD_BATCH_SIZE = 500
+RECENT_GENERATIONS = 20
+# well past the time the query takes to see a write
+RECENT_WRITES_SECONDS = 600
+SNAPSHOT_SECONDS = 300
+INCOMPLETE_SECONDS = 30
+
+SpeakerRecord = collections.namedtuple(
+    'SpeakerRecord', 'name biography specialty company websafeKey')
+
+_lock = threading.Lock()
+_current = [None]
+
+
+class SpeakerDirectory(object):
+    """SpeakerDirectory -- immutable snapshot of every Speaker"""
+
+    def __init__(self, generation, records, ttl=SNAPSHOT_SECONDS):
+        self.generation = generation
+        self.expiresAt = time.time() + ttl
+        self.records = tuple(records)
+        by_name, by_company, by_specialty = {}, {}, {}
+        for record in self.records:
+            by_name.setdefault(record.name, []).append(record)
+            by_company.setdefault(record.company, []).append(record)
+            for specialty in record.specialty:
+                by_specialty.setdefault(specialty, []).append(record)
+        self._indexes = {
+            'name': dict((k, tuple(v)) for k, v in by_name.items()),
+            'company': dict((k, tuple(v)) for k, v in by_company.items()),
+            'specialty': dict((k, tuple(v)) for k, v in by_specialty.items()),
+        }
+
+    def byName(self, name):
+        """Return the record of the speaker with this name, or None; like
+        the query it replaces, the first one of duplicate names."""
+        found = self._indexes['name'].get(name)
+        return found[0] if found else None
+
+    def namesByCompany(self, company):
+        return [r.name for r in self._indexes['company'].get(company, ())]
+
+    def namesBySpecialty(self, specialty):
+        return [r.name for r in self._indexes['specialty'].get(specialty, ())]
+
+    def query(self, filters):
+        """Return the records passing every equality filter, as (field,
+        value) pairs, and the number of records looked at. One indexed
+        field picks the candidates, the other filters are checked on them."""
+        candidates = self.records
+        rest = list(filters)
+        for i, (field, value) in enumerate(rest):
+            if field in self._indexes:
+                candidates = self._indexes[field].get(value, ())
+                del rest[i]
+                break
+        records = [r for r in candidates
+                   if all(_equals(r, field, value) for field, value in rest)]
+        return records, len(candidates)
+
+
+def _equals(record, field, value):
+    """Datastore equality: a repeated property matches any of its values."""
+    actual = getattr(record, field)
+    if isinstance(actual, tuple):
+        return value in actual
+    return actual == value
+
+
+def toRecord(speaker):
+    """Return the compact record of a Speaker entity."""
+    return SpeakerRecord(speaker.name, speaker.biography,
+                         tuple(speaker.specialty), speaker.company,
+                         speaker.key.urlsafe())
+
+
+def _recentWrites(generation):
+    """Return the keys of the Speakers written by the last bumps, and
+    whether the current generation's were found."""
+    try:
+        last = int(generation)
+    except ValueError:
+        return [], False
+    written = memcache.get_multi(
+        [str(g) for g in range(last - RECENT_GENERATIONS + 1, last + 1)],
+        key_prefix=MEMCACHE_SPEAKER_WRITES_PRE_KEY)
+    keys = [ndb.Key(urlsafe=wsk) for wsks in written.values() for wsk in wsks]
+    return keys, str(last) in written
+
+
+def loadDirectory(generation):
+    """Read every Speaker into a new SpeakerDirectory."""
+    recent, complete = _recentWrites(generation)
+    speakers = Speaker.query().fetch(batch_size=LOAD_BATCH_SIZE)
+    # the recent writes replace the query's results, or follow them
+    position = dict((s.key, i) for i, s in enumerate(speakers))
+    for speaker in ndb.get_multi(recent):
+        if speaker and speaker.key in position:
+            speakers[position[speaker.key]] = speaker
+        elif speaker:
+            position[speaker.key] = len(speakers)
+            speakers.append(speaker)
+    return SpeakerDirectory(generation, [toRecord(s) for s in speakers],
+                            SNAPSHOT_SECONDS if complete else INCOMPLETE_SECONDS)
+
+
+def _stale(directory, generation):
+    return (directory is None or directory.generation != generation or
+            time.time() > directory.expiresAt)
+
+
+def speakerDirectory():
+    """Return this instance's snapshot, reloaded if the generation moved
+    or it expired."""
+    generation = getVersion(MEMCACHE_SPEAKER_GENERATION_KEY)
+    directory = _current[0]
+    if _stale(directory, generation):
+        with _lock:
+            # another thread may have loaded it while we waited
+            directory = _current[0]
+            if _stale(directory, generation):
+                directory = loadDirectory(generation)
+                _current[0] = directory
+    return directory
+
+
+def _recordWrites(keys):
+    generation = incrementVersion(MEMCACHE_SPEAKER_GENERATION_KEY)
+    if generation is not None:
+        memcache.set(MEMCACHE_SPEAKER_WRITES_PRE_KEY + str(generation),
+                     [key.urlsafe() for key in keys],
+                     time=RECENT_WRITES_SECONDS)
+
+
+def bumpSpeakerGeneration(keys):
+    """Make every instance reload its snapshot, with the Speakers of keys,
+    on its next read; call it after any Speaker write. Inside a
+    transaction the bump waits for the commit."""
+    keys = list(keys)
+    ndb.get_context().call_on_commit(lambda: _recordWrites(keys))
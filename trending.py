@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+
+"""trending.py
+
+Conferences with the most registrations in the last hour and day.
+_conferenceRegistration counts every registration, in its own
+transaction, in a RegistrationShard counter of its BUCKET_SECONDS time
+bucket. The shard is picked at random among SHARDS, so concurrent
+registrations for the same conference rarely contend on the same
+entity, and a count commits (or not) with its registration.
+
+/crons/trending merges the shards of the last day into the top TOP_K
+conferences of each window, stored in a TrendingList entity and cached
+in memcache for getTrendingConferences, and deletes the shards that
+fell out of the day.
+
+"""
+
+import heapq
+import random
+import time
+from datetime import datetime
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+from caching import MEMCACHE_TRENDING_KEY
+from models import RegistrationShard
+from models import TrendingList
+
+BUCKET_SECONDS = 600
+SHARDS = 20
+# window name -> number of buckets, the current one included
+WINDOWS = {'hour': 3600 // BUCKET_SECONDS, 'day': 86400 // BUCKET_SECONDS}
+TOP_K = 20
+TRENDING_KEY = ndb.Key(TrendingList, 'conferences')
+DELETE_BATCH_SIZE = 500
+
+
+def currentBucket(now=None):
+    return int((now or time.time()) // BUCKET_SECONDS)
+
+
+def recordRegistration(wsck):
+    """Count one registration for a conference in a random shard of the
+    current bucket. Meant to run in the registration transaction (one more
+    entity group)."""
+    bucket = currentBucket()
+    key = ndb.Key(RegistrationShard, '%d|%s|%d' % (
+        bucket, wsck, random.randrange(SHARDS)))
+    shard = key.get() or RegistrationShard(key=key, bucket=bucket, conference=wsck)
+    shard.count += 1
+    shard.put()
+
+
+def mergeShards(now=None):
+    """Sum the shards of the last day into the TOP_K conferences of every
+    window, store and cache them; delete the older shards. Return the
+    TrendingList."""
+    current = currentBucket(now)
+    first = current - WINDOWS['day'] + 1
+    totals = dict((name, {}) for name in WINDOWS)
+    q = RegistrationShard.query(RegistrationShard.bucket >= first)
+    for shard in q.iter(batch_size=1000):
+        for name, size in WINDOWS.items():
+            if shard.bucket > current - size:
+                window = totals[name]
+                window[shard.conference] = window.get(shard.conference, 0) + shard.count
+    top = {}
+    for name, window in totals.items():
+        top[name] = heapq.nlargest(TOP_K, window.items(), key=lambda item: item[1])
+    trending = TrendingList(key=TRENDING_KEY, top=top, computedAt=datetime.utcnow())
+    trending.put()
+    memcache.set(MEMCACHE_TRENDING_KEY, (top, trending.computedAt))
+    _deleteOldShards(first)
+    return trending
+
+
+def _deleteOldShards(first):
+    q = RegistrationShard.query(RegistrationShard.bucket < first)
+    while True:
+        keys = q.fetch(DELETE_BATCH_SIZE, keys_only=True)
+        if not keys:
+            return
+        ndb.delete_multi(keys)
+
+
+def trendingConferences(window):
+    """Return ([(wsck, registrations)] of the window, most first, and when
+    they were computed)."""
+    cached = memcache.get(MEMCACHE_TRENDING_KEY)
+    if cached is None:
+        trending = TRENDING_KEY.get() or TrendingList(key=TRENDING_KEY)
+        cached = (trending.top or {}, trending.computedAt)
+        memcache.add(MEMCACHE_TRENDING_KEY, cached)
+    top, computedAt = cached
+    return top.get(window, []), computedAt
@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+
+"""waitlist.py
+
+Waitlist of full conferences. Registering for a conference with no free
+seat, or with people already waiting, adds a WaitlistEntry instead (a
+child of the user's Profile, keyed by the conference) stamped with its
+arrival time, and counts it in Conference.waitlisted so that the seats
+freed later go to the waitlist first.
+
+Freeing seats (an unregistration or a capacity increase) queues a
+/tasks/promote_waitlist task. It is delayed by PROMOTION_DELAY_SECONDS so
+that the seats freed meanwhile are promoted together, oldest entries
+first, PROMOTION_BATCH_SIZE users per transaction.
+
+A position is the number of entries that arrived earlier, plus one. It is
+cached in memcache under a per conference version, bumped when entries
+leave the waitlist; joining only adds at the tail, so it leaves the cached
+positions valid.
+
+"""
+
+import logging
+
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+from caching import MEMCACHE_WAITLIST_POSITION_PRE_KEY
+from caching import bumpMonthVersions
+from caching import bumpVersion
+from caching import conferenceVersionKey
+from caching import getVersion
+from caching import waitlistVersionKey
+from emails import enqueueEmails
+from models import WaitlistEntry
+
+PROMOTION_DELAY_SECONDS = 10
+# profiles plus the conference: within the 25 entity groups of a
+# cross-group transaction
+PROMOTION_BATCH_SIZE = 20
+# batches per task, the next task goes on where it stopped
+MAX_PROMOTION_BATCHES = 10
+# entries counted at most to compute a position
+MAX_COUNTED_POSITION = 1000
+POSITION_CACHE_SECONDS = 600
+
+
+def entryKey(profile_key, wsck):
+    return ndb.Key(WaitlistEntry, wsck, parent=profile_key)
+
+
+def joinWaitlist(conf, prof):
+    """Put a user on the waitlist of a conference, keeping their place if
+    they already are. Meant to run in the registration transaction, which
+    writes conf."""
+    wsck = conf.key.urlsafe()
+    key = entryKey(prof.key, wsck)
+    if not key.get():
+        WaitlistEntry(key=key, conference=wsck).put()
+        conf.waitlisted = (conf.waitlisted or 0) + 1
+    if conf.seatsAvailable > 0:
+        # free seats left by a promotion that didn't see every entry yet
+        enqueuePromotion(conf.key)
+
+
+def leaveWaitlist(conf, prof):
+    """Take a user off the waitlist of a conference; return whether they
+    were on it. Meant to run in the transaction writing conf."""
+    wsck = conf.key.urlsafe()
+    key = entryKey(prof.key, wsck)
+    if not key.get():
+        return False
+    key.delete()
+    conf.waitlisted = max(0, (conf.waitlisted or 0) - 1)
+    bumpVersion(waitlistVersionKey(wsck))
+    return True
+
+
+def enqueuePromotion(conf_key):
+    """Queue the promotion of a conference's waitlist to its free seats;
+    in a transaction, only once it commits."""
+    taskqueue.add(params={'conference': conf_key.urlsafe()},
+        url='/tasks/promote_waitlist',
+        countdown=PROMOTION_DELAY_SECONDS,
+        transactional=ndb.in_transaction()
+    )
+
+
+@ndb.transactional(xg=True)
+def _promoteBatch(conf_key, entry_keys):
+    """Register the users of entry_keys, oldest first, while the conference
+    has free seats. Return (emails of the promoted users, entries removed,
+    seats left)."""
+    wsck = conf_key.urlsafe()
+    conf = conf_key.get()
+    entries = ndb.get_multi(entry_keys)
+    profiles = ndb.get_multi([key.parent() for key in entry_keys])
+    removed, promoted = [], []
+    for entry, prof in zip(entries, profiles):
+        if conf.seatsAvailable <= 0:
+            break
+        if not entry:
+            # left the waitlist meanwhile
+            continue
+        removed.append(entry.key)
+        if prof and wsck not in prof.conferenceKeysToAttend:
+            prof.conferenceKeysToAttend.append(wsck)
+            conf.seatsAvailable -= 1
+            promoted.append(prof)
+    if removed:
+        conf.waitlisted = max(0, (conf.waitlisted or 0) - len(removed))
+        ndb.put_multi([conf] + promoted)
+        ndb.delete_multi(removed)
+        bumpVersion(conferenceVersionKey(wsck))
+        bumpMonthVersions(conf.startDate)
+        bumpVersion(waitlistVersionKey(wsck))
+    return ([p.mainEmail for p in promoted if p.mainEmail],
+            len(removed), conf.seatsAvailable)
+
+
+def promoteWaitlist(conf_key):
+    """Give the free seats of a conference to its waitlist, in batches;
+    return the number of users promoted."""
+    wsck = conf_key.urlsafe()
+    if not conf_key.get():
+        # deleted: the deletion job clears its waitlist
+        return 0
+    q = WaitlistEntry.query(WaitlistEntry.conference == wsck)
+    q = q.order(WaitlistEntry.joinedAt)
+    total = 0
+    for i in range(MAX_PROMOTION_BATCHES):
+        keys = q.fetch(PROMOTION_BATCH_SIZE, keys_only=True)
+        if not keys:
+            return total
+        emails, removed, seats = _promoteBatch(conf_key, keys)
+        if emails:
+            enqueueEmails('waitlist_promoted', emails, wsck)
+        total += len(emails)
+        if seats <= 0 or not removed:
+            # no seat left, or only entries that already left (the query
+            # is eventually consistent)
+            return total
+    enqueuePromotion(conf_key)
+    logging.info('Promoted %d users to %s, more to go' % (total, wsck))
+    return total
+
+
+def waitlistPosition(wsck, profile_key):
+    """Return the position (from 1) of a user on the waitlist of a
+    conference, or None if they are not on it."""
+    version = getVersion(waitlistVersionKey(wsck))
+    key = MEMCACHE_WAITLIST_POSITION_PRE_KEY + '%s|%s|%s' % (
+        wsck, version, profile_key.id())
+    position = memcache.get(key)
+    if position is None:
+        entry = entryKey(profile_key, wsck).get()
+        if not entry:
+            return None
+        position = WaitlistEntry.query(
+            WaitlistEntry.conference == wsck,
+            WaitlistEntry.joinedAt < entry.joinedAt
+        ).count(limit=MAX_COUNTED_POSITION) + 1
+        memcache.set(key, position, time=POSITION_CACHE_SECONDS)
+    return position
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+
+"""warmup.py
+
+Warmup of new instances and measurement of their cold start. App Engine
+sends /_ah/warmup (inbound_services: warmup) to an instance before any
+traffic; warmup() then loads the API modules, builds the request message
+classes of the resource containers, parses index.yaml, loads the speaker
+directory and primes the announcement cache, timing every step.
+
+STARTED is when the instance loaded its first script (main.py and
+apistats.py import this module first), so apistats can record when, and
+how fast, every instance served its first API call.
+
+"""
+
+import logging
+import time
+
+STARTED = time.time()
+WARMED = [False]
+
+
+def _loadApi():
+    """Import the endpoints API with protorpc and every model."""
+    import conference
+
+
+def _buildMessages():
+    """Build the request messages of the resource containers (lazily built
+    on the first request otherwise) and the API's method map."""
+    import endpoints
+    import conference
+    for value in vars(conference).values():
+        if isinstance(value, endpoints.ResourceContainer):
+            value.combined_message_class
+    conference.ConferenceApi.all_remote_methods()
+
+
+def _loadIndexes():
+    from indexes import declaredIndexes
+    declaredIndexes()
+
+
+def _loadSpeakers():
+    from speakerdirectory import speakerDirectory
+    speakerDirectory()
+
+
+def _primeCaches():
+    """Fill the memcache entries the first requests would otherwise miss."""
+    from google.appengine.api import memcache
+    from caching import MEMCACHE_ANNOUNCEMENTS_KEY
+    from caching import cacheAnnouncement
+    if memcache.get(MEMCACHE_ANNOUNCEMENTS_KEY) is None:
+        cacheAnnouncement()
+
+
+STEPS = [
+    ('loadApi', _loadApi),
+    ('buildMessages', _buildMessages),
+    ('loadIndexes', _loadIndexes),
+    ('loadSpeakers', _loadSpeakers),
+    ('primeCaches', _primeCaches),
+]
+
+
+def warmup():
+    """Run the warmup steps; return their durations (ms) by step name."""
+    timings = {}
+    for name, step in STEPS:
+        started = time.time()
+        try:
+            step()
+        except Exception, e:
+            # a failed step is only work left to the first request
+            logging.warning('Warmup step %s failed: %s' % (name, e))
+        timings[name] = (time.time() - started) * 1000
+    WARMED[0] = True
+    logging.info('Warmed up %.0f ms after instance start: %s' % (
+        (time.time() - STARTED) * 1000,
+        ', '.join('%s %.0f ms' % (name, timings[name]) for name, s in STEPS)))
+    return timings